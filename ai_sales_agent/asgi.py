@@ -0,0 +1,218 @@
+"""ASGI-вариант агента на asyncio.
+
+Запуск: uvicorn asgi:asgi_app --host 0.0.0.0 --port $PORT
+
+POST /event_handler (и /tenants/<id>/event_handler) обрабатывается нативно: OpenAI и WAHA вызываются
+асинхронными клиентами, работа с Google Таблицей уходит в потоки, а
+независимые шаги (запись клиента и чтение каталога) идут параллельно.
+Логика этапов (main.upsell_steps), проверка и дедупликация событий
+(main.event_steps), настройки, кэши, буфер записи и метрики общие с main.py;
+остальные роуты обслуживает то же Flask-приложение через asgiref.WsgiToAsgi.
+"""
+import asyncio
+import json
+
+from asgiref.wsgi import WsgiToAsgi
+
+import main
+import metrics
+from tenants import tenant_scope
+from waha_client import AsyncWahaClient, make_async_client
+
+app = main.app
+flask_asgi = WsgiToAsgi(app)
+
+# Один пул соединений к WAHA на все сессии продавцов
+waha_http_client = make_async_client(pool_size=main.WAHA_POOL_SIZE)
+async_waha_clients = {
+    tenant.id: AsyncWahaClient(
+        tenant.waha_client.url,
+        tenant.waha_client.build_payload,
+        max_retries=main.WAHA_MAX_RETRIES,
+        # Общий ограничитель частоты с синхронным клиентом (рассылки, отложенные задачи)
+        limiter=tenant.waha_client.limiter,
+        on_retry=lambda: metrics.count_retry("waha"),
+        client=waha_http_client
+    )
+    for tenant in main.tenant_registry
+}
+_openai_client = None
+
+def get_async_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        import openai
+        _openai_client = openai.AsyncOpenAI(api_key=main.OPENAI_API_KEY)
+    return _openai_client
+
+# --- ВНЕШНИЕ ВЫЗОВЫ ---
+
+async def get_openai_response_async(prompt, model=main.OPENAI_FULL_MODEL, scenario=None, customer_name=None,
+                                    defer_on_throttle=False, usage=None):
+    cached, cache_key, name = main.cached_openai_response(prompt, model, scenario, customer_name)
+    if cached is not None:
+        if usage is not None:
+            usage["cached"] = True
+        return cached
+    rate_limiters = main.current_tenant().rate_limiters
+    limiter, tokens_limiter = rate_limiters["openai"], rate_limiters["openai_tokens"]
+    try:
+        with metrics.span("openai"):
+            if tokens_limiter:
+                await tokens_limiter.acquire_async(main.estimate_openai_tokens(prompt))
+            create = get_async_openai_client().chat.completions.create
+            kwargs = {"model": model, "messages": main.openai_messages(prompt), "temperature": 0.7}
+            response = await (limiter.call_async(create, **kwargs) if limiter else create(**kwargs))
+        answer = response.choices[0].message.content.strip()
+        main.record_openai_usage(usage, response)
+    except main.RateLimited as e:
+        app.logger.warning(f"OpenAI: {e}")
+        if defer_on_throttle:
+            raise
+        return main.OPENAI_FALLBACK_ANSWER
+    except Exception as e:
+        app.logger.error(f"Ошибка OpenAI: {e}")
+        return main.OPENAI_FALLBACK_ANSWER
+    main.remember_openai_response(cache_key, answer, name)
+    return answer
+
+# Статистика политик рендеринга общая с Flask-роутами
+for tenant in main.tenant_registry:
+    tenant.stage_router.complete_async = get_openai_response_async
+
+async def render_stage_message_async(stage_id, context, customer_name=None):
+    return await main.current_tenant().stage_router.render_async(stage_id, context, customer_name=customer_name)
+
+async def send_waha_message_async(phone, text):
+    try:
+        with metrics.span("waha"):
+            sent = await async_waha_clients[main.current_tenant().id].send(phone, text)
+    except Exception as e:
+        app.logger.error(f"Ошибка при отправке WAHA-сообщения: {e}")
+        return False
+    if not sent:
+        metrics.count_error("waha")
+    return sent
+
+# --- ЭТАПЫ ВОРОНКИ ---
+
+async def prepare_upsell_async(customer_info, order_info):
+    # Запись клиента и чтение каталога друг от друга не зависят
+    update = asyncio.to_thread(main.update_customer_in_sheet, customer_info, "POST_PURCHASE", order_info)
+    if not order_info.get('sku'):
+        await update
+        return None
+    _, catalog = await asyncio.gather(update, asyncio.to_thread(main.get_catalog))
+    return catalog
+
+UPSELL_ACTIONS = {
+    "prepare": prepare_upsell_async, "render": render_stage_message_async, "send": send_waha_message_async,
+}
+assert UPSELL_ACTIONS.keys() == main.UPSELL_ACTIONS.keys(), "шаги допродажи ASGI и Flask расходятся"
+
+async def run_steps_async(steps, actions):
+    """Асинхронный вариант main.run_steps."""
+    try:
+        step = next(steps)
+        while True:
+            try:
+                result = await actions[step[0]](*step[1:])
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+async def handle_upsell_async(data):
+    return await run_steps_async(main.upsell_steps(data), UPSELL_ACTIONS)
+
+async def handle_delivered_async(data):
+    customer_info = data.get("customer", {})
+    await asyncio.gather(
+        asyncio.to_thread(main.update_customer_in_sheet, customer_info, "ORDER_DELIVERED"),
+        asyncio.to_thread(main.schedule_task, main.review_request_payload(data)),
+    )
+    return {"status": "success", "action": "review_request_scheduled"}, 200
+
+ASYNC_EVENT_HANDLERS = {
+    "POST_PURCHASE": handle_upsell_async,
+    "ORDER_DELIVERED": handle_delivered_async,
+}
+assert ASYNC_EVENT_HANDLERS.keys() == main.EVENT_HANDLERS.keys(), "этапы ASGI и Flask расходятся"
+
+async def process_event_async(event_data):
+    error = main.validate_event(event_data)
+    if error: return error
+    stage = event_data["waha_stage_id"]
+    with tenant_scope(main.tenant_registry.get(event_data.get("tenant_id"))), \
+            metrics.track_event(stage, app.logger) as result:
+        body, status_code = await ASYNC_EVENT_HANDLERS[stage](event_data)
+        result["status"] = status_code
+    return body, status_code
+
+async def event_handler(body, tenant_id=None):
+    """Тот же путь, что и main.event_handler (main.event_steps); возвращает (тело, код, заголовки)."""
+    try:
+        event_data = json.loads(body) if body else None
+    except ValueError:
+        event_data = None
+    return await run_steps_async(main.event_steps(event_data, tenant_id), {"process": process_event_async})
+
+ROUTES = {
+    ("POST", "/event_handler"): event_handler,
+}
+
+def match_route(method, path):
+    """(обработчик, аргументы) для нативного роута или (None, None)."""
+    route = ROUTES.get((method, path))
+    if route:
+        return route, {}
+    parts = path.strip("/").split("/")
+    if method == "POST" and len(parts) == 3 and parts[0] == "tenants" and parts[2] == "event_handler":
+        return event_handler, {"tenant_id": parts[1]}
+    return None, None
+
+# --- ASGI ---
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await waha_http_client.aclose()
+            if _openai_client is not None:
+                await _openai_client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    route, kwargs = match_route(scope["method"], scope["path"]) if scope["type"] == "http" else (None, None)
+    if not route:
+        return await flask_asgi(scope, receive, send)
+    body = await read_body(receive)
+    try:
+        payload, status_code, extra_headers = await route(body, **kwargs)
+    except Exception as e:
+        app.logger.error(f"Ошибка при обработке {scope['path']}: {e}")
+        payload, status_code, extra_headers = {"status": "error", "message": "Internal Server Error"}, 500, {}
+    content = json.dumps(payload).encode("utf-8")
+    headers = [("Content-Type", "application/json"), ("Content-Length", str(len(content)))]
+    headers.extend(extra_headers.items())
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(name.lower().encode("latin-1"), str(value).encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": content})
@@ -0,0 +1,210 @@
+"""Офлайн-бенчмарк /event_handler с локальными заменителями внешних сервисов.
+
+Пример (из каталога ai_sales_agent):
+    python bench/run_benchmark.py --events 2000 --concurrency 32 --catalog-size 20000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Заменители Sheets, OpenAI и WAHA общие с тестами
+sys.path.insert(0, os.path.join(AGENT_DIR, "tests"))
+
+from fakes import (CallCounter, FakeGspreadClient, FakeOpenAI, FakeSpreadsheet, FakeWahaServer,
+                   FakeWorksheet, customer_phone, seed_customers, seed_products)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=1000, help="сколько событий отправить")
+    parser.add_argument("--concurrency", type=int, default=16, help="параллельных HTTP-клиентов")
+    parser.add_argument("--delivered-ratio", type=float, default=0.2, help="доля ORDER_DELIVERED")
+    parser.add_argument("--catalog-size", type=int, default=5000)
+    parser.add_argument("--customers", type=int, default=10000)
+    parser.add_argument("--new-customer-ratio", type=float, default=0.3)
+    parser.add_argument("--sheets-latency", type=float, default=0.15)
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=1.5)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--waha-latency", type=float, default=0.1)
+    parser.add_argument("--waha-error-rate", type=float, default=0.0)
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="отправлять события пакетами в /event_handler/batch (0 — по одному)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="вывести отчет в JSON")
+    return parser.parse_args()
+
+
+def install_fakes(args, counter, waha_url, workdir):
+    """Подменяет внешние клиенты до импорта main.py и настраивает окружение."""
+    rng = random.Random(args.seed)
+    products = FakeWorksheet("products", seed_products(args.catalog_size, rng=rng), counter,
+                             args.sheets_latency, args.sheets_error_rate, random.Random(args.seed + 1))
+    customers = FakeWorksheet("customers", seed_customers(args.customers, args.catalog_size, rng=rng), counter,
+                              args.sheets_latency, args.sheets_error_rate, random.Random(args.seed + 2))
+    spreadsheet = FakeSpreadsheet([products, customers], counter, args.sheets_latency)
+    fake_openai = FakeOpenAI(counter, args.openai_latency, args.openai_error_rate, random.Random(args.seed + 3))
+
+    import gspread
+    import openai
+    from oauth2client.service_account import ServiceAccountCredentials
+    gspread.authorize = lambda creds: FakeGspreadClient(spreadsheet)
+    ServiceAccountCredentials.from_json_keyfile_name = staticmethod(lambda *a, **kw: None)
+    openai.OpenAI = lambda *a, **kw: fake_openai
+
+    defaults = {
+        "OPENAI_API_KEY": "bench", "WAHA_API_ENDPOINT": waha_url, "WAHA_SESSION_ID": "bench",
+        "FUNCTION_URL": "http://localhost", "GOOGLE_SHEET_URL": "https://sheets.local/bench",
+        "TASKS_DB_PATH": os.path.join(workdir, "tasks.sqlite3"),
+        "CAMPAIGNS_DB_PATH": os.path.join(workdir, "campaigns.sqlite3"),
+        "LOCAL_STORE_PATH": os.path.join(workdir, "store.sqlite3"),
+        "KNOWLEDGE_BASE_PATH": os.path.join(AGENT_DIR, "knowledge_base.json"),
+        "WAHA_RATE_LIMIT": "1000",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    os.environ["WAHA_API_ENDPOINT"] = waha_url
+    return products, customers
+
+
+def make_events(args):
+    rng = random.Random(args.seed + 4)
+    events = []
+    for i in range(args.events):
+        if rng.random() < args.new_customer_ratio:
+            phone = customer_phone(args.customers + i)
+        else:
+            phone = customer_phone(rng.randrange(args.customers))
+        sku = str(100000 + rng.randrange(args.catalog_size))
+        stage = "ORDER_DELIVERED" if rng.random() < args.delivered_ratio else "POST_PURCHASE"
+        events.append({
+            "waha_stage_id": stage,
+            "customer": {"phone": phone, "name": f"Клиент {phone[-4:]}"},
+            "order": {"id": f"bench-{i}", "sku": sku, "product_name": f"Модель {sku}"},
+        })
+    return events
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(args):
+    counter = CallCounter()
+    waha = FakeWahaServer(counter, args.waha_latency, args.waha_error_rate, random.Random(args.seed + 5)).start()
+    workdir = tempfile.mkdtemp(prefix="agent-bench-")
+    install_fakes(args, counter, waha.url, workdir)
+
+    sys.path.insert(0, AGENT_DIR)
+    os.chdir(AGENT_DIR)
+    import main
+    from werkzeug.serving import make_server
+
+    # Прогрев (подключение, каталог, индекс клиентов) не входит в замер
+    main.sheets_ready.wait(30)
+    tenant = main.tenant_registry.get()
+    if tenant.sheet_sync:
+        tenant.sheet_sync.pull()
+    main.get_catalog()
+    if tenant.customer_writer:
+        tenant.customer_writer.row_index.get("")
+    counter.reset()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/event_handler"
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+
+    def send(event):
+        started = time.perf_counter()
+        response = session.post(url, json=event, timeout=120)
+        return time.perf_counter() - started, response.status_code
+
+    def send_batch(batch):
+        started = time.perf_counter()
+        response = session.post(f"{url}/batch", json=batch, timeout=600)
+        latency = time.perf_counter() - started
+        if response.status_code != 200:
+            return [(latency, response.status_code)] * len(batch)
+        return [(latency, result["status_code"]) for result in response.json()["results"]]
+
+    events = make_events(args)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        if args.batch_size > 0:
+            batches = [events[i:i + args.batch_size] for i in range(0, len(events), args.batch_size)]
+            results = [result for batch in executor.map(send_batch, batches) for result in batch]
+        else:
+            results = list(executor.map(send, events))
+    if main.event_queue:
+        main.event_queue.join()
+    elapsed = time.perf_counter() - started
+    if tenant.sheet_sync:
+        tenant.sheet_sync.push()
+    if tenant.customer_writer:
+        tenant.customer_writer.flush()
+
+    server.shutdown()
+    waha.stop()
+
+    latencies = [latency for latency, _ in results]
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    calls = counter.snapshot()
+    total_calls = sum(calls.values())
+    return {
+        "events": len(events),
+        "concurrency": args.concurrency,
+        "batch_size": args.batch_size,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_eps": round(len(events) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "mean": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        },
+        "status_codes": statuses,
+        "external_calls": calls,
+        "external_calls_per_event": round(total_calls / len(events), 3) if events else 0.0,
+    }
+
+
+def print_report(report):
+    print(f"Событий: {report['events']}, параллельно: {report['concurrency']}, "
+          f"время: {report['elapsed_seconds']} с, пропускная способность: {report['throughput_eps']} соб/с")
+    latency = report["latency_ms"]
+    print(f"Задержка, мс: p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} mean={latency['mean']}")
+    print(f"HTTP-коды: {report['status_codes']}")
+    print(f"Внешних вызовов на событие: {report['external_calls_per_event']}")
+    for name, count in sorted(report["external_calls"].items()):
+        print(f"  {name}: {count}")
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    result = run(arguments)
+    if arguments.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
@@ -0,0 +1,244 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    campaign_id TEXT PRIMARY KEY,
+    filters TEXT NOT NULL,
+    next_row INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    matched INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    scanned INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS campaign_recipients (
+    campaign_id TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (campaign_id, phone)
+);
+"""
+
+# Квота OpenAI/WAHA исчерпана: получателя нужно повторить позже, а не считать ошибкой
+DEFERRED = "deferred"
+
+
+def customer_matches(row, filters, load_orders=None):
+    """Проверяет строку листа customers (телефон, имя, этап, история) по фильтрам рассылки.
+
+    load_orders(row) — история заказов клиента; по умолчанию JSON из колонки D.
+    """
+    if not row or not str(row[0]).strip():
+        return False
+    stage = row[2] if len(row) > 2 else ''
+    if filters.get("stages") and stage not in filters["stages"]:
+        return False
+    if filters.get("exclude_stages") and stage in filters["exclude_stages"]:
+        return False
+    min_orders = filters.get("min_orders") or 0
+    skus = filters.get("skus")
+    if min_orders or skus:
+        orders = (load_orders or parse_orders)(row)
+        if len(orders) < min_orders:
+            return False
+        if skus and not any(str(order.get("sku")) in skus for order in orders if isinstance(order, dict)):
+            return False
+    return True
+
+
+def parse_orders(row):
+    try:
+        orders = json.loads((row[3] if len(row) > 3 else '') or '[]')
+    except json.JSONDecodeError:
+        return []
+    return orders if isinstance(orders, list) else []
+
+
+class CampaignRunner:
+    """Рассылка PROMOTIONS по листу customers страницами постоянного размера.
+
+    Лист читается диапазонами по page_size строк до последней строки с
+    телефоном на момент запуска, в памяти держится только текущая страница. Подходящие клиенты обрабатываются пулом из max_workers
+    потоков: render(row) готовит текст (пустой — клиент пропускается),
+    send(phone, text) отправляет его; частоту отправки ограничивает сам
+    клиент WAHA. Каждый обработанный получатель сразу записывается в SQLite
+    (campaign_recipients), номер следующей страницы — после каждой страницы,
+    поэтому после падения рассылка продолжается с прерванной страницы, а
+    клиенты, которые уже получили сообщение, пропускаются. Если render или
+    send бросает RateLimited, получатель не считается ошибкой: такие
+    получатели страницы повторяются через retry_delay секунд (с удвоением
+    паузы до max_retry_delay), пока квота не освободится.
+    Историю заказов для фильтров min_orders и skus дает load_orders(row).
+    """
+
+    def __init__(self, worksheet, render, send, db_path, page_size=500, max_workers=8, load_orders=parse_orders,
+                 retry_delay=30, max_retry_delay=300):
+        self.worksheet = worksheet
+        self.render = render
+        self.send = send
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.load_orders = load_orders
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._running = set()
+
+    def start(self, filters, campaign_id=None):
+        """Создает (или продолжает существующую) рассылку и запускает ее в фоне."""
+        campaign_id = str(campaign_id) if campaign_id else uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO campaigns (campaign_id, filters, next_row, status, created_at, updated_at) "
+                "VALUES (?, ?, 2, 'running', ?, ?)",
+                (campaign_id, json.dumps(filters, ensure_ascii=False), now, now),
+            )
+            self._conn.execute(
+                "UPDATE campaigns SET status = 'running' WHERE campaign_id = ? AND status != 'done'",
+                (campaign_id,))
+        self._spawn(campaign_id)
+        return campaign_id
+
+    def resume_unfinished(self):
+        """Продолжает рассылки, прерванные перезапуском процесса."""
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute(
+                "SELECT campaign_id FROM campaigns WHERE status = 'running'")]
+        for campaign_id in ids:
+            logger.info(f"Продолжаем рассылку {campaign_id} с контрольной точки")
+            self._spawn(campaign_id)
+        return ids
+
+    def status(self, campaign_id):
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM campaigns WHERE campaign_id = ?", (campaign_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            record = dict(zip([column[0] for column in cursor.description], row))
+        record["filters"] = json.loads(record["filters"])
+        return record
+
+    def _spawn(self, campaign_id):
+        with self._lock:
+            if campaign_id in self._running:
+                return
+            self._running.add(campaign_id)
+        threading.Thread(target=self._run, args=(campaign_id,), name=f"campaign-{campaign_id}", daemon=True).start()
+
+    def _run(self, campaign_id):
+        try:
+            record = self.status(campaign_id)
+            if not record or record["status"] != "running":
+                return
+            filters, next_row = record["filters"], record["next_row"]
+            # Последняя строка с телефоном. Короткая страница не означает конец листа:
+            # Sheets не возвращает пустые строки в конце диапазона.
+            # Клиенты, дописанные после запуска, в рассылку не попадают.
+            sheet_rows = len(self.worksheet.col_values(1))
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while next_row <= sheet_rows:
+                    last_row = min(next_row + self.page_size - 1, sheet_rows)
+                    page = self.worksheet.get(f"A{next_row}:D{last_row}")
+                    matched = [row for row in page if customer_matches(row, filters, self.load_orders)]
+                    done = self._processed_phones(campaign_id, [str(row[0]).strip() for row in matched])
+                    pending = [row for row in matched if str(row[0]).strip() not in done]
+                    self._deliver_page(campaign_id, pending, executor)
+                    next_row = last_row + 1
+                    self._checkpoint(campaign_id, next_row, len(page), len(matched), "running")
+            self._checkpoint(campaign_id, next_row, 0, 0, "done")
+            logger.info(f"Рассылка {campaign_id} завершена")
+        except Exception as e:
+            logger.error(f"Рассылка {campaign_id} прервана: {e}")
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE campaigns SET status = 'failed', last_error = ?, updated_at = ? WHERE campaign_id = ?",
+                    (str(e), time.time(), campaign_id))
+        finally:
+            with self._lock:
+                self._running.discard(campaign_id)
+
+    def _deliver_page(self, campaign_id, rows, executor):
+        delay = self.retry_delay
+        while True:
+            results = list(executor.map(lambda row: self._deliver(campaign_id, row), rows))
+            rows = [row for row, result in zip(rows, results) if result == DEFERRED]
+            if not rows:
+                return
+            logger.warning(f"Рассылка {campaign_id}: квота исчерпана, {len(rows)} получателей "
+                           f"повторим через {delay} с")
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def _deliver(self, campaign_id, row):
+        phone = str(row[0]).strip()
+        try:
+            text = self.render(row)
+            if not text:
+                result = None
+            else:
+                result = bool(self.send(phone, text))
+        except RateLimited as e:
+            logger.info(f"Рассылка клиенту {row[0]} отложена: {e}")
+            return DEFERRED
+        except Exception as e:
+            logger.error(f"Ошибка рассылки клиенту {row[0]}: {e}")
+            result = False
+        self._record_recipient(campaign_id, phone, {True: "sent", False: "failed", None: "skipped"}[result])
+        return result
+
+    def _processed_phones(self, campaign_id, phones):
+        """Телефоны из phones, которым эта рассылка уже отправляла (или пыталась отправить) сообщение."""
+        if not phones:
+            return set()
+        with self._lock:
+            found = set()
+            for start in range(0, len(phones), 500):
+                chunk = phones[start:start + 500]
+                found.update(phone for (phone,) in self._conn.execute(
+                    "SELECT phone FROM campaign_recipients WHERE campaign_id = ? AND phone IN (%s)"
+                    % ",".join("?" * len(chunk)), [campaign_id] + chunk))
+            return found
+
+    def _record_recipient(self, campaign_id, phone, status):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO campaign_recipients (campaign_id, phone, status, updated_at) "
+                    "VALUES (?, ?, ?, ?)", (campaign_id, phone, status, now))
+                self._conn.execute(
+                    "UPDATE campaigns SET sent = sent + ?, failed = failed + ?, updated_at = ? WHERE campaign_id = ?",
+                    (int(status == "sent"), int(status == "failed"), now, campaign_id))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _checkpoint(self, campaign_id, next_row, scanned, matched, status):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE campaigns SET next_row = ?, scanned = scanned + ?, matched = matched + ?, "
+                "status = ?, updated_at = ? WHERE campaign_id = ?",
+                (next_row, scanned, matched, status, time.time(), campaign_id),
+            )
@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogCache:
+    """Кэш каталога товаров в памяти процесса с TTL и фоновым обновлением.
+
+    Пока данные свежие, get() отдает их без обращения к Google Sheets.
+    Когда TTL истек, get() сразу возвращает устаревшую копию и запускает
+    обновление в фоновом потоке (stale-while-revalidate). Синхронная
+    загрузка происходит только при самом первом обращении. name — что
+    кэшируется (для логов и статистики); по умолчанию каталог.
+    """
+
+    def __init__(self, loader, ttl=300, retry_delay=30, name="catalog"):
+        self.loader = loader
+        self.name = name
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self._value = None
+        self._loaded_at = 0.0
+        self._next_attempt = 0.0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def get(self):
+        """Возвращает каталог; при первом обращении загружает его синхронно."""
+        with self._lock:
+            value = self._value
+            if value is not None:
+                self.hits += 1
+                now = time.monotonic()
+                stale = now - self._loaded_at >= self.ttl
+                if stale and not self._refreshing and now >= self._next_attempt:
+                    self._refreshing = True
+                    threading.Thread(target=self._background_refresh, daemon=True).start()
+                return value
+            self.misses += 1
+        return self._load()
+
+    def refresh(self, wait=True):
+        """Принудительно перечитывает каталог (сразу или в фоне)."""
+        if wait:
+            return self._load(force=True)
+        with self._lock:
+            if self._refreshing:
+                return None
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+        return None
+
+    def stats(self):
+        with self._lock:
+            age = time.monotonic() - self._loaded_at if self._value is not None else None
+            return {
+                "name": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "errors": self.errors,
+                "ttl": self.ttl,
+                "age_seconds": round(age, 1) if age is not None else None,
+                "refreshing": self._refreshing,
+            }
+
+    def _load(self, force=False):
+        # Один поток грузит данные, остальные ждут его результат,
+        # чтобы всплеск первых запросов не превратился в N чтений таблицы.
+        with self._load_lock:
+            if not force:
+                with self._lock:
+                    if self._value is not None:
+                        return self._value
+            try:
+                value = self.loader()
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                    self._next_attempt = time.monotonic() + self.retry_delay
+                raise
+            with self._lock:
+                self._value = value
+                self._loaded_at = time.monotonic()
+                self.refreshes += 1
+            return value
+
+    def _background_refresh(self):
+        try:
+            self._load(force=True)
+        except Exception as e:
+            logger.error(f"Не удалось обновить кэш {self.name}, используется устаревшая копия: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
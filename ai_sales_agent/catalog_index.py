@@ -0,0 +1,85 @@
+import math
+
+import pandas as pd
+
+
+STOCK_COLUMNS = [f'PP{i}' for i in range(1, 6)]
+
+
+def compute_total_stock(df):
+    """Векторно суммирует остатки по складам PP1-PP5.
+
+    Учитываются только целые неотрицательные числа; 'no', пустые ячейки
+    и прочий мусор считаются нулем.
+    """
+    total = pd.Series(0, index=df.index, dtype='int64')
+    for column in STOCK_COLUMNS:
+        if column not in df.columns:
+            continue
+        values = df[column].astype(str).str.strip()
+        counts = pd.to_numeric(values.where(values.str.fullmatch(r'\d+', na=False)), errors='coerce')
+        total += counts.fillna(0).astype('int64')
+    return total
+
+
+def numeric_price(df):
+    """Цена числом для сортировки; пустые и нечисловые цены — в конец (inf)."""
+    if 'price' not in df.columns:
+        return pd.Series(math.inf, index=df.index)
+    prices = df['price'].astype(str).str.replace(' ', '', regex=False).str.replace(',', '.', regex=False)
+    return pd.to_numeric(prices, errors='coerce').fillna(math.inf)
+
+
+class CatalogIndex:
+    """Индексы каталога, построенные один раз на каждую загрузку.
+
+    В df добавляется числовая колонка total_stock (см. compute_total_stock).
+
+    by_sku: SKU -> запись товара (первая строка с этим SKU).
+    by_category: категория -> товары в наличии, отсортированные по остатку
+    (больше — раньше) и цене (дешевле — раньше).
+    """
+
+    def __init__(self, df=None):
+        self.df = df if df is not None else pd.DataFrame()
+        self.by_sku = {}
+        self.by_category = {}
+        if self.df.empty or 'SKU' not in self.df.columns:
+            return
+
+        self.df = self.df.assign(total_stock=compute_total_stock(self.df))
+        for product in self.df.drop_duplicates('SKU').to_dict('records'):
+            self.by_sku[product['SKU']] = product
+
+        if 'category' not in self.df.columns:
+            return
+        category = self.df['category']
+        in_stock = self.df[(self.df['total_stock'] > 0) & category.notna() & (category.astype(str) != '')]
+        in_stock = (
+            in_stock.assign(_price=numeric_price(in_stock))
+            .sort_values(['total_stock', '_price'], ascending=[False, True], kind='stable')
+            .drop(columns='_price')
+        )
+        for product in in_stock.to_dict('records'):
+            self.by_category.setdefault(product['category'], []).append(product)
+
+    def __len__(self):
+        return len(self.by_sku)
+
+    def get_product(self, sku):
+        return self.by_sku.get(str(sku))
+
+    def products(self):
+        return list(self.by_sku.values())
+
+    def recommendations(self, category, exclude_sku=None, limit=3):
+        """Первые `limit` товаров категории в наличии, кроме exclude_sku."""
+        exclude_sku = str(exclude_sku) if exclude_sku is not None else None
+        result = []
+        for product in self.by_category.get(category, ()):
+            if product['SKU'] == exclude_sku:
+                continue
+            result.append(product)
+            if len(result) >= limit:
+                break
+        return result
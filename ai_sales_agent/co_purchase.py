@@ -0,0 +1,148 @@
+import threading
+import time
+
+
+class CoPurchaseRecommender:
+    """Рекомендации "с этим товаром покупают" по истории заказов.
+
+    Матрица совместных покупок товар x товар (scipy.sparse): в ячейке [a, b]
+    — сколько клиентов купили и a, и b. Для каждого SKU заранее считается
+    top_k товаров в наличии с наибольшим числом совместных покупок (не меньше
+    min_count), поэтому recommendations() — один поиск в словаре.
+
+    rebuild(pairs, products) строит матрицу по всей истории (пары (телефон,
+    SKU)); add_order() обновляет ее на месте и пересчитывает топ только
+    затронутых товаров; refresh_stock() пересчитывает топ после обновления
+    каталога. Повторная покупка того же товара клиентом ничего не меняет,
+    поэтому заказ, пришедший и в add_order(), и в историю для rebuild(),
+    не учитывается дважды.
+    """
+
+    def __init__(self, top_k=3, min_count=1):
+        self.top_k = top_k
+        self.min_count = min_count
+        self._lock = threading.Lock()
+        self._sku_index = {}
+        self._skus = []
+        self._baskets = {}
+        self._products = {}
+        self._counts = None
+        self._in_stock = None
+        self._top = {}
+        self.updates = 0
+        self.built_at = None
+        self.build_seconds = None
+
+    @property
+    def ready(self):
+        return self._counts is not None
+
+    def recommendations(self, sku, limit=3):
+        """Товары, которые чаще всего покупают вместе с sku (в наличии)."""
+        return self._top.get(str(sku), ())[:limit]
+
+    def rebuild(self, pairs, products):
+        """Строит матрицу по истории заказов; products — все товары каталога."""
+        import numpy as np
+        from scipy import sparse
+        started = time.perf_counter()
+        with self._lock:
+            for phone, sku in pairs:
+                self._add_to_basket(str(phone), str(sku))
+            rows, cols = [], []
+            for customer, items in enumerate(self._baskets.values()):
+                rows.extend([customer] * len(items))
+                cols.extend(items)
+            size = len(self._skus)
+            purchases = sparse.csr_matrix(
+                (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(self._baskets), size))
+            counts = (purchases.T @ purchases).tolil()
+            counts.setdiag(0)
+            self._counts = counts
+            self._set_products(products)
+            self._top = {self._skus[index]: top for index in range(size) if (top := self._rank(index))}
+            self.built_at = time.time()
+            self.build_seconds = round(time.perf_counter() - started, 3)
+
+    def refresh_stock(self, products):
+        """Пересчитывает топ по новым остаткам каталога."""
+        with self._lock:
+            self._set_products(products)
+            if self._counts is not None:
+                self._top = {self._skus[index]: top for index in range(len(self._skus)) if (top := self._rank(index))}
+
+    def add_order(self, phone, sku):
+        """Учитывает новый заказ: обновляет матрицу и топ затронутых товаров."""
+        if not phone or not sku:
+            return
+        with self._lock:
+            basket = self._baskets.get(str(phone), set())
+            index = self._sku_index.get(str(sku))
+            if index is not None and index in basket:
+                return
+            others = list(basket)
+            index = self._add_to_basket(str(phone), str(sku))
+            if self._counts is None:
+                return
+            size = len(self._skus)
+            if self._counts.shape[0] < size:
+                self._counts.resize((size, size))
+                self._set_stock_mask()
+            for other in others:
+                self._counts[index, other] += 1
+                self._counts[other, index] += 1
+            for affected in others + [index]:
+                self._set_top(affected)
+            self.updates += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ready": self._counts is not None,
+                "skus": len(self._skus),
+                "customers": len(self._baskets),
+                "pairs": self._counts.nnz // 2 if self._counts is not None else 0,
+                "skus_with_recommendations": len(self._top),
+                "updates": self.updates,
+                "built_at": self.built_at,
+                "build_seconds": self.build_seconds,
+            }
+
+    def _add_to_basket(self, phone, sku):
+        index = self._sku_index.get(sku)
+        if index is None:
+            index = self._sku_index[sku] = len(self._skus)
+            self._skus.append(sku)
+        self._baskets.setdefault(phone, set()).add(index)
+        return index
+
+    def _set_products(self, products):
+        in_stock = {}
+        for product in products:
+            if (product.get('total_stock') or 0) > 0:
+                in_stock.setdefault(str(product.get('SKU')), product)
+        self._products = in_stock
+        self._set_stock_mask()
+
+    def _set_stock_mask(self):
+        import numpy as np
+        self._in_stock = np.array([sku in self._products for sku in self._skus], dtype=bool)
+
+    def _set_top(self, index):
+        top = self._rank(index)
+        if top:
+            self._top[self._skus[index]] = top
+        else:
+            self._top.pop(self._skus[index], None)
+
+    def _rank(self, index):
+        """top_k товаров в наличии по числу совместных покупок; при равенстве — кто раньше встретился."""
+        import numpy as np
+        cols = np.asarray(self._counts.rows[index], dtype=np.int64)
+        if not cols.size:
+            return []
+        counts = np.asarray(self._counts.data[index])
+        keep = self._in_stock[cols] & (counts >= self.min_count)
+        cols, counts = cols[keep], counts[keep]
+        order = np.lexsort((cols, -counts))[:self.top_k]
+        return [self._products[self._skus[col]] for col in cols[order]]
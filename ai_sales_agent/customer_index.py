@@ -0,0 +1,66 @@
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+_RANGE_START_ROW = re.compile(r"![A-Z]+(\d+)")
+
+
+class CustomerRowIndex:
+    """Локальный индекс телефон -> номер строки листа customers.
+
+    Колонка A читается целиком только при прогреве и при восстановлении
+    (rebuild), дальше поиск клиента — обращение к словарю. Новые строки
+    добавляются в индекс по ответу append_rows.
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._rows = None
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+
+    def rebuild(self):
+        """Перечитывает колонку A и строит индекс заново."""
+        rows = {}
+        for row_index, value in enumerate(self.worksheet.col_values(1), start=1):
+            rows.setdefault(str(value), row_index)
+        with self._lock:
+            self._rows = rows
+            self.rebuilds += 1
+        logger.info(f"Индекс клиентов построен: {len(rows)} строк")
+        return rows
+
+    def invalidate(self):
+        with self._lock:
+            self._rows = None
+
+    def get(self, phone):
+        """Номер строки клиента или None, если клиента нет в листе."""
+        with self._lock:
+            rows = self._rows
+        if rows is None:
+            rows = self.rebuild()
+        return rows.get(str(phone))
+
+    def add(self, phone, row_index):
+        with self._lock:
+            if self._rows is not None:
+                self._rows.setdefault(str(phone), row_index)
+
+    def record_append(self, phones, response):
+        """Запоминает строки, добавленные через append_rows, по диапазону из ответа API."""
+        updated_range = ((response or {}).get("updates") or {}).get("updatedRange", "")
+        match = _RANGE_START_ROW.search(updated_range)
+        if not match:
+            # Без номера строки индексу верить нельзя — перестроим при следующем обращении
+            self.invalidate()
+            return
+        first_row = int(match.group(1))
+        for offset, phone in enumerate(phones):
+            self.add(phone, first_row + offset)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows) if self._rows is not None else 0
@@ -0,0 +1,324 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+from customer_index import CustomerRowIndex
+
+logger = logging.getLogger(__name__)
+
+ORDER_COLUMNS = ["phone", "order_id", "sku", "product_name", "recorded_at", "data"]
+
+
+def open_orders_worksheet(spreadsheet, title="orders"):
+    """Лист истории заказов; создается с заголовком, если его еще нет."""
+    import gspread
+    try:
+        return spreadsheet.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(title, rows=1000, cols=len(ORDER_COLUMNS))
+        worksheet.append_row(ORDER_COLUMNS)
+        logger.info(f"Создан лист '{title}' для истории заказов")
+        return worksheet
+
+
+def order_row(phone, order, recorded_at):
+    return [
+        phone,
+        str(order.get("id") or order.get("order_id") or ""),
+        str(order.get("sku") or ""),
+        str(order.get("product_name") or ""),
+        recorded_at,
+        json.dumps(order, ensure_ascii=False),
+    ]
+
+
+def read_orders_by_phone(worksheet, max_rows=None):
+    """Лист orders одним чтением: {телефон: [заказы в порядке записи]}.
+
+    max_rows ограничивает чтение последними строками листа — в памяти
+    держится только недавняя история, а не весь лист.
+    """
+    range_name = "A2:F"
+    if max_rows:
+        last_row = len(worksheet.col_values(1))
+        if last_row < 2:
+            return {}
+        range_name = f"A{max(2, last_row - max_rows + 1)}:F{last_row}"
+    history = {}
+    for row in worksheet.get(range_name):
+        phone = str(row[0]).strip() if row else ''
+        if not phone:
+            continue
+        try:
+            order = json.loads(row[5]) if len(row) > 5 and row[5] else None
+        except json.JSONDecodeError:
+            order = None
+        if not isinstance(order, dict):
+            order = dict(zip(("id", "sku", "product_name"), row[1:4]))
+        history.setdefault(phone, []).append(order)
+    return history
+
+
+class CustomerWriteBuffer:
+    """Отложенная (write-behind) запись изменений в лист customers.
+
+    update() только складывает изменение в буфер и сразу возвращает
+    управление. Изменения одного клиента склеиваются по телефону: имя и этап
+    берутся из последнего события, новые заказы дописываются в историю.
+    Буфер сбрасывается фоновым потоком раз в flush_interval секунд или сразу,
+    как только в нем накопилось max_batch клиентов, а также при завершении
+    процесса. Строки клиентов ищутся по локальному CustomerRowIndex; один
+    сброс — это одно batch_get (сверка телефонов и старая история заказов),
+    один batch_update и один append_rows. Если задан span(name) — контекстный
+    менеджер замера, каждый сброс выполняется внутри span("sheets_customers").
+
+    С orders_worksheet история заказов только дописывается строками в
+    отдельный лист (один append_rows на сброс), а колонка D листа customers
+    больше не перечитывается и не перезаписывается. Без него — прежний режим
+    с JSON-историей в колонке D.
+
+    Неудачный сброс возвращается в буфер и повторяется с растущей паузой (до
+    max_backoff секунд). Клиент, которого не удалось записать max_attempts
+    раз подряд, и самые старые изменения сверх max_pending клиентов
+    отбрасываются с записью в лог — во время сбоя Sheets буфер не растет
+    без ограничений.
+    """
+
+    def __init__(self, worksheet, max_batch=50, flush_interval=2.0, span=None, orders_worksheet=None,
+                 max_attempts=5, max_pending=10000, max_backoff=60.0):
+        self.worksheet = worksheet
+        self.orders_worksheet = orders_worksheet
+        self.row_index = CustomerRowIndex(worksheet)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self._span = span or (lambda name: nullcontext())
+        self._pending = {}
+        self._attempts = {}
+        self._failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.flushes = 0
+        self.rows_written = 0
+        self.orders_appended = 0
+        self.errors = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def update(self, phone, name, stage, order_info=None):
+        """Ставит изменение клиента в очередь на запись."""
+        change = {"name": name, "stage": stage, "orders": [order_info] if order_info else []}
+        with self._lock:
+            self._merge(str(phone), change)
+            self._trim()
+            depth = len(self._pending)
+        if depth >= self.max_batch:
+            self._wakeup.set()
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_batch": self.max_batch,
+            "flush_interval": self.flush_interval,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "orders_appended": self.orders_appended,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "indexed_customers": len(self.row_index),
+            "index_rebuilds": self.row_index.rebuilds,
+        }
+
+    def flush(self):
+        """Записывает все накопленные изменения в таблицу."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            written = len(batch)
+            try:
+                with self._span("sheets_customers"):
+                    self.write_batch(batch)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка при пакетной записи клиентов ({len(batch)} шт.), повтор позже: {e}")
+                self._requeue(batch)
+                return 0
+            with self._lock:
+                for phone in batch:
+                    self._attempts.pop(phone, None)
+                self._failures = 0
+                self._retry_at = 0.0
+            self.flushes += 1
+            self.rows_written += written
+            return written
+
+    def _requeue(self, batch):
+        """Возвращает неудачный пакет в буфер, отбрасывая клиентов, исчерпавших попытки."""
+        with self._lock:
+            dropped = []
+            for phone in list(batch):
+                self._attempts[phone] = self._attempts.get(phone, 0) + 1
+                if self._attempts[phone] >= self.max_attempts:
+                    dropped.append(phone)
+                    del batch[phone]
+                    del self._attempts[phone]
+            newer, self._pending = self._pending, batch
+            for phone, change in newer.items():
+                self._merge(phone, change)
+            self._trim()
+            self._failures += 1
+            self._retry_at = time.monotonic() + min(self.flush_interval * 2 ** self._failures, self.max_backoff)
+            self.dropped += len(dropped)
+        if dropped:
+            logger.error(f"Изменения клиентов отброшены после {self.max_attempts} неудачных попыток записи: "
+                         f"{', '.join(dropped[:20])}{' ...' if len(dropped) > 20 else ''}")
+
+    def _trim(self):
+        """Держит в буфере не больше max_pending клиентов: самые старые изменения отбрасываются."""
+        overflow = len(self._pending) - self.max_pending
+        if overflow <= 0:
+            return
+        dropped = list(self._pending)[:overflow]
+        for phone in dropped:
+            del self._pending[phone]
+            self._attempts.pop(phone, None)
+        self.dropped += overflow
+        logger.error(f"Буфер записи клиентов переполнен ({self.max_pending}), отброшено изменений: {overflow}")
+
+    def close(self):
+        """Останавливает фоновый поток и сбрасывает остаток буфера."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def _merge(self, phone, change):
+        current = self._pending.get(phone)
+        if current is None:
+            self._pending[phone] = change
+            return
+        current["name"] = change["name"]
+        current["stage"] = change["stage"]
+        current["orders"].extend(change["orders"])
+
+    def _run(self):
+        try:
+            self.row_index.rebuild()
+        except Exception as e:
+            logger.error(f"Не удалось прогреть индекс клиентов: {e}")
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._closed:
+                break
+            # После неудачного сброса ждем паузу, даже если буфер уже заполнен
+            if time.monotonic() < self._retry_at:
+                continue
+            self.flush()
+
+    def _read_rows(self, phones):
+        """Находит строки клиентов и читает их текущие значения одним batch_get.
+
+        Для сверки телефонов хватает колонки A; A:D читается только ради
+        JSON-истории в режиме без листа orders.
+        """
+        rows = {}
+        for phone in phones:
+            row_index = self.row_index.get(phone)
+            if row_index:
+                rows[phone] = row_index
+        if not rows:
+            return rows, {}
+        last_column = "A" if self.orders_worksheet else "D"
+        ranges = [f"A{row_index}:{last_column}{row_index}" for row_index in rows.values()]
+        values = {}
+        for phone, value_range in zip(rows, self.worksheet.batch_get(ranges)):
+            values[phone] = list(value_range[0]) if value_range and value_range[0] else []
+        return rows, values
+
+    def write_batch(self, batch):
+        """Синхронно записывает пакет {phone: change} в лист.
+
+        Уже записанные клиенты удаляются из batch, а у уже дописанных в лист
+        orders заказов очищается список orders, поэтому при ошибке в batch
+        остается только то, что нужно отправить повторно.
+        """
+        if self.orders_worksheet:
+            self._append_orders(batch)
+        rows, values = self._read_rows(list(batch))
+        if any(str(values[phone][0] if values[phone] else '') != phone for phone in rows):
+            # Строки в листе сдвинули вручную — индекс устарел, перестраиваем и сверяем заново
+            logger.warning("Индекс клиентов не совпадает с листом customers, перестраиваем")
+            self.row_index.rebuild()
+            rows, values = self._read_rows(list(batch))
+            rows = {phone: row_index for phone, row_index in rows.items()
+                    if values[phone] and str(values[phone][0]) == phone}
+
+        histories = {}
+        for phone, row_values in values.items():
+            old_history_str = (row_values[3] if len(row_values) > 3 else '') or '[]'
+            try:
+                histories[phone] = json.loads(old_history_str)
+            except json.JSONDecodeError:
+                histories[phone] = []
+
+        updates, new_rows = [], []
+        for phone, change in batch.items():
+            if phone in rows:
+                row_index = rows[phone]
+                if change["orders"]:
+                    history = histories.get(phone, []) + change["orders"]
+                    updates.append({
+                        "range": f"B{row_index}:D{row_index}",
+                        "values": [[change["name"], change["stage"], json.dumps(history, ensure_ascii=False)]],
+                    })
+                else:
+                    updates.append({
+                        "range": f"B{row_index}:C{row_index}",
+                        "values": [[change["name"], change["stage"]]],
+                    })
+            else:
+                history = '' if self.orders_worksheet else json.dumps(change["orders"], ensure_ascii=False)
+                new_rows.append([phone, change["name"], change["stage"], history])
+
+        if updates:
+            self.worksheet.batch_update(updates)
+            # Уже записанные клиенты не должны повторно попасть в буфер при ошибке append_rows
+            for phone in rows:
+                batch.pop(phone, None)
+        if new_rows:
+            response = self.worksheet.append_rows(new_rows)
+            self.row_index.record_append([row[0] for row in new_rows], response)
+        logger.info(f"Клиенты записаны пакетом: обновлено {len(updates)}, добавлено {len(new_rows)}")
+
+    def _append_orders(self, batch):
+        """Дописывает новые заказы пакета в лист orders одним append_rows."""
+        recorded_at = datetime.now().isoformat(timespec="seconds")
+        rows = [order_row(phone, order, recorded_at)
+                for phone, change in batch.items() for order in change["orders"]]
+        if not rows:
+            return
+        self.orders_worksheet.append_rows(rows)
+        self.orders_appended += len(rows)
+        # Заказы записаны: при повторе пакета из-за ошибки ниже они не должны задублироваться
+        for change in batch.values():
+            change["orders"] = []
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_events (
+    key TEXT PRIMARY KEY,
+    result TEXT,
+    status_code INTEGER,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_events_expiry ON processed_events (expires_at);
+"""
+
+PROCESSING = ({"status": "processing", "message": "Событие уже обрабатывается"}, 202)
+
+_HASH_KEY = re.compile(r"(?:[^:]+:)?hash:[0-9a-f]{64}")
+
+
+def event_key(event):
+    """Ключ идемпотентности: event_id отправителя или хэш (этап, телефон, заказ).
+
+    События разных продавцов (tenant_id) не пересекаются.
+    """
+    if event.get("tenant_id"):
+        return f"{event['tenant_id']}:{event_key(dict(event, tenant_id=None))}"
+    if event.get("event_id"):
+        return f"id:{event['event_id']}"
+    order = event.get("order") or {}
+    parts = [
+        str(event.get("waha_stage_id", "")),
+        str((event.get("customer") or {}).get("phone", "")),
+        str(order.get("id") or order.get("order_id") or order.get("sku") or ""),
+    ]
+    return "hash:" + hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class DedupStore:
+    """Ограниченное TTL-LRU хранилище обработанных событий.
+
+    claim(key) атомарно отмечает событие как принятое; для повтора
+    возвращается сохраненный результат первого вызова (или PROCESSING, пока
+    первый еще выполняется). Если задан db_path, готовые результаты
+    дублируются в SQLite и переживают перезапуск процесса.
+
+    Ключи без event_id (хэш этапа, телефона и заказа) хранятся hash_ttl
+    секунд — столько, сколько отправитель повторяет запрос: иначе настоящая
+    повторная покупка того же SKU в течение ttl считалась бы дублем.
+    """
+
+    def __init__(self, max_size=10000, ttl=86400, db_path=None, hash_ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hash_ttl = hash_ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        self.duplicates = 0
+        self.accepted = 0
+
+    def claim(self, key):
+        """Возвращает None для нового события или (тело, код) сохраненного результата."""
+        now = time.time()
+        with self._lock:
+            item = self._get(key, now)
+            if item is not None:
+                self.duplicates += 1
+                return item[0] if item[0] is not None else PROCESSING
+            self._put(key, None, now + self._ttl(key))
+            self.accepted += 1
+            return None
+
+    def complete(self, key, result):
+        """Сохраняет результат (тело, код) обработки события."""
+        with self._lock:
+            self._put(key, result, time.time() + self._ttl(key))
+
+    def release(self, key):
+        """Забывает событие, чтобы повтор отправителя обработался заново (после ошибки)."""
+        with self._lock:
+            self._items.pop(key, None)
+            if self._conn:
+                self._conn.execute("DELETE FROM processed_events WHERE key = ?", (key,))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hash_ttl": self.hash_ttl,
+                "accepted": self.accepted,
+                "duplicates": self.duplicates,
+                "persistent": self._conn is not None,
+            }
+
+    def _get(self, key, now):
+        item = self._items.get(key)
+        if item is None and self._conn:
+            row = self._conn.execute(
+                "SELECT result, status_code, expires_at FROM processed_events WHERE key = ?", (key,)).fetchone()
+            if row:
+                item = ((json.loads(row[0]), row[1]), row[2])
+                self._remember(key, item)
+        if item is None:
+            return None
+        if item[1] <= now:
+            self._items.pop(key, None)
+            return None
+        self._items.move_to_end(key)
+        return item
+
+    def _ttl(self, key):
+        return min(self.hash_ttl, self.ttl) if _HASH_KEY.fullmatch(key) else self.ttl
+
+    def _remember(self, key, item):
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def _put(self, key, result, expires_at):
+        self._remember(key, (result, expires_at))
+        # В SQLite попадают только готовые результаты: отметка "в обработке"
+        # от упавшего процесса не должна блокировать повтор после рестарта
+        if self._conn and result is not None:
+            body, status_code = result
+            self._conn.execute(
+                "INSERT OR REPLACE INTO processed_events (key, result, status_code, expires_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(body, ensure_ascii=False), status_code, expires_at),
+            )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._conn.execute("DELETE FROM processed_events WHERE expires_at <= ?", (time.time(),))
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Очередь событий заполнена, новое событие не принято."""
+
+
+class EventQueue:
+    """Ограниченная очередь событий и пул воркеров для асинхронного режима.
+
+    submit() кладет событие в очередь и сразу возвращает его id; воркеры
+    вызывают processor(event), который возвращает (тело ответа, HTTP-код).
+    Статусы последних max_results событий доступны через status().
+
+    У каждого воркера своя очередь (шард) на max_queue / workers событий.
+    События с одинаковым shard_key(event) (например, телефон клиента) всегда
+    попадают в один шард и обрабатываются строго по очереди, события разных
+    клиентов — параллельно. События без ключа уходят в наименее загруженный шард.
+    """
+
+    def __init__(self, processor, workers=4, max_queue=1000, max_results=10000, shard_key=None):
+        self.processor = processor
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_results = max_results
+        self.shard_key = shard_key
+        shard_size = max(1, -(-max_queue // workers))
+        self._shards = [queue.Queue(maxsize=shard_size) for _ in range(workers)]
+        self._shard_processed = [0] * workers
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._threads = [
+            threading.Thread(target=self._worker, args=(i,), name=f"event-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def shard_for(self, event):
+        """Номер шарда события: стабильный хэш ключа или наименее загруженный шард."""
+        key = self.shard_key(event) if self.shard_key else None
+        if key is None:
+            return min(range(self.workers), key=lambda i: self._shards[i].qsize())
+        return zlib.crc32(str(key).encode("utf-8")) % self.workers
+
+    def submit(self, event, event_id=None):
+        """Ставит событие в очередь; при переполнении бросает QueueFull."""
+        event_id = str(event_id) if event_id else uuid.uuid4().hex
+        record = {"event_id": event_id, "status": "queued", "submitted_at": time.time()}
+        with self._lock:
+            self._remember(event_id, record)
+        shard = self.shard_for(event)
+        try:
+            self._shards[shard].put_nowait((event_id, event))
+        except queue.Full:
+            with self._lock:
+                self._results.pop(event_id, None)
+                self.rejected += 1
+            raise QueueFull(f"Очередь событий заполнена (шард {shard}, {self._shards[shard].maxsize})")
+        return event_id
+
+    def status(self, event_id):
+        with self._lock:
+            record = self._results.get(event_id)
+            return dict(record) if record else None
+
+    def join(self):
+        """Ждет, пока все принятые события будут обработаны."""
+        for shard in self._shards:
+            shard.join()
+
+    def queue_depth(self):
+        return sum(shard.qsize() for shard in self._shards)
+
+    def shard_depths(self):
+        return [shard.qsize() for shard in self._shards]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "max_queue": self.max_queue,
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "shards": [
+                    {"shard": i, "queue_depth": shard.qsize(), "max_queue": shard.maxsize,
+                     "processed": self._shard_processed[i]}
+                    for i, shard in enumerate(self._shards)
+                ],
+            }
+
+    def _remember(self, event_id, record):
+        self._results[event_id] = record
+        self._results.move_to_end(event_id)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    def _update(self, event_id, **fields):
+        with self._lock:
+            record = self._results.get(event_id)
+            if record is not None:
+                record.update(fields)
+
+    def _worker(self, shard):
+        events = self._shards[shard]
+        while True:
+            event_id, event = events.get()
+            self._update(event_id, status="processing", started_at=time.time())
+            try:
+                body, status_code = self.processor(event)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке события {event_id}: {e}")
+                with self._lock:
+                    self.failed += 1
+                self._update(event_id, status="error", error=str(e), finished_at=time.time())
+            else:
+                with self._lock:
+                    self.processed += 1
+                self._update(event_id, status="done", result=body, http_status=status_code,
+                             finished_at=time.time())
+            finally:
+                with self._lock:
+                    self._shard_processed[shard] += 1
+                events.task_done()
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_knowledge_base(raw):
+    """Приводит оба формата базы знаний к виду {"scenarios": ..., "rules": ...}.
+
+    Поддерживаются сценарии верхнего уровня ("scenarios": id -> script) и
+    этапы воронки ("knowledge_base.stages" или "stages": id -> actions).
+    Если есть оба, сценарии имеют приоритет при совпадении id.
+    """
+    scenarios = {stage_id: dict(scenario) for stage_id, scenario in raw.get("scenarios", {}).items()}
+    nested = raw.get("knowledge_base") or {}
+    stages = raw.get("stages") or nested.get("stages") or {}
+    for stage_id, stage in stages.items():
+        scenarios.setdefault(stage_id, {
+            "description": stage.get("description", ""),
+            "script": stage.get("script") or stage.get("actions", []),
+        })
+
+    rules = dict(raw.get("rules") or {})
+    if not rules.get("general"):
+        principles = (nested.get("communication_rules") or {}).get("principles")
+        if principles:
+            rules["general"] = principles
+
+    normalized = dict(raw)
+    normalized["scenarios"] = scenarios
+    normalized["rules"] = rules
+    return normalized
+
+
+class KnowledgeSnapshot:
+    """Неизменяемая версия базы знаний с готовыми индексами и промптами."""
+
+    def __init__(self, data, prompts, mtime):
+        self.data = data
+        self.scenarios = data["scenarios"]
+        self.rules = data["rules"]
+        self.prompts = prompts
+        self.mtime = mtime
+        self.loaded_at = time.time()
+
+
+class KnowledgeBase:
+    """База знаний с ленивой загрузкой и горячей перезагрузкой по mtime файла.
+
+    Файл читается при первом обращении. Дальше не чаще раза в check_interval
+    секунд сверяется mtime; при изменении новая версия разбирается и
+    компилируется в фоновом потоке, а затем подменяется одной операцией
+    присваивания. Запросы, уже взявшие snapshot(), дорабатывают со старой
+    версией. Если новая версия не разбирается, остается прежняя, а файл с
+    тем же mtime повторно не перечитывается — до следующего изменения.
+    """
+
+    def __init__(self, path, compiler, required_scenarios=(), check_interval=2.0):
+        self.path = path
+        self.compiler = compiler
+        self.required_scenarios = list(required_scenarios)
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._load_lock = threading.Lock()
+        self._reloading = False
+        self._last_check = 0.0
+        self._failed_mtime = None
+        self.reloads = 0
+        self.errors = 0
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self._load_initial()
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            self._check_for_changes(snapshot)
+        return snapshot
+
+    def render(self, stage_id, context):
+        return self.snapshot().prompts.render(stage_id, context)
+
+    def scenario(self, stage_id):
+        return self.snapshot().scenarios.get(stage_id)
+
+    def reload(self):
+        """Перечитывает файл сразу; при ошибке оставляет текущую версию и бросает исключение."""
+        with self._load_lock:
+            self._snapshot = self._build()
+            self._last_check = time.monotonic()
+            return self._snapshot
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "loaded": snapshot is not None,
+            "scenarios": len(snapshot.scenarios) if snapshot else 0,
+            "reloads": self.reloads,
+            "errors": self.errors,
+            "loaded_at": snapshot.loaded_at if snapshot else None,
+        }
+
+    def _load_initial(self):
+        with self._load_lock:
+            if self._snapshot is None:
+                try:
+                    self._snapshot = self._build()
+                except Exception as e:
+                    logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось загрузить {self.path}: {e}")
+                    try:
+                        self._failed_mtime = os.stat(self.path).st_mtime
+                    except OSError:
+                        pass
+                    self._snapshot = KnowledgeSnapshot(
+                        normalize_knowledge_base({}), self.compiler({}), None)
+                self._last_check = time.monotonic()
+            return self._snapshot
+
+    def _check_for_changes(self, snapshot):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime in (snapshot.mtime, self._failed_mtime) or self._reloading:
+            return
+        self._reloading = True
+        threading.Thread(target=self._background_reload, args=(mtime,), daemon=True).start()
+
+    def _background_reload(self, mtime):
+        try:
+            self.reload()
+            logger.info(f"База знаний '{self.path}' перезагружена")
+        except Exception as e:
+            # Сломанную версию не перечитываем, пока файл снова не изменится
+            self._failed_mtime = mtime
+            logger.error(f"Не удалось перезагрузить {self.path}, используется прежняя версия: {e}")
+        finally:
+            self._reloading = False
+
+    def _build(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = normalize_knowledge_base(json.load(f))
+            prompts = self.compiler(data)
+        except Exception:
+            self.errors += 1
+            raise
+        missing = prompts.missing(self.required_scenarios)
+        if missing:
+            logger.error(f"В базе знаний нет сценариев: {', '.join(missing)}")
+        self.reloads += 1
+        return KnowledgeSnapshot(data, prompts, mtime)
@@ -0,0 +1,81 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+NAME_TOKEN = "⟨CUSTOMER_NAME⟩"
+
+
+def anonymize(text, name):
+    """Заменяет имя клиента на метку; None, если имя нельзя надежно убрать.
+
+    Ответ модели может содержать имя в другом падеже ("Анна" -> "Анне"),
+    такой ответ нельзя отдавать другим клиентам, поэтому он не кэшируется.
+    """
+    if not name:
+        return text
+    name = str(name)
+    text = text.replace(name, NAME_TOKEN)
+    stem = name[:max(3, len(name) - 2)]
+    if stem in text:
+        return None
+    return text
+
+
+def personalize(text, name):
+    return text.replace(NAME_TOKEN, str(name or ""))
+
+
+class ResponseCache:
+    """LRU-кэш ответов LLM с TTL и ограничением размера."""
+
+    def __init__(self, max_size=1000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model, system_prompt, prompt):
+        digest = hashlib.sha256()
+        for part in (model, system_prompt, prompt):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,255 @@
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    phone TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    stage TEXT NOT NULL DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 1,
+    synced_version INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS customers_dirty ON customers (updated_at) WHERE version > synced_version;
+
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phone TEXT NOT NULL,
+    sku TEXT,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    synced INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS orders_by_customer ON orders (phone, id);
+CREATE INDEX IF NOT EXISTS orders_unsynced ON orders (phone) WHERE synced = 0;
+
+CREATE TABLE IF NOT EXISTS products (
+    sku TEXT PRIMARY KEY,
+    category TEXT,
+    price REAL,
+    total_stock INTEGER NOT NULL DEFAULT 0,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_in_stock_by_category
+    ON products (category, total_stock DESC, price, position) WHERE total_stock > 0;
+"""
+
+
+class LocalStore:
+    """Локальная SQLite-база клиентов, заказов и каталога для горячего пути.
+
+    Изменения клиентов пишутся сюда одной транзакцией и помечаются как
+    несинхронизированные (version > synced_version, orders.synced = 0);
+    отправкой в Google Таблицу занимается SheetSync. Каталог наоборот
+    подтягивается из таблицы и целиком заменяется в replace_products().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    # --- Клиенты и заказы ---
+
+    def record_customers(self, changes):
+        """Обновляет имя и этап клиентов и дописывает их заказы.
+
+        changes — список (phone, name, stage, order_info или None); все
+        изменения пишутся одной транзакцией, по порядку.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for phone, name, stage, order_info in changes:
+                    phone = str(phone)
+                    self._conn.execute(
+                        "INSERT INTO customers (phone, name, stage, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (phone) DO UPDATE SET name = excluded.name, stage = excluded.stage, "
+                        "version = version + 1, updated_at = excluded.updated_at",
+                        (phone, name or '', stage or '', now))
+                    if order_info:
+                        self._conn.execute(
+                            "INSERT INTO orders (phone, sku, data, created_at) VALUES (?, ?, ?, ?)",
+                            (phone, str(order_info.get('sku') or '') or None,
+                             json.dumps(order_info, ensure_ascii=False), now))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def import_customers(self, customers):
+        """Переносит клиентов из таблицы: customers — список (phone, name, stage, orders).
+
+        Записи сразу считаются синхронизированными — в таблице они уже есть.
+        Клиенты, которые уже есть в базе, пропускаются.
+        """
+        now = time.time()
+        imported = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for phone, name, stage, orders in customers:
+                    phone = str(phone)
+                    cursor = self._conn.execute(
+                        "INSERT OR IGNORE INTO customers (phone, name, stage, synced_version, updated_at) "
+                        "VALUES (?, ?, ?, 1, ?)", (phone, name or '', stage or '', now))
+                    if not cursor.rowcount:
+                        continue
+                    imported += 1
+                    self._conn.executemany(
+                        "INSERT INTO orders (phone, sku, data, created_at, synced) VALUES (?, ?, ?, ?, 1)",
+                        [(phone, str(order.get('sku') or '') or None, json.dumps(order, ensure_ascii=False), now)
+                         for order in orders])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return imported
+
+    def customer_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM customers").fetchone()[0]
+
+    def recent_orders(self, phone, limit=10):
+        """Последние limit заказов клиента (старые — раньше); читается только это окно.
+
+        limit=None — вся история клиента.
+        """
+        with self._lock:
+            return self._recent_orders(str(phone), limit)
+
+    def _recent_orders(self, phone, limit):
+        rows = self._conn.execute(
+            "SELECT data FROM orders WHERE phone = ? ORDER BY id DESC LIMIT ?",
+            (phone, -1 if limit is None else limit)).fetchall()
+        return [json.loads(data) for (data,) in reversed(rows)]
+
+    def order_skus(self):
+        """Все заказы с SKU парами (телефон, SKU) в порядке записи."""
+        with self._lock:
+            return self._conn.execute("SELECT phone, sku FROM orders WHERE sku IS NOT NULL ORDER BY id").fetchall()
+
+    def pending_changes(self, limit=200):
+        """Клиенты с несинхронизированными изменениями: {phone: change}.
+
+        change — {"name", "stage", "orders", "version", "order_ids"}; orders —
+        только еще не отправленные в таблицу заказы.
+        """
+        with self._lock:
+            customers = self._conn.execute(
+                "SELECT phone, name, stage, version FROM customers WHERE version > synced_version "
+                "ORDER BY updated_at LIMIT ?", (limit,)).fetchall()
+            changes = {}
+            for phone, name, stage, version in customers:
+                orders = self._conn.execute(
+                    "SELECT id, data FROM orders WHERE phone = ? AND synced = 0 ORDER BY id", (phone,)).fetchall()
+                changes[phone] = {
+                    "name": name, "stage": stage, "version": version,
+                    "orders": [json.loads(data) for _, data in orders],
+                    "order_ids": [order_id for order_id, _ in orders],
+                }
+        return changes
+
+    def mark_synced(self, changes):
+        """Отмечает отправленными версии клиентов и заказы из pending_changes()."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for phone, change in changes.items():
+                    self._conn.execute(
+                        "UPDATE customers SET synced_version = MAX(synced_version, ?) WHERE phone = ?",
+                        (change["version"], phone))
+                    self._conn.executemany(
+                        "UPDATE orders SET synced = 1 WHERE id = ?", [(order_id,) for order_id in change["order_ids"]])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM customers WHERE version > synced_version").fetchone()[0]
+
+    # --- Каталог ---
+
+    def replace_products(self, records, total_stock, prices):
+        """Заменяет каталог целиком: records — строки листа products в исходном порядке."""
+        rows, seen = [], set()
+        for position, (record, stock, price) in enumerate(zip(records, total_stock, prices)):
+            sku = str(record.get('SKU', ''))
+            if not sku or sku in seen:
+                continue
+            seen.add(sku)
+            category = record.get('category')
+            rows.append((sku, str(category) if category not in (None, '') else None,
+                         price, int(stock), position, json.dumps(record, ensure_ascii=False, default=str)))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM products")
+                self._conn.executemany(
+                    "INSERT INTO products (sku, category, price, total_stock, position, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def all_products(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT data, total_stock FROM products ORDER BY position").fetchall()
+        return [self._product(row) for row in rows]
+
+    def product_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def get_product(self, sku):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, total_stock FROM products WHERE sku = ?", (str(sku),)).fetchone()
+        return self._product(row) if row else None
+
+    def products_in_category(self, category, exclude_sku=None, limit=3):
+        """Товары категории в наличии: больше остаток — раньше, при равенстве дешевле — раньше."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data, total_stock FROM products "
+                "WHERE category = ? AND total_stock > 0 AND sku IS NOT ? "
+                "ORDER BY total_stock DESC, price, position LIMIT ?",
+                (str(category), str(exclude_sku) if exclude_sku is not None else None, limit)).fetchall()
+        return [self._product(row) for row in rows]
+
+    @staticmethod
+    def _product(row):
+        product = json.loads(row[0])
+        product['total_stock'] = row[1]
+        return product
+
+
+class StoreCatalog:
+    """Каталог поверх LocalStore с тем же интерфейсом, что и CatalogIndex."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.product_count()
+
+    def get_product(self, sku):
+        return self.store.get_product(sku)
+
+    def products(self):
+        return self.store.all_products()
+
+    def recommendations(self, category, exclude_sku=None, limit=3):
+        return self.store.products_in_category(category, exclude_sku=exclude_sku, limit=limit)
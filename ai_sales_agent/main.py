@@ -1,216 +1,1135 @@
-import os
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import contextvars
 import json
-import pandas
-import playwright
-from datetime import datetime, timedelta
-
-from flask import Flask, request, jsonify
-import openai
-import requests
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import pandas as pd
-from apscheduler.schedulers.background import BackgroundScheduler
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+
+from flask import Flask, Response, request, jsonify
+
+import metrics
+
+from campaigns import CampaignRunner, parse_orders
+from catalog_cache import CatalogCache
+from co_purchase import CoPurchaseRecommender
+from customer_writer import CustomerWriteBuffer, open_orders_worksheet, read_orders_by_phone
+from dedup import DedupStore, event_key
+from event_queue import EventQueue, QueueFull
+from knowledge import KnowledgeBase
+from llm_cache import ResponseCache, anonymize, personalize
+from local_store import LocalStore, StoreCatalog
+from prompt_templates import UnknownStageError, compile_script_templates
+from rate_limit import AdaptiveRateLimiter, RateLimited, RateLimitedWorksheet
+from sheet_sync import SheetSync
+from stage_router import StageRouter
+from task_store import DelayedTaskStore
+import tenants
+from tenants import DEFAULT_TENANT_ID, Tenant, TenantRegistry, UnknownTenant, load_tenant_settings, tenant_scope
+from waha_client import WahaClient, make_session
 
 # --- 1. ИНИЦИАЛИЗАЦИЯ И НАСТРОЙКА ---
 
 app = Flask(__name__)
 
-# Загрузка базы знаний со сценариями
-try:
-    with open('knowledge_base.json', 'r', encoding='utf-8') as f:
-        knowledge_base = json.load(f)
-    app.logger.info("База знаний 'knowledge_base.json' успешно загружена.")
-except Exception as e:
-    app.logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось загрузить knowledge_base.json: {e}")
-    knowledge_base = {}
+# Продавцы: JSON-файл с сессией WAHA, таблицей и базой знаний каждого; пусто — один продавец из окружения
+TENANTS_CONFIG = os.environ.get("TENANTS_CONFIG")
 
 # Обязательные переменные окружения
-REQUIRED_VARS = [
-    "OPENAI_API_KEY", "WAHA_API_ENDPOINT", "WAHA_SESSION_ID",
-    "FUNCTION_URL", "GOOGLE_SHEET_URL"
-]
+REQUIRED_VARS = ["OPENAI_API_KEY", "WAHA_API_ENDPOINT", "FUNCTION_URL"]
+if not TENANTS_CONFIG:
+    REQUIRED_VARS += ["WAHA_SESSION_ID", "GOOGLE_SHEET_URL"]
 missing_vars = [v for v in REQUIRED_VARS if not os.environ.get(v)]
 if missing_vars:
     raise RuntimeError(f"Отсутствуют обязательные переменные окружения: {', '.join(missing_vars)}")
 
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 WAHA_API_ENDPOINT = os.environ["WAHA_API_ENDPOINT"]
-WAHA_SESSION_ID = os.environ["WAHA_SESSION_ID"]
+WAHA_SESSION_ID = os.environ.get("WAHA_SESSION_ID")
 FUNCTION_URL = os.environ["FUNCTION_URL"]
-GOOGLE_SHEET_URL = os.environ["GOOGLE_SHEET_URL"]
+GOOGLE_SHEET_URL = os.environ.get("GOOGLE_SHEET_URL")
+# База знаний со сценариями: загружается при первом обращении и перечитывается при изменении файла
+KNOWLEDGE_BASE_PATH = os.environ.get("KNOWLEDGE_BASE_PATH", "knowledge_base.json")
+# Каталог для SQLite-файлов продавцов из TENANTS_CONFIG
+TENANTS_DATA_DIR = os.environ.get("TENANTS_DATA_DIR", "tenants")
+CATALOG_CACHE_TTL = int(os.environ.get("CATALOG_CACHE_TTL", 300))
+CUSTOMER_WRITE_BATCH = int(os.environ.get("CUSTOMER_WRITE_BATCH", 50))
+CUSTOMER_WRITE_INTERVAL = float(os.environ.get("CUSTOMER_WRITE_INTERVAL", 2.0))
+CUSTOMER_WRITE_MAX_ATTEMPTS = int(os.environ.get("CUSTOMER_WRITE_MAX_ATTEMPTS", 5))
+CUSTOMER_WRITE_MAX_PENDING = int(os.environ.get("CUSTOMER_WRITE_MAX_PENDING", 10000))
+EVENT_ASYNC_MODE = os.environ.get("EVENT_ASYNC_MODE", "0").lower() in ("1", "true", "yes")
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", 4))
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", 1000))
+# Без очереди весь пакет обрабатывается внутри одного HTTP-запроса — пакет должен успеть до таймаута отправителя
+EVENT_BATCH_MAX_SIZE = int(os.environ.get("EVENT_BATCH_MAX_SIZE", 1000 if EVENT_ASYNC_MODE else 20))
+EVENT_BATCH_WORKERS = int(os.environ.get("EVENT_BATCH_WORKERS", 8))
+WAHA_POOL_SIZE = int(os.environ.get("WAHA_POOL_SIZE", 10))
+WAHA_MAX_RETRIES = int(os.environ.get("WAHA_MAX_RETRIES", 3))
+WAHA_RATE_LIMIT = float(os.environ.get("WAHA_RATE_LIMIT", 20))
+TASKS_DB_PATH = os.environ.get("TASKS_DB_PATH", "delayed_tasks.sqlite3")
+TASK_WORKERS = int(os.environ.get("TASK_WORKERS", 4))
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "0").lower() in ("1", "true", "yes")
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", 1000))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 600))
+LLM_CACHE_IGNORE_NAME = os.environ.get("LLM_CACHE_IGNORE_NAME", "0").lower() in ("1", "true", "yes")
+LLM_CACHE_OPT_OUT = {s.strip() for s in os.environ.get("LLM_CACHE_OPT_OUT", "").split(",") if s.strip()}
+DEDUP_MAX_SIZE = int(os.environ.get("DEDUP_MAX_SIZE", 10000))
+DEDUP_TTL = int(os.environ.get("DEDUP_TTL", 86400))
+DEDUP_HASH_TTL = int(os.environ.get("DEDUP_HASH_TTL", 600))  # события без event_id: окно повторов отправителя
+DEDUP_DB_PATH = os.environ.get("DEDUP_DB_PATH")  # пусто — только память
+CAMPAIGNS_DB_PATH = os.environ.get("CAMPAIGNS_DB_PATH", "campaigns.sqlite3")
+CAMPAIGN_PAGE_SIZE = int(os.environ.get("CAMPAIGN_PAGE_SIZE", 500))
+CAMPAIGN_WORKERS = int(os.environ.get("CAMPAIGN_WORKERS", 8))
+# Квоты внешних API в запросах (токенах) в минуту; 0 — без ограничения
+SHEETS_READ_RPM = int(os.environ.get("SHEETS_READ_RPM", 60))
+SHEETS_WRITE_RPM = int(os.environ.get("SHEETS_WRITE_RPM", 60))
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", 0))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 30))
+# Локальная база клиентов и каталога; пусто — работать напрямую с Google Таблицей
+LOCAL_STORE_PATH = os.environ.get("LOCAL_STORE_PATH", "agent_store.sqlite3")
+SHEET_PUSH_INTERVAL = float(os.environ.get("SHEET_PUSH_INTERVAL", 5))
+CATALOG_PULL_INTERVAL = float(os.environ.get("CATALOG_PULL_INTERVAL", CATALOG_CACHE_TTL))
+# Лист истории заказов (только дописывается); пусто — прежняя JSON-история в колонке D листа customers
+ORDERS_SHEET_NAME = os.environ.get("ORDERS_SHEET_NAME", "orders")
+ORDER_HISTORY_WINDOW = int(os.environ.get("ORDER_HISTORY_WINDOW", 10))
+ORDER_HISTORY_CACHE_TTL = int(os.environ.get("ORDER_HISTORY_CACHE_TTL", 300))
+# Без локальной базы история берется из последних ORDER_HISTORY_SHEET_ROWS строк листа orders
+ORDER_HISTORY_SHEET_ROWS = int(os.environ.get("ORDER_HISTORY_SHEET_ROWS", 5000))
+# Рекомендации "с этим товаром покупают": сколько держать на SKU и минимум совместных покупок
+CO_PURCHASE_TOP_K = int(os.environ.get("CO_PURCHASE_TOP_K", 3))
+CO_PURCHASE_MIN_COUNT = int(os.environ.get("CO_PURCHASE_MIN_COUNT", 1))
+# Модели для политик рендеринга "full" и "fast" из базы знаний
+OPENAI_FULL_MODEL = os.environ.get("OPENAI_FULL_MODEL", "gpt-4o")
+OPENAI_FAST_MODEL = os.environ.get("OPENAI_FAST_MODEL", "gpt-4o-mini")
 
 # Ключ-файл используется для аутентификации в Google
 KEY_PATH = "kaspiseller-57379-firebase-adminsdk-fbsvc-1c22a63a88.json"
 
-# Инициализация OpenAI
-openai.api_key = OPENAI_API_KEY
+def make_rate_limiter(name, per_minute):
+    if not per_minute:
+        return None
+    # Запас на всплеск — шестая часть минутной квоты
+    return AdaptiveRateLimiter(name, per_minute / 60, burst=max(1, per_minute // 6), max_wait=RATE_LIMIT_MAX_WAIT)
+
+def make_rate_limiters(tenant):
+    """Ограничители квот продавца; квоты можно переопределить в его настройках."""
+    quotas = {
+        "sheets_read": tenant.setting("sheets_read_rpm", SHEETS_READ_RPM),
+        "sheets_write": tenant.setting("sheets_write_rpm", SHEETS_WRITE_RPM),
+        "openai": tenant.setting("openai_rpm", OPENAI_RPM),
+        "openai_tokens": tenant.setting("openai_tpm", OPENAI_TPM),
+    }
+    return {name: make_rate_limiter(f"{tenant.id}.{name}", int(per_minute)) for name, per_minute in quotas.items()}
+
+# Тяжелые клиенты (openai, gspread, pandas) импортируются при первом использовании,
+# а подключение к Google Таблице выполняется в фоне: Flask начинает отвечать сразу
+startup_report = {}
+sheets_ready = threading.Event()
 
-# Подключение к Google Sheets
-try:
+# Общие для всех продавцов клиенты: один пул соединений к WAHA, один OpenAI и один gspread
+waha_session = make_session(WAHA_POOL_SIZE)
+
+@lru_cache(maxsize=None)
+def get_openai_client():
+    import openai
+    return openai.OpenAI(api_key=OPENAI_API_KEY)
+
+@lru_cache(maxsize=None)
+def get_gspread_client():
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
     scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/drive']
     creds = ServiceAccountCredentials.from_json_keyfile_name(KEY_PATH, scope)
-    gspread_client = gspread.authorize(creds)
-    products_sheet = gspread_client.open_by_url(GOOGLE_SHEET_URL).worksheet("products")
-    customers_sheet = gspread_client.open_by_url(GOOGLE_SHEET_URL).worksheet("customers")
-    app.logger.info("Успешное подключение к Google Таблице (листы products и customers).")
-except Exception as e:
-    app.logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к Google Таблице: {e}")
-    products_sheet, customers_sheet = None, None
+    return gspread.authorize(creds)
+
+def open_spreadsheet(url):
+    return get_gspread_client().open_by_url(url)
+
+def limit_worksheet(tenant, worksheet):
+    read_limiter, write_limiter = tenant.rate_limiters["sheets_read"], tenant.rate_limiters["sheets_write"]
+    if not read_limiter and not write_limiter:
+        return worksheet
+    return RateLimitedWorksheet(worksheet, read_limiter, write_limiter)
+
+def open_tenant_orders_sheet(tenant, spreadsheet):
+    """Лист orders или None — тогда история заказов пишется по-старому, в колонку D листа customers."""
+    if not ORDERS_SHEET_NAME:
+        return None
+    try:
+        return limit_worksheet(tenant, open_orders_worksheet(spreadsheet, ORDERS_SHEET_NAME))
+    except Exception as e:
+        app.logger.error(f"[{tenant.id}] Не удалось открыть лист {ORDERS_SHEET_NAME}, "
+                         f"история заказов пишется в колонку D листа customers: {e}")
+        return None
+
+def connect_sheets(tenant):
+    try:
+        spreadsheet = open_spreadsheet(tenant.setting("google_sheet_url"))
+        tenant.products_sheet = limit_worksheet(tenant, spreadsheet.worksheet("products"))
+        tenant.customers_sheet = limit_worksheet(tenant, spreadsheet.worksheet("customers"))
+        tenant.orders_sheet = open_tenant_orders_sheet(tenant, spreadsheet)
+        app.logger.info(f"[{tenant.id}] Успешное подключение к Google Таблице (листы products и customers).")
+    except Exception as e:
+        app.logger.error(f"[{tenant.id}] КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к Google Таблице: {e}")
+        tenant.products_sheet, tenant.customers_sheet, tenant.orders_sheet = None, None, None
+    else:
+        tenant.customer_writer = CustomerWriteBuffer(
+            tenant.customers_sheet, max_batch=CUSTOMER_WRITE_BATCH, flush_interval=CUSTOMER_WRITE_INTERVAL,
+            span=tenant.span, orders_worksheet=tenant.orders_sheet,
+            max_attempts=CUSTOMER_WRITE_MAX_ATTEMPTS, max_pending=CUSTOMER_WRITE_MAX_PENDING
+        )
+        if tenant.local_store:
+            try:
+                import_sheets_to_store(tenant)
+            except Exception as e:
+                app.logger.error(f"[{tenant.id}] Не удалось перенести клиентов из таблицы в локальную базу: {e}")
+            # Таблица — зеркало локальной базы: клиенты уходят туда, правки каталога приходят оттуда
+            tenant.sheet_sync = SheetSync(
+                tenant.local_store, tenant.bind(tenant.customer_writer.write_batch), tenant.bind(pull_catalog_to_store),
+                push_interval=SHEET_PUSH_INTERVAL, pull_interval=CATALOG_PULL_INTERVAL
+            )
+            tenant.sheet_sync.start()
+        else:
+            tenant.catalog_cache.refresh(wait=False)
+        tenant.campaign_runner = CampaignRunner(
+            tenant.customers_sheet, tenant.bind(render_promotion), tenant.bind(send_promotion),
+            tenant_path(tenant, "campaigns_db_path", CAMPAIGNS_DB_PATH),
+            page_size=CAMPAIGN_PAGE_SIZE, max_workers=CAMPAIGN_WORKERS, load_orders=tenant.bind(customer_order_history)
+        )
+        tenant.campaign_runner.resume_unfinished()
+    finally:
+        tenant.sheets_ready.set()
+
+def connect_all_sheets():
+    started = time.perf_counter()
+    try:
+        # Продавцы подключаются параллельно: время запуска не растет с их числом
+        with ThreadPoolExecutor(max_workers=min(8, len(tenant_registry))) as executor:
+            list(executor.map(connect_sheets, tenant_registry))
+    finally:
+        startup_report["sheets_connect_seconds"] = round(time.perf_counter() - started, 3)
+        sheets_ready.set()
+
+def warm_up():
+    connect_all_sheets()
+    # Импорт openai тоже уводим с пути первого запроса
+    started = time.perf_counter()
+    try:
+        get_openai_client()
+    except Exception as e:
+        app.logger.error(f"Не удалось инициализировать клиент OpenAI: {e}")
+    startup_report["openai_init_seconds"] = round(time.perf_counter() - started, 3)
+    app.logger.info(f"Отчет о запуске: {startup_report}")
 
 # --- 2. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
-def get_all_products_from_sheet():
-    if not products_sheet:
-        return pd.DataFrame()
+def current_tenant():
+    """Продавец текущего события или задачи; вне tenant_scope — продавец по умолчанию."""
+    return tenants.current_tenant() or tenant_registry.get()
+
+def tenant_path(tenant, name, default):
+    """Путь к SQLite-файлу продавца: из его настроек или отдельный каталог в TENANTS_DATA_DIR.
+
+    Единственный продавец из окружения использует пути как есть; пустой путь
+    выключает компонент, как и раньше.
+    """
+    if name in tenant.settings:
+        return tenant.settings[name] or None
+    if not TENANTS_CONFIG or not default:
+        return default
+    directory = os.path.join(TENANTS_DATA_DIR, tenant.id)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, os.path.basename(default))
+
+def load_products_from_sheet():
+    import pandas as pd
+    with metrics.span("sheets_products"):
+        all_records = current_tenant().products_sheet.get_all_records()
+    df = pd.DataFrame(all_records)
+    df['SKU'] = df['SKU'].astype(str)
+    return df
+
+def load_catalog():
+    from catalog_index import CatalogIndex
+    catalog = CatalogIndex(load_products_from_sheet())
+    refresh_co_purchase(catalog)
+    return catalog
+
+def pull_catalog_to_store():
+    import pandas as pd
+    from catalog_index import compute_total_stock, numeric_price
+    tenant = current_tenant()
+    with metrics.span("sheets_products"):
+        records = tenant.products_sheet.get_all_records()
+    for record in records:
+        record['SKU'] = str(record.get('SKU', ''))
+    df = pd.DataFrame(records)
+    if df.empty:
+        count = tenant.local_store.replace_products([], [], [])
+    else:
+        count = tenant.local_store.replace_products(
+            records, compute_total_stock(df).tolist(), numeric_price(df).tolist())
+    tenant.store_catalog_ready.set()
+    refresh_co_purchase(tenant.store_catalog)
+    return count
+
+def import_sheets_to_store(tenant):
+    """Однократно переносит клиентов и историю заказов из таблицы в пустую локальную базу.
+
+    Без этого после перехода на локальную базу агент не видел бы клиентов,
+    уже записанных в лист customers, и их заказов (колонка D и лист orders).
+    """
+    store = tenant.local_store
+    if store.customer_count():
+        return 0
+    with tenant.span("sheets_import"):
+        recorded = read_orders_by_phone(tenant.orders_sheet) if tenant.orders_sheet else {}
+        customers = []
+        for row in tenant.customers_sheet.get("A2:D"):
+            phone = str(row[0]).strip() if row else ''
+            if not phone:
+                continue
+            orders = merge_orders([order for order in parse_orders(row) if isinstance(order, dict)],
+                                  recorded.pop(phone, []))
+            customers.append((phone, row[1] if len(row) > 1 else '', row[2] if len(row) > 2 else '', orders))
+        # Заказы клиентов, которых нет в листе customers
+        customers.extend((phone, '', '', orders) for phone, orders in recorded.items())
+        imported = store.import_customers(customers)
+    app.logger.info(f"[{tenant.id}] В локальную базу перенесено клиентов из таблицы: {imported}")
+    return imported
+
+def load_order_history():
+    """Пары (телефон, SKU) всех известных заказов продавца для построения co_purchase.
+
+    Старая JSON-история из колонки D листа customers учитывается всегда,
+    новые заказы берутся из локальной базы или листа orders.
+    """
+    tenant = current_tenant()
+    pairs = []
+    if tenant.customers_sheet:
+        for row in tenant.customers_sheet.get("A2:D"):
+            phone = str(row[0]).strip() if row else ''
+            if phone:
+                pairs.extend((phone, order['sku']) for order in parse_orders(row)
+                             if isinstance(order, dict) and order.get('sku'))
+    if tenant.local_store:
+        pairs.extend(tenant.local_store.order_skus())
+    elif tenant.orders_sheet:
+        pairs.extend((row[0], row[2]) for row in tenant.orders_sheet.get("A2:C") if len(row) > 2 and row[0] and row[2])
+    return pairs
+
+def refresh_co_purchase(catalog):
+    """Строит рекомендации при первой загрузке каталога, дальше только обновляет остатки."""
+    co_purchase = current_tenant().co_purchase
     try:
-        all_records = products_sheet.get_all_records()
-        df = pd.DataFrame(all_records)
-        df['SKU'] = df['SKU'].astype(str)
-        return df
-    except:
-        return pd.DataFrame()
-
-def check_availability_and_get_stock(product_row):
-    stock_count, is_available = 0, False
-    for i in range(1, 6):
-        stock_value = str(product_row.get(f'PP{i}', 'no')).lower().strip()
-        if stock_value != 'no' and stock_value.isdigit():
-            count = int(stock_value)
-            if count > 0:
-                is_available = True
-                stock_count += count
-    return stock_count if is_available else 0
+        with metrics.span("co_purchase"):
+            if co_purchase.ready:
+                co_purchase.refresh_stock(catalog.products())
+            else:
+                co_purchase.rebuild(load_order_history(), catalog.products())
+    except Exception as e:
+        app.logger.error(f"Не удалось обновить рекомендации по совместным покупкам: {e}")
+
+# Пакет событий (/event_handler/batch): каталог продавца читается один раз на пакет,
+# изменения клиентов копятся и пишутся одним разом в конце пакета
+_event_batch = contextvars.ContextVar("event_batch", default=None)
+
+def get_catalog():
+    from catalog_index import CatalogIndex
+    tenant = current_tenant()
+    batch = _event_batch.get()
+    if batch is not None and tenant.id in batch["catalogs"]:
+        return batch["catalogs"][tenant.id]
+    if tenant.store_catalog_ready.is_set():
+        return tenant.store_catalog
+    if not tenant.products_sheet:
+        return CatalogIndex()
+    try:
+        with metrics.span("catalog"):
+            return tenant.catalog_cache.get()
+    except Exception as e:
+        app.logger.error(f"Ошибка при чтении каталога товаров: {e}")
+        return CatalogIndex()
 
 def update_customer_in_sheet(customer_info, stage, order_info=None):
-    if not customers_sheet:
+    tenant = current_tenant()
+    if not tenant.local_store and not tenant.customer_writer:
         return
+    batch = _event_batch.get()
+    if batch is not None:
+        batch["customer_writes"].append((tenant, (customer_info, stage, order_info)))
+        return
+    write_customers(tenant, [(customer_info, stage, order_info)])
+
+def write_customers(tenant, changes):
+    """Записывает список (customer_info, stage, order_info) клиентов продавца; в базу — одной транзакцией."""
     try:
-        phone = str(customer_info['phone'])
-        cell = customers_sheet.find(phone, in_column=1)
-        if cell:  # update
-            row_index = cell.row
-            customers_sheet.update_cell(row_index, 2, customer_info.get('name', ''))
-            customers_sheet.update_cell(row_index, 3, stage)
+        with metrics.span("customer_update"):
+            if tenant.local_store:
+                tenant.local_store.record_customers([
+                    (customer_info['phone'], customer_info.get('name', ''), stage, order_info)
+                    for customer_info, stage, order_info in changes])
+            else:
+                for customer_info, stage, order_info in changes:
+                    tenant.customer_writer.update(
+                        customer_info['phone'], customer_info.get('name', ''), stage, order_info)
+        for customer_info, stage, order_info in changes:
             if order_info:
-                old_history_str = customers_sheet.cell(row_index, 4).value or '[]'
-                try: order_history = json.loads(old_history_str)
-                except: order_history = []
-                order_history.append(order_info)
-                customers_sheet.update_cell(row_index, 4, json.dumps(order_history, ensure_ascii=False))
-        else:  # create new
-            new_row = [
-                phone, customer_info.get('name', ''), stage,
-                json.dumps([order_info] if order_info else [], ensure_ascii=False)
-            ]
-            customers_sheet.append_row(new_row)
+                tenant.co_purchase.add_order(customer_info['phone'], order_info.get('sku'))
     except Exception as e:
         app.logger.error(f"Ошибка при обновлении данных клиента: {e}")
 
+def load_orders_sheet():
+    return read_orders_by_phone(current_tenant().orders_sheet, ORDER_HISTORY_SHEET_ROWS)
+
+def customer_order_history(row, limit=None):
+    """Заказы клиента по строке листа customers (старые — раньше); limit — только последние.
+
+    Старая JSON-история из колонки D дополняется заказами из локальной базы,
+    а без нее — из последних ORDER_HISTORY_SHEET_ROWS строк листа orders
+    (читаются не чаще раза в ORDER_HISTORY_CACHE_TTL секунд, поэтому полная
+    история для фильтров рассылки есть только с локальной базой); заказы,
+    записанные в оба места, не дублируются.
+    """
+    tenant = current_tenant()
+    orders = [order for order in parse_orders(row) if isinstance(order, dict)]
+    phone = str(row[0]).strip() if row else ''
+    recorded = []
+    if phone and tenant.local_store:
+        recorded = tenant.local_store.recent_orders(phone, limit)
+    elif phone and tenant.orders_sheet:
+        try:
+            with metrics.span("orders_history"):
+                recorded = tenant.order_history.get().get(phone, [])
+        except Exception as e:
+            app.logger.error(f"Ошибка при чтении листа {ORDERS_SHEET_NAME}: {e}")
+    orders = merge_orders(orders, recorded)
+    return orders[-limit:] if limit else orders
+
+def merge_orders(orders, recorded):
+    """Дописывает к orders заказы из recorded, которых там еще нет."""
+    if not recorded:
+        return orders
+    seen = {json.dumps(order, sort_keys=True, ensure_ascii=False) for order in orders}
+    for order in recorded:
+        if json.dumps(order, sort_keys=True, ensure_ascii=False) not in seen:
+            orders.append(order)
+    return orders
+
+def customer_orders(row):
+    """Последние ORDER_HISTORY_WINDOW заказов клиента — контекст промпта рассылки."""
+    return customer_order_history(row, ORDER_HISTORY_WINDOW)
+
+def waha_payload(phone, text):
+    return {"phone": phone, "message": text}
+
 def send_waha_message(phone, text):
-    # WAHA API call
     try:
-        url = f"{WAHA_API_ENDPOINT}/api/sendMessage/{WAHA_SESSION_ID}"
-        payload = {"phone": phone, "message": text}
-        requests.post(url, json=payload)
+        with metrics.span("waha"):
+            sent = current_tenant().waha_client.send(phone, text)
     except Exception as e:
         app.logger.error(f"Ошибка при отправке WAHA-сообщения: {e}")
+        return False
+    if not sent:
+        metrics.count_error("waha")
+    return sent
+
+SYSTEM_PROMPT = "Ты помощник по продажам."
+
+OPENAI_FALLBACK_ANSWER = "Извините, сейчас не могу ответить."
+
+def openai_messages(prompt):
+    return [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+
+def cached_openai_response(prompt, model, scenario, customer_name):
+    """Ищет ответ в кэше LLM; возвращает (ответ или None, ключ для сохранения, имя)."""
+    # Одинаковые сценарий, товар и рекомендации дают одинаковый промпт — ответ берем из кэша
+    name = customer_name if LLM_CACHE_IGNORE_NAME else None
+    llm_cache = current_tenant().llm_cache
+    if not llm_cache or scenario in LLM_CACHE_OPT_OUT:
+        return None, None, name
+    key_prompt = anonymize(prompt, name)
+    if key_prompt is None:
+        return None, None, name
+    cache_key = llm_cache.make_key(model, SYSTEM_PROMPT, key_prompt)
+    cached = llm_cache.get(cache_key)
+    return (personalize(cached, name) if cached is not None else None), cache_key, name
+
+def remember_openai_response(cache_key, answer, name):
+    if cache_key:
+        cached = anonymize(answer, name)
+        if cached is not None:
+            current_tenant().llm_cache.set(cache_key, cached)
 
-def get_openai_response(prompt, model="gpt-4o"):
+def estimate_openai_tokens(prompt):
+    # Грубая оценка для квоты TPM: ~3 символа на токен плюс запас на ответ
+    return (len(SYSTEM_PROMPT) + len(prompt)) // 3 + 300
+
+def record_openai_usage(usage, response):
+    """Переносит токены ответа в словарь usage (для счетчиков стоимости)."""
+    if usage is None:
+        return
+    response_usage = getattr(response, "usage", None)
+    usage["prompt_tokens"] = getattr(response_usage, "prompt_tokens", 0) or 0
+    usage["completion_tokens"] = getattr(response_usage, "completion_tokens", 0) or 0
+
+def get_openai_response(prompt, model=OPENAI_FULL_MODEL, scenario=None, customer_name=None,
+                        defer_on_throttle=False, usage=None):
+    """Ответ модели; при ошибке — OPENAI_FALLBACK_ANSWER.
+
+    defer_on_throttle=True пробрасывает RateLimited, чтобы фоновую работу
+    (отложенную задачу, рассылку) повторили позже, а не отправили заглушку.
+    В словарь usage, если он передан, записываются токены запроса.
+    """
+    cached, cache_key, name = cached_openai_response(prompt, model, scenario, customer_name)
+    if cached is not None:
+        if usage is not None:
+            usage["cached"] = True
+        return cached
+    rate_limiters = current_tenant().rate_limiters
+    limiter, tokens_limiter = rate_limiters["openai"], rate_limiters["openai_tokens"]
     try:
-        response = openai.chat.completions.create(
-            model=model,
-            messages=[{"role": "system", "content": "Ты помощник по продажам."},
-                      {"role": "user", "content": prompt}],
-            temperature=0.7
-        )
-        return response.choices[0].message["content"].strip()
+        with metrics.span("openai"):
+            if tokens_limiter:
+                tokens_limiter.acquire(estimate_openai_tokens(prompt))
+            create = get_openai_client().chat.completions.create
+            kwargs = {"model": model, "messages": openai_messages(prompt), "temperature": 0.7}
+            response = limiter.call(create, **kwargs) if limiter else create(**kwargs)
+        answer = response.choices[0].message.content.strip()
+        record_openai_usage(usage, response)
+    except RateLimited as e:
+        app.logger.warning(f"OpenAI: {e}")
+        if defer_on_throttle:
+            raise
+        return OPENAI_FALLBACK_ANSWER
     except Exception as e:
         app.logger.error(f"Ошибка OpenAI: {e}")
-        return "Извините, сейчас не могу ответить."
+        return OPENAI_FALLBACK_ANSWER
+    remember_openai_response(cache_key, answer, name)
+    return answer
 
-def build_prompt_from_kb(stage_id, context):
-    stage = knowledge_base.get("scenarios", {}).get(stage_id, {})
-    script = stage.get("script", [])
-    text = "\n".join(script)
-    for k, v in context.items():
-        text = text.replace(f"{{{k}}}", str(v))
-    return text
+def render_stage_message(stage_id, context, customer_name=None, **kwargs):
+    return current_tenant().stage_router.render(stage_id, context, customer_name=customer_name, **kwargs)
 
-# --- 3. ПЛАНИРОВЩИК (замена Cloud Tasks) ---
+# --- 2.1. ПРОДАВЦЫ ---
+
+def create_tenant(settings):
+    """Продавец со своими листами, базой знаний, кэшами и квотами поверх общих клиентов."""
+    tenant = Tenant(str(settings["id"]), settings)
+    # База знаний: загружается при первом обращении и перечитывается при изменении файла
+    tenant.knowledge_base = KnowledgeBase(
+        tenant.setting("knowledge_base_path", KNOWLEDGE_BASE_PATH),
+        compile_script_templates,
+        required_scenarios=["after_purchase_upsell", "delivery_feedback"],
+    )
+    # 429 от API превращается в ожидание, а не в ошибку; квоты у каждого продавца свои
+    tenant.rate_limiters = make_rate_limiters(tenant)
+    # Политика сценария решает, нужен ли LLM: шаблон, быстрая или полная модель
+    tenant.stage_router = StageRouter(
+        tenant.knowledge_base, get_openai_response, {"full": OPENAI_FULL_MODEL, "fast": OPENAI_FAST_MODEL},
+        span=metrics.span
+    )
+    tenant.llm_cache = ResponseCache(max_size=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL) if LLM_CACHE_ENABLED else None
+    tenant.waha_client = WahaClient(
+        f"{WAHA_API_ENDPOINT}/api/sendMessage/{tenant.setting('waha_session_id')}", waha_payload,
+        pool_size=WAHA_POOL_SIZE, max_retries=WAHA_MAX_RETRIES, rate_limit=float(tenant.setting("waha_rate_limit", WAHA_RATE_LIMIT)),
+        on_retry=lambda: metrics.count_retry("waha"), session=waha_session
+    )
+    tenant.catalog_cache = CatalogCache(tenant.bind(load_catalog), ttl=CATALOG_CACHE_TTL)
+    store_path = tenant_path(tenant, "local_store_path", LOCAL_STORE_PATH)
+    tenant.local_store = LocalStore(store_path) if store_path else None
+    tenant.store_catalog = StoreCatalog(tenant.local_store) if tenant.local_store else None
+    # Каталог в локальной базе уже есть (с прошлого запуска или после первой синхронизации)
+    tenant.store_catalog_ready = threading.Event()
+    if tenant.local_store and tenant.local_store.product_count():
+        tenant.store_catalog_ready.set()
+    # История из листа orders нужна только без локальной базы
+    tenant.order_history = None if tenant.local_store else CatalogCache(
+        tenant.bind(load_orders_sheet), ttl=ORDER_HISTORY_CACHE_TTL, name="order_history")
+    tenant.co_purchase = CoPurchaseRecommender(top_k=CO_PURCHASE_TOP_K, min_count=CO_PURCHASE_MIN_COUNT)
+    tenant.sheets_ready = threading.Event()
+    return tenant
+
+def load_tenants():
+    if not TENANTS_CONFIG:
+        settings = {
+            "id": DEFAULT_TENANT_ID, "waha_session_id": WAHA_SESSION_ID, "google_sheet_url": GOOGLE_SHEET_URL,
+        }
+        return TenantRegistry([create_tenant(settings)])
+    tenant_settings, default_id = load_tenant_settings(TENANTS_CONFIG)
+    missing = [str(item["id"]) for item in tenant_settings
+               if not item.get("waha_session_id") or not item.get("google_sheet_url")]
+    if missing:
+        raise RuntimeError(f"{TENANTS_CONFIG}: нет waha_session_id или google_sheet_url у продавцов {', '.join(missing)}")
+    return TenantRegistry([create_tenant(item) for item in tenant_settings], default_id)
+
+tenant_registry = load_tenants()
 
-scheduler = BackgroundScheduler()
-scheduler.start()
+# --- 3. ПЛАНИРОВЩИК (замена Cloud Tasks) ---
 
-def schedule_task(func, payload, delay_seconds=172800):
-    run_time = datetime.now() + timedelta(seconds=delay_seconds)
-    scheduler.add_job(func, 'date', run_date=run_time, args=[payload])
+def schedule_task(payload, delay_seconds=172800):
+    return task_store.schedule(payload["task_type"], payload, delay_seconds)
 
 def process_review_request(payload):
+    with tenant_scope(tenant_registry.get(payload.get("tenant_id"))), \
+            metrics.track_event("REVIEW_REQUEST", app.logger) as result:
+        _send_review_request(payload)
+        result["status"] = 200
+
+def _send_review_request(payload):
     customer_info = payload.get("customer", {})
     order_info = payload.get("order", {})
     update_customer_in_sheet(customer_info, "NURTURING")
     context = {"Клиент": customer_info.get('name'), "Купленный товар": order_info.get('product_name')}
-    prompt = build_prompt_from_kb("delivery_feedback", context)
-    ai_message = get_openai_response(prompt)
+    ai_message = render_stage_message("delivery_feedback", context, customer_info.get('name'), defer_on_throttle=True)
     send_waha_message(customer_info.get("phone"), ai_message)
 
+# Отложенные задачи хранятся в SQLite и переживают перезапуск процесса
+task_store = DelayedTaskStore(TASKS_DB_PATH, {"REVIEW_REQUEST": process_review_request}, max_workers=TASK_WORKERS)
+task_store.start()
+
 # --- 4. ЛОГИКА ДЛЯ ЭТАПОВ ВОРОНКИ ---
 
-def handle_upsell_logic(data):
+def format_recommendations(products):
+    return "".join(f"\n- {product['model']} (Цена: {product['price']} KZT)" for product in products)
+
+def upsell_recommendations(catalog, sku, product, limit=3):
+    """Сначала товары, которые покупают вместе с sku, остаток — из той же категории."""
+    recommendations = list(current_tenant().co_purchase.recommendations(sku, limit))
+    if len(recommendations) < limit and product.get('category'):
+        seen = {str(item.get('SKU')) for item in recommendations}
+        for item in catalog.recommendations(product['category'], exclude_sku=sku, limit=limit + len(seen)):
+            if str(item.get('SKU')) not in seen:
+                recommendations.append(item)
+                if len(recommendations) >= limit:
+                    break
+    return recommendations
+
+def build_upsell_context(customer_info, order_info, catalog):
+    """Контекст допродажи или None, если купленного товара нет в каталоге."""
+    purchased_sku = order_info.get('sku')
+    if not purchased_sku:
+        return None
+    purchased_product = catalog.get_product(purchased_sku)
+    if not purchased_product:
+        return None
+    recommendations = upsell_recommendations(catalog, purchased_sku, purchased_product)
+    if not recommendations and not purchased_product.get('category'):
+        return None
+    return {
+        "Клиент": customer_info.get('name'),
+        "Купленный товар": order_info.get('product_name'),
+        "Рекомендации": format_recommendations(recommendations)
+    }
+
+def default_thank_you(customer_info):
+    return f"Здравствуйте, {customer_info.get('name')}! Спасибо за ваш заказ."
+
+def review_request_payload(data):
+    return {"task_type": "REVIEW_REQUEST", "tenant_id": current_tenant().id,
+            "customer": data.get("customer", {}), "order": data.get("order")}
+
+def upsell_steps(data):
+    """Логика допродажи без ввода-вывода — общая для Flask и ASGI (asgi.py).
+
+    Генератор отдает шаги, исполнитель выполняет их и возвращает результат:
+    ("prepare", customer_info, order_info) — записать клиента и вернуть каталог
+    (None, если у заказа нет SKU), ("render", stage_id, context, name) — текст
+    сообщения, ("send", phone, text) — отправка. Исключение шага бросается
+    обратно в генератор. Возвращает (тело ответа, HTTP-код).
+    """
     customer_info = data.get("customer", {})
     order_info = data.get("order", {})
     phone = customer_info.get("phone")
-    if not phone: return jsonify({"status": "error", "message": "Missing customer phone"}), 400
+    if not phone: return {"status": "error", "message": "Missing customer phone"}, 400
 
+    catalog = yield ("prepare", customer_info, order_info)
+    context = build_upsell_context(customer_info, order_info, catalog) if catalog is not None else None
+    if context:
+        try:
+            ai_message = yield ("render", "after_purchase_upsell", context, customer_info.get('name'))
+        except UnknownStageError as e:
+            app.logger.error(f"Допродажа пропущена: {e}")
+        else:
+            yield ("send", phone, ai_message)
+            return {"status": "success", "action": "upsell_sent"}, 200
+    try:
+        text = yield ("render", "order_thank_you", {"Клиент": customer_info.get('name')}, customer_info.get('name'))
+    except UnknownStageError:
+        text = default_thank_you(customer_info)
+    yield ("send", phone, text)
+    return {"status": "success", "action": "simple_thank_you_sent"}, 200
+
+def run_steps(steps, actions):
+    """Выполняет шаги генератора (см. upsell_steps) синхронными actions[имя шага]."""
+    try:
+        step = next(steps)
+        while True:
+            try:
+                result = actions[step[0]](*step[1:])
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+def prepare_upsell(customer_info, order_info):
     update_customer_in_sheet(customer_info, "POST_PURCHASE", order_info)
+    return get_catalog() if order_info.get('sku') else None
 
-    purchased_sku = order_info.get('sku')
-    if purchased_sku:
-        all_products_df = get_all_products_from_sheet()
-        if not all_products_df.empty:
-            purchased_product = all_products_df[all_products_df['SKU'] == str(purchased_sku)]
-            if not purchased_product.empty:
-                category = purchased_product.iloc[0].get('category')
-                if category:
-                    same_category_products = all_products_df[
-                        (all_products_df['category'] == category) &
-                        (all_products_df['SKU'] != str(purchased_sku))
-                    ]
-                    recommendations_text = ""
-                    for _, row in same_category_products.head(3).iterrows():
-                        stock = check_availability_and_get_stock(row)
-                        if stock > 0:
-                            recommendations_text += f"\n- {row['model']} (Цена: {row['price']} KZT)"
-                    context = {
-                        "Клиент": customer_info.get('name'),
-                        "Купленный товар": order_info.get('product_name'),
-                        "Рекомендации": recommendations_text
-                    }
-                    prompt = build_prompt_from_kb("after_purchase_upsell", context)
-                    ai_message = get_openai_response(prompt)
-                    send_waha_message(phone, ai_message)
-                    return jsonify({"status": "success", "action": "upsell_sent"})
-    send_waha_message(phone, f"Здравствуйте, {customer_info.get('name')}! Спасибо за ваш заказ.")
-    return jsonify({"status": "success", "action": "simple_thank_you_sent"})
+UPSELL_ACTIONS = {"prepare": prepare_upsell, "render": render_stage_message, "send": send_waha_message}
+
+def handle_upsell_logic(data):
+    return run_steps(upsell_steps(data), UPSELL_ACTIONS)
 
 def handle_delivered_logic(data):
     customer_info = data.get("customer", {})
     update_customer_in_sheet(customer_info, "ORDER_DELIVERED")
-    task_payload = {"task_type": "REVIEW_REQUEST", "customer": customer_info, "order": data.get("order")}
-    schedule_task(process_review_request, task_payload)
-    return jsonify({"status": "success", "action": "review_request_scheduled"})
+    schedule_task(review_request_payload(data))
+    return {"status": "success", "action": "review_request_scheduled"}, 200
+
+EVENT_HANDLERS = {
+    "POST_PURCHASE": handle_upsell_logic,
+    "ORDER_DELIVERED": handle_delivered_logic,
+}
+
+def validate_event(event_data):
+    if not event_data or not isinstance(event_data, dict): return {"status": "error", "message": "Invalid JSON"}, 400
+    tenant_id = event_data.get("tenant_id")
+    if tenant_id and tenant_id not in tenant_registry:
+        return {"status": "error", "message": f"Неизвестный продавец: {tenant_id}"}, 400
+    stage = event_data.get("waha_stage_id")
+    if stage not in EVENT_HANDLERS: return {"status": "error", "message": f"Неизвестный этап: {stage}"}, 400
+    if stage == "POST_PURCHASE" and not (event_data.get("customer") or {}).get("phone"):
+        return {"status": "error", "message": "Missing customer phone"}, 400
+    return None
+
+def process_event(event_data):
+    error = validate_event(event_data)
+    if error: return error
+    stage = event_data["waha_stage_id"]
+    # Одна строка event_timing в логе на событие: общее время и время каждого шага
+    with tenant_scope(tenant_registry.get(event_data.get("tenant_id"))), \
+            metrics.track_event(stage, app.logger) as result:
+        body, status_code = EVENT_HANDLERS[stage](event_data)
+        result["status"] = status_code
+    return body, status_code
+
+dedup_store = DedupStore(max_size=DEDUP_MAX_SIZE, ttl=DEDUP_TTL, db_path=DEDUP_DB_PATH, hash_ttl=DEDUP_HASH_TTL)
+
+def event_shard_key(event_data):
+    """События одного клиента продавца обрабатываются по порядку, разных клиентов — параллельно."""
+    phone = (event_data.get("customer") or {}).get("phone")
+    return f"{event_data.get('tenant_id') or tenant_registry.default_id}:{phone}" if phone else None
+
+def process_queued_event(event_data):
+    """Обработка события воркером очереди.
+
+    Ключ дедупликации остается "в обработке" до конца: повтор отправителя,
+    пришедший после ошибки, обрабатывается заново, а не получает 202.
+    """
+    key = event_key(event_data)
+    try:
+        body, status_code = process_event(event_data)
+    except Exception:
+        dedup_store.release(key)
+        raise
+    if status_code >= 500: dedup_store.release(key)
+    else: dedup_store.complete(key, (body, status_code))
+    return body, status_code
+
+# Асинхронный режим: вебхук только ставит событие в очередь, обработку ведут воркеры по шардам
+event_queue = EventQueue(
+    process_queued_event, workers=EVENT_WORKERS, max_queue=EVENT_QUEUE_SIZE, shard_key=event_shard_key
+) if EVENT_ASYNC_MODE else None
+
+def batch_result(body, status_code, duplicate=False):
+    result = {"status_code": status_code, "body": body}
+    if duplicate:
+        result["duplicate"] = True
+    return result
+
+def process_event_batch(accepted, results):
+    """Обрабатывает принятые события пакета [(индекс, ключ дедупликации, событие)].
+
+    События одного клиента выполняются по порядку, разных клиентов — параллельно
+    (не больше EVENT_BATCH_WORKERS потоков). Каталог каждого продавца читается
+    один раз до начала обработки, изменения клиентов пишутся одним разом после.
+    """
+    batch = {"catalogs": {}, "customer_writes": []}
+    token = _event_batch.set(batch)
+    outcomes = {}
+    try:
+        for tenant_id in {event_data.get("tenant_id") for _, _, event_data in accepted
+                          if event_data["waha_stage_id"] == "POST_PURCHASE"}:
+            tenant = tenant_registry.get(tenant_id)
+            with tenant_scope(tenant):
+                batch["catalogs"][tenant.id] = get_catalog()
+
+        groups = {}
+        for item in accepted:
+            groups.setdefault(event_shard_key(item[2]) or item[1], []).append(item)
+
+        def run_group(group):
+            for index, key, event_data in group:
+                try:
+                    outcomes[index] = process_event(event_data)
+                except Exception as e:
+                    app.logger.error(f"Ошибка обработки события пакета: {e}")
+                    outcomes[index] = {"status": "error", "message": "Internal error"}, 500
+
+        workers = min(EVENT_BATCH_WORKERS, len(groups)) or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Каждой группе своя копия контекста: пакет общий, продавец и метрики — свои
+            futures = [executor.submit(contextvars.copy_context().run, run_group, group) for group in groups.values()]
+            for future in futures:
+                future.result()
+    finally:
+        _event_batch.reset(token)
+        writes = {}
+        for tenant, change in batch["customer_writes"]:
+            writes.setdefault(tenant, []).append(change)
+        for tenant, changes in writes.items():
+            with tenant_scope(tenant):
+                write_customers(tenant, changes)
+
+    for index, key, _ in accepted:
+        body, status_code = outcomes.get(index) or ({"status": "error", "message": "Internal error"}, 500)
+        if status_code >= 500: dedup_store.release(key)
+        else: dedup_store.complete(key, (body, status_code))
+        results[index] = batch_result(body, status_code)
+
+# --- 4.1. РАССЫЛКИ (PROMOTIONS) ---
+
+def render_promotion(row):
+    with metrics.stage_scope("PROMOTIONS"):
+        return _render_promotion(row)
+
+def send_promotion(phone, text):
+    with metrics.stage_scope("PROMOTIONS"):
+        return send_waha_message(phone, text)
+
+def _render_promotion(row):
+    name = row[1] if len(row) > 1 else ''
+    orders = customer_orders(row)
+    last_order = orders[-1] if orders else {}
+    recommendations = []
+    if last_order.get('sku'):
+        catalog = get_catalog()
+        product = catalog.get_product(last_order['sku'])
+        if product:
+            recommendations = upsell_recommendations(catalog, last_order['sku'], product)
+    context = {
+        "Клиент": name,
+        "Купленный товар": last_order.get('product_name', ''),
+        "Рекомендации": format_recommendations(recommendations)
+    }
+    return render_stage_message("promo_newsletter", context, name, defer_on_throttle=True)
 
 # --- 5. РОУТЫ ---
 
+def event_steps(event_data, tenant_id=None):
+    """Проверка, дедупликация и обработка (или постановка в очередь) одного события.
+
+    Общий путь для Flask и ASGI в виде шагов (см. upsell_steps): единственный
+    шаг ("process", event) — обработка события, когда очередь выключена.
+    Возвращает (тело, код, заголовки).
+    """
+    if tenant_id and isinstance(event_data, dict):
+        event_data["tenant_id"] = tenant_id
+    error = validate_event(event_data)
+    if error: return error[0], error[1], {}
+
+    # Повтор отправителя получает результат первой обработки, без новых записей и сообщений
+    key = event_key(event_data)
+    previous = dedup_store.claim(key)
+    if previous:
+        return previous[0], previous[1], {"X-Duplicate-Event": "1"}
+
+    if not event_queue:
+        try:
+            body, status_code = yield ("process", event_data)
+        except Exception:
+            dedup_store.release(key)
+            raise
+        if status_code >= 500: dedup_store.release(key)
+        else: dedup_store.complete(key, (body, status_code))
+        return body, status_code, {}
+    try:
+        event_id = event_queue.submit(event_data, event_data.get("event_id"))
+    except QueueFull as e:
+        dedup_store.release(key)
+        return {"status": "error", "message": str(e)}, 503, {"Retry-After": "5"}
+    # Результат в dedup_store запишет воркер (process_queued_event)
+    return {"status": "accepted", "event_id": event_id}, 202, {}
+
+def ingest_event(event_data, tenant_id=None):
+    return run_steps(event_steps(event_data, tenant_id), {"process": process_event})
+
 @app.route("/event_handler", methods=["POST"])
-def event_handler():
-    event_data = request.get_json(force=True, silent=True)
-    if not event_data: return jsonify({"status": "error", "message": "Invalid JSON"}), 400
-    stage = event_data.get("waha_stage_id")
-    if stage == "POST_PURCHASE": return handle_upsell_logic(event_data)
-    elif stage == "ORDER_DELIVERED": return handle_delivered_logic(event_data)
-    else: return jsonify({"status": "error", "message": f"Неизвестный этап: {stage}"}), 400
+@app.route("/tenants/<tenant_id>/event_handler", methods=["POST"])
+def event_handler(tenant_id=None):
+    body, status_code, headers = ingest_event(request.get_json(force=True, silent=True), tenant_id)
+    return jsonify(body), status_code, headers
+
+@app.route("/event_handler/batch", methods=["POST"])
+@app.route("/tenants/<tenant_id>/event_handler/batch", methods=["POST"])
+def event_batch_handler(tenant_id=None):
+    """Пакет событий: массив событий (или {"events": [...]}) → результат по каждому в том же порядке."""
+    events = request.get_json(force=True, silent=True)
+    if isinstance(events, dict):
+        events = events.get("events")
+    if not isinstance(events, list) or not events:
+        return jsonify({"status": "error", "message": "Ожидается непустой массив событий"}), 400
+    if len(events) > EVENT_BATCH_MAX_SIZE:
+        return jsonify({"status": "error", "message": f"Не больше {EVENT_BATCH_MAX_SIZE} событий в пакете"}), 413
+
+    # Один проход: проверка, дедупликация; повтор внутри пакета получит результат оригинала
+    results = [None] * len(events)
+    accepted = []
+    first_index = {}
+    repeats = []
+    for index, event_data in enumerate(events):
+        if tenant_id and isinstance(event_data, dict):
+            event_data["tenant_id"] = tenant_id
+        error = validate_event(event_data)
+        if error:
+            results[index] = batch_result(*error)
+            continue
+        key = event_key(event_data)
+        if key in first_index:
+            repeats.append((index, first_index[key]))
+            continue
+        first_index[key] = index
+        previous = dedup_store.claim(key)
+        if previous:
+            results[index] = batch_result(*previous, duplicate=True)
+            continue
+        accepted.append((index, key, event_data))
+
+    if not event_queue:
+        process_event_batch(accepted, results)
+    else:
+        for index, key, event_data in accepted:
+            try:
+                event_id = event_queue.submit(event_data, event_data.get("event_id"))
+            except QueueFull as e:
+                dedup_store.release(key)
+                results[index] = batch_result({"status": "error", "message": str(e)}, 503)
+                continue
+            results[index] = batch_result({"status": "accepted", "event_id": event_id}, 202)
+    for index, original in repeats:
+        results[index] = dict(results[original], duplicate=True)
+    return jsonify({"status": "success", "accepted": len(accepted), "results": results}), 200
+
+@app.route("/events/stats")
+def events_stats():
+    if not event_queue:
+        return jsonify({"status": "error", "message": "Асинхронный режим выключен"}), 404
+    return jsonify(event_queue.stats())
+
+@app.route("/events/dedup/stats")
+def events_dedup_stats():
+    return jsonify(dedup_store.stats())
+
+@app.route("/events/<event_id>")
+def event_status(event_id):
+    record = event_queue.status(event_id) if event_queue else None
+    if not record:
+        return jsonify({"status": "error", "message": "Событие не найдено"}), 404
+    return jsonify(record)
+
+@app.errorhandler(UnknownTenant)
+def unknown_tenant(e):
+    return jsonify({"status": "error", "message": str(e)}), 404
+
+def request_tenant(tenant_id=None):
+    """Продавец из параметра ?tenant= (по умолчанию — продавец по умолчанию)."""
+    return tenant_registry.get(tenant_id or request.args.get("tenant"))
+
+@app.route("/tenants")
+def tenants_list():
+    return jsonify({
+        "default": tenant_registry.default_id,
+        "tenants": [{"id": tenant.id, "ready": tenant.sheets_ready.is_set() and tenant.products_sheet is not None}
+                    for tenant in tenant_registry],
+    })
+
+@app.route("/campaigns/promotions", methods=["POST"])
+def start_promotion_campaign():
+    params = request.get_json(force=True, silent=True) or {}
+    campaign_runner = request_tenant(params.get("tenant_id")).campaign_runner
+    if not campaign_runner:
+        return jsonify({"status": "error", "message": "Нет подключения к листу customers"}), 503
+    filters = {
+        "stages": params.get("stages") or [],
+        "exclude_stages": params.get("exclude_stages") or [],
+        "min_orders": int(params.get("min_orders") or 0),
+        "skus": [str(sku) for sku in params.get("skus") or []],
+    }
+    campaign_id = campaign_runner.start(filters, params.get("campaign_id"))
+    return jsonify({"status": "accepted", "campaign_id": campaign_id}), 202
+
+@app.route("/campaigns/<campaign_id>")
+def campaign_status(campaign_id):
+    campaign_runner = request_tenant().campaign_runner
+    record = campaign_runner.status(campaign_id) if campaign_runner else None
+    if not record:
+        return jsonify({"status": "error", "message": "Рассылка не найдена"}), 404
+    return jsonify(record)
+
+@app.route("/catalog/refresh", methods=["POST"])
+def catalog_refresh():
+    tenant = request_tenant()
+    sheet_sync, catalog_cache = tenant.sheet_sync, tenant.catalog_cache
+    if sheet_sync:
+        try:
+            count = sheet_sync.pull()
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e), "sync": sheet_sync.stats()}), 502
+        return jsonify({"status": "success", "products": count, "sync": sheet_sync.stats()})
+    try:
+        catalog_cache.refresh()
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e), "cache": catalog_cache.stats()}), 502
+    return jsonify({"status": "success", "cache": catalog_cache.stats()})
+
+@app.route("/catalog/stats")
+def catalog_stats():
+    tenant = request_tenant()
+    if tenant.local_store:
+        # Каталог читается из локальной базы; кэш листа products нужен только до первой синхронизации
+        return jsonify({
+            "source": "local_store",
+            "ready": tenant.store_catalog_ready.is_set(),
+            "products": tenant.local_store.product_count(),
+            "sync": tenant.sheet_sync.stats() if tenant.sheet_sync else None,
+            "sheet_cache": tenant.catalog_cache.stats(),
+        })
+    return jsonify(dict(tenant.catalog_cache.stats(), source="sheet"))
+
+@app.route("/sync/stats")
+def sync_stats():
+    sheet_sync = request_tenant().sheet_sync
+    if not sheet_sync:
+        return jsonify({"status": "error", "message": "Локальная база выключена или нет подключения к таблице"}), 404
+    return jsonify(sheet_sync.stats())
+
+@app.route("/recommendations/stats")
+def recommendations_stats():
+    return jsonify(request_tenant().co_purchase.stats())
+
+@app.route("/customers/stats")
+def customers_stats():
+    customer_writer = request_tenant().customer_writer
+    if not customer_writer:
+        return jsonify({"status": "error", "message": "Нет подключения к листу customers"}), 503
+    return jsonify(customer_writer.stats())
+
+@app.route("/tasks/stats")
+def tasks_stats():
+    return jsonify(task_store.stats())
+
+@app.route("/llm/stats")
+def llm_stats():
+    llm_cache = request_tenant().llm_cache
+    if not llm_cache:
+        return jsonify({"status": "error", "message": "Кэш ответов LLM выключен"}), 404
+    return jsonify(llm_cache.stats())
+
+@app.route("/rate_limits/stats")
+def rate_limits_stats():
+    rate_limiters = request_tenant().rate_limiters
+    return jsonify({name: limiter.stats() for name, limiter in rate_limiters.items() if limiter})
+
+@app.route("/render/stats")
+def render_stats():
+    return jsonify(request_tenant().stage_router.stats())
+
+@app.route("/knowledge_base/stats")
+def knowledge_base_stats():
+    return jsonify(request_tenant().knowledge_base.stats())
+
+@app.route("/ready")
+def readiness():
+    degraded = [tenant.id for tenant in tenant_registry
+                if tenant.products_sheet is None or tenant.customers_sheet is None]
+    ready = sheets_ready.is_set() and not degraded
+    body = {"status": "ready" if ready else "starting" if not sheets_ready.is_set() else "degraded",
+            "startup": startup_report}
+    if degraded and sheets_ready.is_set():
+        body["degraded_tenants"] = degraded
+    return jsonify(body), 200 if ready else 503
+
+def per_tenant(read):
+    """Снимает read(tenant) -> {метка: значение} по всем продавцам; к меткам добавляется id продавца."""
+    return lambda: {(key, tenant.id): value for tenant in tenant_registry for key, value in read(tenant).items()}
+
+# Текущие значения очередей и кэшей снимаются в момент запроса /metrics;
+# общие на процесс очереди помечены tenant="all"
+metrics.REGISTRY.gauge(
+    "agent_queue_depth", "Глубина внутренних очередей", lambda: {
+        ("events", "all"): event_queue.queue_depth() if event_queue else 0,
+        ("delayed_tasks", "all"): task_store.pending_count(),
+        **per_tenant(lambda tenant: {
+            "customer_writes": tenant.customer_writer.queue_depth() if tenant.customer_writer else 0,
+            "sheet_sync": tenant.local_store.pending_count() if tenant.local_store else 0,
+        })(),
+    }, labels=("queue", "tenant"))
+metrics.REGISTRY.gauge(
+    "agent_event_shard_depth", "Глубина очереди событий по шардам (воркерам)",
+    lambda: dict(enumerate(event_queue.shard_depths())) if event_queue else {}, labels=("shard",))
+
+def cache_counts(tenant, field):
+    """Попадания или промахи кэшей продавца; кэш каталога работает только без локальной базы."""
+    counts = {"llm": tenant.llm_cache.stats()[field] if tenant.llm_cache else 0}
+    if not tenant.local_store:
+        counts["catalog"] = tenant.catalog_cache.stats()[field]
+    return counts
+
+metrics.REGISTRY.gauge(
+    "agent_cache_hits_total", "Попадания в кэши с момента запуска",
+    per_tenant(lambda tenant: cache_counts(tenant, "hits")), labels=("cache", "tenant"), kind="counter")
+metrics.REGISTRY.gauge(
+    "agent_cache_misses_total", "Промахи кэшей с момента запуска",
+    per_tenant(lambda tenant: cache_counts(tenant, "misses")), labels=("cache", "tenant"), kind="counter")
+
+def rate_limit_stat(field):
+    return per_tenant(lambda tenant: {
+        name: limiter.stats()[field] for name, limiter in tenant.rate_limiters.items() if limiter})
+
+metrics.REGISTRY.gauge("agent_rate_limit_rate", "Текущая разрешенная частота, запросов в секунду",
+                       rate_limit_stat("rate"), labels=("dependency", "tenant"))
+metrics.REGISTRY.gauge("agent_rate_limit_waiting", "Вызовы, ожидающие квоты",
+                       rate_limit_stat("waiting"), labels=("dependency", "tenant"))
+metrics.REGISTRY.gauge("agent_rate_limit_throttled_total", "Ответы 429 от внешних API",
+                       rate_limit_stat("throttled"), labels=("dependency", "tenant"), kind="counter")
+metrics.REGISTRY.gauge("agent_rate_limit_rejected_total", "Вызовы, не дождавшиеся квоты за max_wait",
+                       rate_limit_stat("rejected"), labels=("dependency", "tenant"), kind="counter")
+
+def render_stat(field):
+    return per_tenant(lambda tenant: {policy: item[field] for policy, item in tenant.stage_router.stats().items()})
+
+metrics.REGISTRY.gauge("agent_render_calls_total", "Подготовленные сообщения по политике рендеринга",
+                       render_stat("calls"), labels=("policy", "tenant"), kind="counter")
+metrics.REGISTRY.gauge("agent_render_llm_calls_total", "Обращения к LLM по политике рендеринга",
+                       render_stat("llm_calls"), labels=("policy", "tenant"), kind="counter")
+metrics.REGISTRY.gauge("agent_render_tokens_total", "Токены OpenAI по политике рендеринга (вход + выход)",
+                       per_tenant(lambda tenant: {policy: item["prompt_tokens"] + item["completion_tokens"]
+                                                  for policy, item in tenant.stage_router.stats().items()}),
+                       labels=("policy", "tenant"), kind="counter")
+metrics.REGISTRY.gauge("agent_render_cost_usd_total", "Оценка расходов на OpenAI, USD",
+                       render_stat("cost_usd"), labels=("policy", "tenant"), kind="counter")
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/")
 def healthcheck():
@@ -218,5 +1137,8 @@ def healthcheck():
 
 # --- 6. ЗАПУСК ---
 
+startup_report["import_seconds"] = round(time.perf_counter() - _IMPORT_STARTED, 3)
+threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,238 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Этап воронки текущего события, продавец и накопленные тайминги шагов события
+_current_stage = contextvars.ContextVar("metrics_stage", default="background")
+_current_tenant = contextvars.ContextVar("metrics_tenant", default="default")
+_current_timings = contextvars.ContextVar("metrics_timings", default=None)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels + ("le",), label_values + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """Значение, которое снимается функцией в момент выдачи /metrics.
+
+    kind="counter" — для монотонных счетчиков, которые компонент ведет сам.
+    """
+
+    def __init__(self, name, help_text, read, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.read = read
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.error(f"Не удалось снять метрику {self.name}: {e}")
+            return lines
+        if isinstance(value, dict):
+            for label_values, item in sorted(value.items()):
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {item}")
+        elif value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, read, labels=(), kind="gauge"):
+        return self.register(Gauge(name, help_text, read, labels, kind))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+DEPENDENCY_SECONDS = REGISTRY.histogram(
+    "agent_dependency_seconds", "Время шага обработки по внешней зависимости", ("dependency", "stage", "tenant"))
+DEPENDENCY_CALLS = REGISTRY.counter(
+    "agent_dependency_calls_total", "Вызовы внешних зависимостей", ("dependency", "stage", "tenant"))
+DEPENDENCY_ERRORS = REGISTRY.counter(
+    "agent_dependency_errors_total", "Ошибки внешних зависимостей", ("dependency", "stage", "tenant"))
+DEPENDENCY_RETRIES = REGISTRY.counter(
+    "agent_dependency_retries_total", "Повторные попытки вызова внешних зависимостей",
+    ("dependency", "stage", "tenant"))
+EVENT_SECONDS = REGISTRY.histogram(
+    "agent_event_seconds", "Полное время обработки события", ("stage", "tenant"))
+EVENTS = REGISTRY.counter(
+    "agent_events_total", "Обработанные события по этапу и HTTP-коду результата", ("stage", "status", "tenant"))
+
+
+def current_stage():
+    return _current_stage.get()
+
+
+@contextmanager
+def span(dependency):
+    """Замеряет шаг обработки: гистограмма, счетчики вызовов/ошибок, строка тайминга."""
+    stage, tenant = _current_stage.get(), _current_tenant.get()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        DEPENDENCY_ERRORS.inc(dependency, stage, tenant)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        DEPENDENCY_CALLS.inc(dependency, stage, tenant)
+        DEPENDENCY_SECONDS.observe(elapsed, dependency, stage, tenant)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings[dependency] = timings.get(dependency, 0.0) + elapsed
+
+
+@contextmanager
+def stage_scope(stage):
+    """Помечает вызовы внутри блока этапом stage (без отдельной строки тайминга)."""
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+@contextmanager
+def tenant_scope(tenant_id):
+    """Помечает вызовы и события внутри блока продавцом tenant_id."""
+    token = _current_tenant.set(tenant_id)
+    try:
+        yield
+    finally:
+        _current_tenant.reset(token)
+
+
+def count_error(dependency):
+    """Ошибка, которую вызывающий код перехватил сам (без исключения из span)."""
+    DEPENDENCY_ERRORS.inc(dependency, _current_stage.get(), _current_tenant.get())
+
+
+def count_retry(dependency):
+    DEPENDENCY_RETRIES.inc(dependency, _current_stage.get(), _current_tenant.get())
+
+
+@contextmanager
+def track_event(stage, log=logger):
+    """Оборачивает обработку одного события; в конце пишет структурированную строку таймингов.
+
+    Внутрь передается словарь, куда код кладет "status" — HTTP-код результата.
+    """
+    stage_token = _current_stage.set(stage or "unknown")
+    timings = {}
+    timings_token = _current_timings.set(timings)
+    result = {"status": "exception"}
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        elapsed = time.perf_counter() - started
+        _current_timings.reset(timings_token)
+        _current_stage.reset(stage_token)
+        tenant = _current_tenant.get()
+        EVENT_SECONDS.observe(elapsed, stage or "unknown", tenant)
+        EVENTS.inc(stage or "unknown", str(result["status"]), tenant)
+        log.info("event_timing " + json.dumps({
+            "stage": stage,
+            "tenant": tenant,
+            "status": result["status"],
+            "total_ms": round(elapsed * 1000, 1),
+            "spans_ms": {name: round(value * 1000, 1) for name, value in timings.items()},
+        }, ensure_ascii=False))
@@ -2,11 +2,16 @@ import os
 import json
 from flask import Flask, request, jsonify
 import openai
-import requests
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import pandas as pd
 
+from catalog_cache import CatalogCache
+from catalog_index import CatalogIndex
+from customer_writer import CustomerWriteBuffer, open_orders_worksheet
+from prompt_templates import PromptBook, UnknownStageError, compile_sales_prompts
+from waha_client import WahaClient
+
 # --- 1. ИНИЦИАЛИЗАЦИЯ И НАСТРОЙКА ---
 
 app = Flask(__name__)
@@ -20,6 +25,16 @@ except Exception as e:
     app.logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось загрузить knowledge_base.json: {e}")
     knowledge_base = {}
 
+# Статические части промптов собираются один раз, при вызове подставляется только контекст
+try:
+    prompt_book = compile_sales_prompts(knowledge_base)
+except ValueError as e:
+    app.logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Некорректный шаблон в базе знаний: {e}")
+    prompt_book = PromptBook({})
+missing_scenarios = prompt_book.missing(["after_purchase_upsell"])
+if missing_scenarios:
+    app.logger.error(f"В базе знаний нет сценариев: {', '.join(missing_scenarios)}")
+
 # Валидация и загрузка переменных окружения
 REQUIRED_VARS = [
     "OPENAI_API_KEY", "WAHA_API_ENDPOINT", "WAHA_SESSION_ID",
@@ -34,6 +49,12 @@ WAHA_API_ENDPOINT = os.environ["WAHA_API_ENDPOINT"]
 WAHA_SESSION_ID = os.environ["WAHA_SESSION_ID"]
 GOOGLE_SHEET_URL = os.environ["GOOGLE_SHEET_URL"]
 SERVICE_ACCOUNT_KEY_JSON = os.environ["SERVICE_ACCOUNT_KEY_JSON"]
+CATALOG_CACHE_TTL = int(os.environ.get("CATALOG_CACHE_TTL", 300))  # секунды
+CUSTOMER_WRITE_BATCH = int(os.environ.get("CUSTOMER_WRITE_BATCH", 50))  # клиентов в одном пакете
+CUSTOMER_WRITE_INTERVAL = float(os.environ.get("CUSTOMER_WRITE_INTERVAL", 2.0))  # секунды между сбросами
+WAHA_POOL_SIZE = int(os.environ.get("WAHA_POOL_SIZE", 10))  # keep-alive соединений к WAHA
+WAHA_MAX_RETRIES = int(os.environ.get("WAHA_MAX_RETRIES", 3))  # повторов на 429/5xx
+WAHA_RATE_LIMIT = float(os.environ.get("WAHA_RATE_LIMIT", 20))  # сообщений в секунду на сессию
 
 # Инициализация OpenAI
 openai.api_key = OPENAI_API_KEY
@@ -46,96 +67,82 @@ try:
     creds = ServiceAccountCredentials.from_json_keyfile_dict(key_dict, scope)
     gspread_client = gspread.authorize(creds)
     
-    products_sheet = gspread_client.open_by_url(GOOGLE_SHEET_URL).worksheet("products")
-    customers_sheet = gspread_client.open_by_url(GOOGLE_SHEET_URL).worksheet("customers")
+    # Одна загрузка метаданных таблицы на оба листа
+    spreadsheet = gspread_client.open_by_url(GOOGLE_SHEET_URL)
+    products_sheet = spreadsheet.worksheet("products")
+    customers_sheet = spreadsheet.worksheet("customers")
     app.logger.info("Успешное подключение к Google Таблице (листы products и customers).")
 except Exception as e:
     app.logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к Google Таблице: {e}")
-    products_sheet, customers_sheet = None, None
+    spreadsheet, products_sheet, customers_sheet = None, None, None
+
+# История заказов только дописывается в отдельный лист; без него — по-старому, в колонку D
+orders_sheet = None
+if customers_sheet:
+    try:
+        orders_sheet = open_orders_worksheet(spreadsheet)
+    except Exception as e:
+        app.logger.error(f"Не удалось открыть лист orders, история заказов пишется в колонку D: {e}")
 
 # --- 2. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
-def get_all_products_from_sheet():
-    """Загружает все товары из Google Таблицы."""
+def load_products_from_sheet():
+    """Читает все товары из Google Таблицы (сетевой вызов, используется кэшем)."""
+    all_records = products_sheet.get_all_records()
+    df = pd.DataFrame(all_records)
+    if 'SKU' in df.columns:
+        df['SKU'] = df['SKU'].astype(str)
+    return df
+
+def load_catalog():
+    """Загружает каталог и строит индексы по SKU и категориям."""
+    return CatalogIndex(load_products_from_sheet())
+
+# Общий для процесса кэш каталога: чтение таблицы не попадает на горячий путь
+catalog_cache = CatalogCache(load_catalog, ttl=CATALOG_CACHE_TTL)
+if products_sheet:
+    catalog_cache.refresh(wait=False)
+
+def get_catalog():
+    """Возвращает проиндексированный каталог из кэша."""
     if not products_sheet:
         app.logger.error("Нет подключения к Google Таблице, поиск товаров невозможен.")
-        return pd.DataFrame()
+        return CatalogIndex()
     try:
-        all_records = products_sheet.get_all_records()
-        df = pd.DataFrame(all_records)
-        if 'SKU' in df.columns:
-            df['SKU'] = df['SKU'].astype(str)
-        return df
+        return catalog_cache.get()
     except Exception as e:
         app.logger.error(f"Ошибка при чтении данных из Google Таблицы: {e}")
-        return pd.DataFrame()
-
-def check_availability_and_get_stock(product_row):
-    """Проверяет наличие товара по колонкам PP1-PP5 и возвращает общее количество."""
-    stock_count = 0
-    is_available = False
-    for i in range(1, 6):
-        stock_value = str(product_row.get(f'PP{i}', 'no')).lower().strip()
-        if stock_value != 'no' and stock_value.isdigit():
-            count = int(stock_value)
-            if count > 0:
-                is_available = True
-                stock_count += count
-    
-    if is_available:
-        return stock_count
-    return 0
+        return CatalogIndex()
+
+# Отложенная пакетная запись в лист customers: вебхук не ждет запросов к Sheets API
+customer_writer = CustomerWriteBuffer(
+    customers_sheet, max_batch=CUSTOMER_WRITE_BATCH, flush_interval=CUSTOMER_WRITE_INTERVAL,
+    orders_worksheet=orders_sheet
+) if customers_sheet else None
 
 def update_customer_data(customer_info, order_info):
-    """Находит клиента в таблице customers, обновляет или создает его."""
-    if not customers_sheet:
+    """Ставит обновление или создание клиента в буфер записи листа customers."""
+    if not customer_writer:
         app.logger.error("Нет подключения к листу 'customers'.")
         return
-    
+
     try:
         phone = str(customer_info['phone'])
-        cell = customers_sheet.find(phone, in_column=1) # Ищем телефон в первой колонке (A)
-        
-        current_stage = "POST_PURCHASE"
-
-        if cell: # Если клиент найден, обновляем
-            row_index = cell.row
-            old_history_str = customers_sheet.cell(row_index, 4).value or '[]'
-            try:
-                order_history = json.loads(old_history_str)
-            except json.JSONDecodeError:
-                order_history = []
-            order_history.append(order_info)
-            
-            customers_sheet.update_cell(row_index, 2, customer_info.get('name', ''))
-            customers_sheet.update_cell(row_index, 3, current_stage)
-            customers_sheet.update_cell(row_index, 4, json.dumps(order_history, ensure_ascii=False))
-            app.logger.info(f"Обновлены данные для клиента {phone}")
-        else: # Если клиент не найден, создаем новую строку
-            new_row = [
-                phone,
-                customer_info.get('name', ''),
-                current_stage,
-                json.dumps([order_info], ensure_ascii=False)
-            ]
-            customers_sheet.append_row(new_row)
-            app.logger.info(f"Создана новая запись для клиента {phone}")
+        customer_writer.update(phone, customer_info.get('name', ''), "POST_PURCHASE", order_info)
+        app.logger.info(f"Данные клиента {phone} поставлены в очередь на запись")
     except Exception as e:
         app.logger.error(f"Ошибка при обновлении данных клиента в Google Таблице: {e}")
 
+# Один клиент WAHA на процесс: keep-alive соединения, повторы и ограничение частоты
+waha_client = WahaClient(
+    f"{WAHA_API_ENDPOINT.rstrip('/')}/api/v1/sessions/{WAHA_SESSION_ID}/messages/text",
+    lambda phone, text: {"chatId": f"{phone}@c.us", "text": text},
+    pool_size=WAHA_POOL_SIZE, max_retries=WAHA_MAX_RETRIES, rate_limit=WAHA_RATE_LIMIT
+)
+
 def send_waha_message(phone, text):
     """Отправляет сообщение через WhatsApp HTTP API (WAHA)."""
-    url = f"{WAHA_API_ENDPOINT.rstrip('/')}/api/v1/sessions/{WAHA_SESSION_ID}/messages/text"
-    payload = {"chatId": f"{phone}@c.us", "text": text}
-    headers = {"Content-Type": "application/json"}
-    try:
-        response = requests.post(url, json=payload, headers=headers, timeout=15)
-        response.raise_for_status()
-        app.logger.info("WAHA message sent to %s", phone)
-        return True
-    except requests.exceptions.RequestException as e:
-        app.logger.error("WAHA send error: %s", e)
-        return False
+    return waha_client.send(phone, text)
 
 def get_openai_response(prompt, model="gpt-4o"):
     """Получает ответ от OpenAI."""
@@ -154,26 +161,8 @@ def get_openai_response(prompt, model="gpt-4o"):
         return "Приносим извинения, произошла техническая ошибка."
 
 def build_prompt_from_kb(stage_id, context):
-    """Создает 'супер-промпт' для OpenAI на основе базы знаний."""
-    scenario = knowledge_base.get("scenarios", {}).get(stage_id)
-    if not scenario:
-        return f"Ошибка: Сценарий для этапа '{stage_id}' не найден в базе знаний."
-
-    prompt_parts = [
-        "ТЫ — ИИ-продажник. Сгенерируй ответ для клиента, строго следуя приведенным ниже инструкциям.",
-        f"\n--- СЦЕНАРИЙ: {scenario.get('description', 'Без описания')} ---",
-        "Твои действия и фразы должны быть основаны на этом скрипте:",
-        "\n".join(f"- {line}" for line in scenario.get("script", [])),
-        "\n--- ОБЩИЕ ПРАВИЛА КОММУНИКАЦИИ ---",
-        "Всегда придерживайся этих правил:",
-        "\n".join(f"- {rule}" for rule in knowledge_base.get("rules", {}).get("general", [])),
-        "\n--- КОНТЕКСТ ДИАЛОГА ---",
-        "Вот информация о текущей ситуации:",
-        "\n".join(f"- {key}: {value}" for key, value in context.items()),
-        "\n--- ТВОЯ ЗАДАЧА ---",
-        "Сгенерируй ОДНО готовое сообщение для отправки клиенту. Не задавай уточняющих вопросов мне, а сразу пиши финальный текст."
-    ]
-    return "\n".join(prompt_parts)
+    """Создает 'супер-промпт' для OpenAI из скомпилированного шаблона сценария."""
+    return prompt_book.render(stage_id, context)
 
 # --- 3. ЛОГИКА ДЛЯ ЭТАПОВ ВОРОНКИ ---
 
@@ -191,40 +180,31 @@ def handle_upsell_logic(data):
     # Логика допродажи на основе категории товара
     purchased_sku = order_info.get('sku')
     if purchased_sku:
-        all_products_df = get_all_products_from_sheet()
-        if not all_products_df.empty:
-            purchased_product = all_products_df[all_products_df['SKU'] == str(purchased_sku)]
-            
-            if not purchased_product.empty:
-                category = purchased_product.iloc[0].get('category')
-                
-                if category:
-                    same_category_products = all_products_df[
-                        (all_products_df['category'] == category) &
-                        (all_products_df['SKU'] != str(purchased_sku))
-                    ]
-
-                    recommended_products = []
-                    # Проверяем наличие и отбираем до 5 товаров
-                    for index, row in same_category_products.head(5).iterrows():
-                        stock = check_availability_and_get_stock(row)
-                        if stock > 0:
-                            product_info = row.to_dict()
-                            product_info['total_stock'] = stock
-                            recommended_products.append(product_info)
-                    
-                    if recommended_products:
-                        # Формируем текст с рекомендациями (не более 3-х)
-                        recommendations_text = ""
-                        for prod in recommended_products[:3]:
-                            recommendations_text += f"\n- {prod['model']} (Цена: {prod['price']} KZT"
-                            if prod['total_stock'] <= 3:
-                                recommendations_text += f", осталось всего {prod['total_stock']} шт.!"
-                            recommendations_text += ")"
-                        
-                        context = {"Клиент": customer_info.get('name'), "Купленный товар": order_info.get('product_name'), "Рекомендации": recommendations_text}
+        catalog = get_catalog()
+        purchased_product = catalog.get_product(purchased_sku)
+
+        if purchased_product:
+            category = purchased_product.get('category')
+
+            if category:
+                # Товары категории в наличии, уже отсортированные индексом
+                recommended_products = catalog.recommendations(category, exclude_sku=purchased_sku, limit=3)
+
+                if recommended_products:
+                    # Формируем текст с рекомендациями (не более 3-х)
+                    recommendations_text = ""
+                    for prod in recommended_products:
+                        recommendations_text += f"\n- {prod['model']} (Цена: {prod['price']} KZT"
+                        if prod['total_stock'] <= 3:
+                            recommendations_text += f", осталось всего {prod['total_stock']} шт.!"
+                        recommendations_text += ")"
+
+                    context = {"Клиент": customer_info.get('name'), "Купленный товар": order_info.get('product_name'), "Рекомендации": recommendations_text}
+                    try:
                         prompt = build_prompt_from_kb("after_purchase_upsell", context)
-                        
+                    except UnknownStageError as e:
+                        app.logger.error(f"Допродажа пропущена: {e}")
+                    else:
                         ai_message = get_openai_response(prompt)
                         send_waha_message(phone, ai_message)
                         return jsonify({"status": "success", "action": "upsell_sent"})
@@ -240,6 +220,27 @@ def index():
     """Простой эндпоинт для проверки, что сервис работает."""
     return "AI Sales Agent is running!", 200
 
+@app.route("/catalog/refresh", methods=["POST"])
+def catalog_refresh():
+    """Принудительно перечитывает каталог из Google Таблицы."""
+    try:
+        catalog_cache.refresh()
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e), "cache": catalog_cache.stats()}), 502
+    return jsonify({"status": "success", "cache": catalog_cache.stats()})
+
+@app.route("/catalog/stats")
+def catalog_stats():
+    """Счетчики попаданий и промахов кэша каталога."""
+    return jsonify(catalog_cache.stats())
+
+@app.route("/customers/stats")
+def customers_stats():
+    """Глубина очереди и счетчики отложенной записи клиентов."""
+    if not customer_writer:
+        return jsonify({"status": "error", "message": "Нет подключения к листу customers"}), 503
+    return jsonify(customer_writer.stats())
+
 @app.route("/event_handler", methods=["POST"])
 def event_handler():
     event_data = request.get_json(force=True, silent=True)
@@ -0,0 +1,164 @@
+import re
+
+_PLACEHOLDER = re.compile(r"\{([^{}\n]+)\}")
+
+# Ключи контекста, которые код передает в промпты
+CONTEXT_KEYS = frozenset({"Клиент", "Купленный товар", "Рекомендации"})
+
+# Способы подготовки сообщения: готовый шаблон без LLM, быстрая модель, полная модель
+RENDER_POLICIES = ("template", "fast", "full")
+DEFAULT_RENDER_POLICY = "full"
+
+
+class UnknownStageError(KeyError):
+    """В базе знаний нет сценария для запрошенного этапа."""
+
+
+class PromptTemplate:
+    """Промпт сценария, разобранный один раз при загрузке базы знаний.
+
+    Статическая часть хранится готовыми строками, при вызове render()
+    подставляется только контекст. Если context_block задан, ключи
+    контекста, которых нет среди плейсхолдеров текста, выводятся списком
+    "- ключ: значение" после block_header, а затем идет suffix.
+    """
+
+    def __init__(self, stage_id, parts, context_block=False, suffix="", block_header=""):
+        self.stage_id = stage_id
+        self.parts = parts
+        self.context_block = context_block
+        self.suffix = suffix
+        self.block_header = block_header
+        self.keys = frozenset(key for _, key in parts if key is not None)
+
+    @property
+    def prefix(self):
+        """Неизменная между вызовами начальная часть промпта."""
+        return self.parts[0][0] if self.parts else ""
+
+    def render(self, context):
+        chunks = []
+        for literal, key in self.parts:
+            chunks.append(literal)
+            if key is not None:
+                chunks.append(str(context[key]) if key in context else f"{{{key}}}")
+        if self.context_block:
+            lines = [f"- {key}: {value}" for key, value in context.items() if key not in self.keys]
+            if lines:
+                chunks.append(self.block_header)
+                chunks.append("\n".join(lines))
+            chunks.append(self.suffix)
+        return "".join(chunks)
+
+
+class RenderPolicy:
+    """Политика сценария из поля "rendering" базы знаний.
+
+    Для "template" сообщение целиком задается шаблоном (template), LLM не
+    вызывается; для "fast"/"full" model переопределяет модель по умолчанию.
+    """
+
+    def __init__(self, stage_id, name=DEFAULT_RENDER_POLICY, template=None, model=None):
+        self.stage_id = stage_id
+        self.name = name
+        self.template = template
+        self.model = model
+
+
+class PromptBook:
+    """Набор скомпилированных промптов и политик рендеринга по id этапа."""
+
+    def __init__(self, templates, policies=None):
+        self.templates = templates
+        self.policies = policies or {}
+
+    def policy(self, stage_id):
+        if stage_id not in self.templates:
+            raise UnknownStageError(f"Сценарий для этапа '{stage_id}' не найден в базе знаний")
+        return self.policies.get(stage_id) or RenderPolicy(stage_id)
+
+    def __contains__(self, stage_id):
+        return stage_id in self.templates
+
+    def missing(self, stage_ids):
+        return [stage_id for stage_id in stage_ids if stage_id not in self.templates]
+
+    def render(self, stage_id, context):
+        template = self.templates.get(stage_id)
+        if template is None:
+            raise UnknownStageError(f"Сценарий для этапа '{stage_id}' не найден в базе знаний")
+        return template.render(context)
+
+
+def _parse(stage_id, text, placeholders):
+    """Разбивает текст на пары (литерал, плейсхолдер) и проверяет плейсхолдеры."""
+    parts, position = [], 0
+    for match in _PLACEHOLDER.finditer(text):
+        key = match.group(1)
+        if placeholders is not None and key not in placeholders:
+            raise ValueError(f"Сценарий '{stage_id}': неизвестный плейсхолдер {{{key}}}")
+        parts.append((text[position:match.start()], key))
+        position = match.end()
+    parts.append((text[position:], None))
+    return parts
+
+
+def compile_render_policies(knowledge_base, placeholders=CONTEXT_KEYS):
+    """Разбирает поля "rendering" сценариев; ошибки в них ловятся при загрузке."""
+    policies = {}
+    for stage_id, scenario in knowledge_base.get("scenarios", {}).items():
+        rendering = scenario.get("rendering") or {}
+        name = rendering.get("policy", DEFAULT_RENDER_POLICY)
+        if name not in RENDER_POLICIES:
+            raise ValueError(f"Сценарий '{stage_id}': неизвестная политика рендеринга '{name}'")
+        template = None
+        if name == "template":
+            if not rendering.get("template"):
+                raise ValueError(f"Сценарий '{stage_id}': для политики 'template' нужен текст шаблона")
+            template = PromptTemplate(stage_id, _parse(stage_id, rendering["template"], placeholders))
+        policies[stage_id] = RenderPolicy(stage_id, name, template, rendering.get("model"))
+    return policies
+
+
+def compile_script_templates(knowledge_base, placeholders=CONTEXT_KEYS):
+    """Скрипт сценария с подстановкой {ключей} контекста прямо в текст.
+
+    Ключи контекста, которые скрипт не упоминает, дописываются блоком после
+    скрипта — иначе имя клиента, товар и рекомендации не дошли бы до модели.
+    """
+    templates = {}
+    for stage_id, scenario in knowledge_base.get("scenarios", {}).items():
+        text = "\n".join(scenario.get("script", []))
+        templates[stage_id] = PromptTemplate(
+            stage_id, _parse(stage_id, text, placeholders), context_block=True,
+            block_header="\n\n--- КОНТЕКСТ ДИАЛОГА ---\n")
+    return PromptBook(templates, compile_render_policies(knowledge_base, placeholders))
+
+
+def compile_sales_prompts(knowledge_base, placeholders=CONTEXT_KEYS):
+    """'Супер-промпт': сценарий и общие правила, затем блок контекста и задача."""
+    rules = "\n".join(f"- {rule}" for rule in knowledge_base.get("rules", {}).get("general", []))
+    suffix = "\n".join([
+        "",
+        "\n--- ТВОЯ ЗАДАЧА ---",
+        "Сгенерируй ОДНО готовое сообщение для отправки клиенту. Не задавай уточняющих вопросов мне, а сразу пиши финальный текст."
+    ])
+    templates = {}
+    for stage_id, scenario in knowledge_base.get("scenarios", {}).items():
+        script = "\n".join(f"- {line}" for line in scenario.get("script", []))
+        # Плейсхолдеры в этом формате не подставляются, но опечатки в них ловим сразу
+        _parse(stage_id, script, placeholders)
+        prefix = "\n".join([
+            "ТЫ — ИИ-продажник. Сгенерируй ответ для клиента, строго следуя приведенным ниже инструкциям.",
+            f"\n--- СЦЕНАРИЙ: {scenario.get('description', 'Без описания')} ---",
+            "Твои действия и фразы должны быть основаны на этом скрипте:",
+            script,
+            "\n--- ОБЩИЕ ПРАВИЛА КОММУНИКАЦИИ ---",
+            "Всегда придерживайся этих правил:",
+            rules,
+            "\n--- КОНТЕКСТ ДИАЛОГА ---",
+            "Вот информация о текущей ситуации:",
+            "",
+        ])
+        templates[stage_id] = PromptTemplate(stage_id, [(prefix, None)], context_block=True, suffix=suffix)
+    return PromptBook(templates, compile_render_policies(knowledge_base, placeholders))
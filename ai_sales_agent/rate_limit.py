@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_STATUS_CODES = {429}
+
+
+class RateLimited(Exception):
+    """Квота зависимости исчерпана: ждать дольше max_wait не стали."""
+
+
+class TokenBucket:
+    """Простой ограничитель частоты: не больше rate запросов в секунду."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        """Берет токены, если они есть; иначе возвращает, сколько секунд ждать."""
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate = rate
+
+
+def rate_limit_info(exc):
+    """(True, Retry-After в секундах или None), если исключение — ответ 429 от API.
+
+    Понимает gspread.exceptions.APIError и openai.RateLimitError: у обоих есть
+    response со status_code и заголовками.
+    """
+    response = getattr(exc, "response", None)
+    status_code = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+    if status_code not in RATE_LIMIT_STATUS_CODES:
+        return False, None
+    headers = getattr(response, "headers", None) or {}
+    try:
+        retry_after = float(headers.get("Retry-After") or headers.get("retry-after") or 0) or None
+    except (TypeError, ValueError):
+        retry_after = None
+    return True, retry_after
+
+
+class AdaptiveRateLimiter:
+    """Общий ограничитель частоты для одной внешней зависимости (квоты Sheets, OpenAI).
+
+    Вызовы ждут своей очереди в token bucket, но не дольше max_wait секунд —
+    иначе RateLimited. Ответ 429 ставит зависимость на паузу (по Retry-After
+    или экспоненциально) и вдвое снижает частоту; каждый успешный вызов
+    понемногу возвращает ее к настроенной rate. Так под пиковой нагрузкой
+    запросы замедляются, а не падают.
+    """
+
+    def __init__(self, name, rate, burst=None, max_wait=30.0, max_retries=3,
+                 backoff=1.0, max_backoff=60.0, min_rate=None, recovery=0.05):
+        self.name = name
+        self.base_rate = rate
+        self.min_rate = min_rate or rate / 10
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.recovery = recovery
+        self._bucket = TokenBucket(rate, burst)
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._consecutive_throttles = 0
+        self.acquired = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.waiting = 0
+        self.wait_seconds = 0.0
+
+    @property
+    def rate(self):
+        return self._bucket.rate
+
+    def _reserve(self, tokens, deadline):
+        """Секунды до следующей попытки (0 — токены взяты); RateLimited после deadline."""
+        now = time.monotonic()
+        wait = max(0.0, self._paused_until - now) or self._bucket.try_acquire(tokens)
+        if wait and now + wait > deadline:
+            with self._lock:
+                self.rejected += 1
+            raise RateLimited(f"{self.name}: квота исчерпана, ожидание дольше {self.max_wait} с")
+        return wait
+
+    def _begin_wait(self):
+        with self._lock:
+            self.waiting += 1
+        return time.monotonic()
+
+    def _end_wait(self, started, acquired):
+        with self._lock:
+            self.waiting -= 1
+            self.acquired += acquired
+            self.wait_seconds += time.monotonic() - started
+
+    def acquire(self, tokens=1):
+        """Ждет разрешения на вызов (не дольше max_wait)."""
+        started = self._begin_wait()
+        deadline = started + self.max_wait
+        acquired = False
+        try:
+            while True:
+                wait = self._reserve(tokens, deadline)
+                if not wait:
+                    acquired = True
+                    return
+                time.sleep(wait)
+        finally:
+            self._end_wait(started, acquired)
+
+    async def acquire_async(self, tokens=1):
+        started = self._begin_wait()
+        deadline = started + self.max_wait
+        acquired = False
+        try:
+            while True:
+                wait = self._reserve(tokens, deadline)
+                if not wait:
+                    acquired = True
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            self._end_wait(started, acquired)
+
+    def on_throttled(self, retry_after=None):
+        """Учитывает ответ 429: пауза и снижение частоты."""
+        with self._lock:
+            self.throttled += 1
+            self._consecutive_throttles += 1
+            if retry_after is None:
+                delay = min(self.backoff * (2 ** (self._consecutive_throttles - 1)), self.max_backoff)
+                retry_after = delay + random.uniform(0, delay / 2)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            new_rate = max(self.min_rate, self._bucket.rate / 2)
+        self._bucket.set_rate(new_rate)
+        logger.warning(f"{self.name}: превышена квота, пауза {retry_after:.1f} с, частота {new_rate:.2f}/с")
+
+    def on_success(self):
+        with self._lock:
+            self._consecutive_throttles = 0
+            if self._bucket.rate >= self.base_rate:
+                return
+            new_rate = min(self.base_rate, self._bucket.rate + self.base_rate * self.recovery)
+        self._bucket.set_rate(new_rate)
+
+    def call(self, func, *args, tokens=1, **kwargs):
+        """Вызывает func под ограничителем; 429 повторяется до max_retries раз."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                limited, retry_after = rate_limit_info(e)
+                if not limited:
+                    raise
+                self.on_throttled(retry_after)
+                if attempt == self.max_retries:
+                    raise RateLimited(f"{self.name}: квота исчерпана после {attempt + 1} попыток") from e
+                continue
+            self.on_success()
+            return result
+
+    async def call_async(self, func, *args, tokens=1, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self.acquire_async(tokens)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                limited, retry_after = rate_limit_info(e)
+                if not limited:
+                    raise
+                self.on_throttled(retry_after)
+                if attempt == self.max_retries:
+                    raise RateLimited(f"{self.name}: квота исчерпана после {attempt + 1} попыток") from e
+                continue
+            self.on_success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": round(self._bucket.rate, 3),
+                "base_rate": self.base_rate,
+                "max_wait": self.max_wait,
+                "acquired": self.acquired,
+                "throttled": self.throttled,
+                "rejected": self.rejected,
+                "waiting": self.waiting,
+                "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 1),
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+
+class RateLimitedWorksheet:
+    """Обертка над gspread.Worksheet: чтения и записи идут через свои ограничители.
+
+    Квоты Google Sheets считаются отдельно для чтения и записи; остальные
+    атрибуты листа, как и методы с отключенным ограничителем, передаются как есть.
+    """
+
+    READ_METHODS = {"get", "batch_get", "get_all_records", "get_all_values", "col_values", "row_values", "acell", "cell"}
+    WRITE_METHODS = {"batch_update", "update", "update_cell", "append_row", "append_rows", "delete_rows", "insert_row"}
+
+    def __init__(self, worksheet, read_limiter, write_limiter):
+        self._worksheet = worksheet
+        self._read_limiter = read_limiter
+        self._write_limiter = write_limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if name in self.READ_METHODS:
+            limiter = self._read_limiter
+        elif name in self.WRITE_METHODS:
+            limiter = self._write_limiter
+        else:
+            return attr
+        if limiter is None:
+            return attr
+
+        def limited(*args, **kwargs):
+            return limiter.call(attr, *args, **kwargs)
+        return limited
@@ -0,0 +1,128 @@
+import atexit
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SheetSync:
+    """Фоновая синхронизация LocalStore с Google Таблицей.
+
+    Раз в push_interval секунд несинхронизированные изменения клиентов
+    пачками по batch_size отправляются в лист customers через
+    write_batch(batch) (CustomerWriteBuffer.write_batch). Раз в pull_interval
+    секунд pull_catalog() перечитывает лист products, чтобы правки команды
+    в таблице попадали в локальный каталог.
+    """
+
+    def __init__(self, store, write_batch, pull_catalog, push_interval=5.0, pull_interval=300.0, batch_size=200):
+        self.store = store
+        self.write_batch = write_batch
+        self.pull_catalog = pull_catalog
+        self.push_interval = push_interval
+        self.pull_interval = pull_interval
+        self.batch_size = batch_size
+        self._push_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.pushes = 0
+        self.pushed_customers = 0
+        self.pushed_orders = 0
+        self.pulls = 0
+        self.errors = 0
+        self.last_push_at = None
+        self.last_pull_at = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sheet-sync", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Останавливает фоновый поток; он успевает отправить последние изменения."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=self.push_interval + 5)
+
+    def push(self):
+        """Отправляет в таблицу все накопленные изменения; возвращает число клиентов."""
+        total = 0
+        with self._push_lock:
+            while True:
+                changes = self.store.pending_changes(self.batch_size)
+                if not changes:
+                    break
+                batch = {phone: {"name": change["name"], "stage": change["stage"], "orders": list(change["orders"])}
+                         for phone, change in changes.items()}
+                try:
+                    self.write_batch(batch)
+                except Exception:
+                    # write_batch убирает из batch уже записанных клиентов — их повторно не отправляем;
+                    # у оставшихся заказы могли уже уйти в лист orders (список orders очищен)
+                    written = {}
+                    for phone, change in changes.items():
+                        if phone not in batch:
+                            written[phone] = change
+                        elif change["order_ids"] and not batch[phone]["orders"]:
+                            written[phone] = dict(change, version=0)
+                    if written:
+                        self.store.mark_synced(written)
+                    raise
+                self.store.mark_synced(changes)
+                self.pushes += 1
+                self.pushed_customers += len(changes)
+                self.pushed_orders += sum(len(change["order_ids"]) for change in changes.values())
+                total += len(changes)
+                if len(changes) < self.batch_size:
+                    break
+            self.last_push_at = time.time()
+        return total
+
+    def pull(self):
+        """Перечитывает каталог из листа products; возвращает число товаров."""
+        count = self.pull_catalog()
+        self.pulls += 1
+        self.last_pull_at = time.time()
+        return count
+
+    def stats(self):
+        return {
+            "pending_customers": self.store.pending_count(),
+            "products": self.store.product_count(),
+            "pushes": self.pushes,
+            "pushed_customers": self.pushed_customers,
+            "pushed_orders": self.pushed_orders,
+            "pulls": self.pulls,
+            "errors": self.errors,
+            "last_push_at": self.last_push_at,
+            "last_pull_at": self.last_pull_at,
+            "push_interval": self.push_interval,
+            "pull_interval": self.pull_interval,
+        }
+
+    def _run(self):
+        next_pull = time.monotonic()
+        while not self._stopped:
+            if time.monotonic() >= next_pull:
+                try:
+                    self.pull()
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"Не удалось обновить каталог из таблицы: {e}")
+                next_pull = time.monotonic() + self.pull_interval
+            try:
+                self.push()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Не удалось отправить изменения клиентов в таблицу, повтор позже: {e}")
+            self._wakeup.wait(self.push_interval)
+            self._wakeup.clear()
+        try:
+            self.push()
+        except Exception as e:
+            logger.error(f"Изменения клиентов не отправлены при остановке: {e}")
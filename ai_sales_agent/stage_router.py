@@ -0,0 +1,103 @@
+import threading
+import time
+from contextlib import nullcontext
+
+# Цены OpenAI, USD за 1M токенов: (вход, выход)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+
+class StageRouter:
+    """Готовит сообщение этапа по политике сценария из базы знаний.
+
+    "template" — текст из шаблона сценария без обращения к LLM; "fast" и
+    "full" — промпт сценария отправляется в быструю или полную модель
+    (models[policy], если в сценарии не указана своя). complete(prompt,
+    model=..., scenario=..., customer_name=..., usage=...) — синхронный вызов
+    LLM, complete_async — его асинхронный вариант; в usage вызов кладет
+    prompt_tokens, completion_tokens и cached. По каждой политике считаются
+    вызовы, время, токены и стоимость.
+    """
+
+    def __init__(self, knowledge_base, complete, models, complete_async=None, prices=MODEL_PRICES, span=None):
+        self.knowledge_base = knowledge_base
+        self.complete = complete
+        self.complete_async = complete_async
+        self.models = models
+        self.prices = prices
+        self._span = span or (lambda name: nullcontext())
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def render(self, stage_id, context, customer_name=None, **kwargs):
+        """Текст сообщения; UnknownStageError, если сценария нет в базе знаний."""
+        policy, prompt, model = self._plan(stage_id, context)
+        started = time.perf_counter()
+        usage = {}
+        with self._span(f"render.{policy.name}"):
+            if model is None:
+                text = prompt
+            else:
+                text = self.complete(prompt, model=model, scenario=stage_id, customer_name=customer_name,
+                                     usage=usage, **kwargs)
+        self._record(policy.name, model, usage, time.perf_counter() - started)
+        return text
+
+    async def render_async(self, stage_id, context, customer_name=None, **kwargs):
+        policy, prompt, model = self._plan(stage_id, context)
+        started = time.perf_counter()
+        usage = {}
+        with self._span(f"render.{policy.name}"):
+            if model is None:
+                text = prompt
+            else:
+                text = await self.complete_async(prompt, model=model, scenario=stage_id,
+                                                 customer_name=customer_name, usage=usage, **kwargs)
+        self._record(policy.name, model, usage, time.perf_counter() - started)
+        return text
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for name, item in self._stats.items():
+                result[name] = dict(item)
+                result[name]["mean_seconds"] = round(item["seconds"] / item["calls"], 4) if item["calls"] else 0.0
+                result[name]["seconds"] = round(item["seconds"], 3)
+                result[name]["cost_usd"] = round(item["cost_usd"], 6)
+            return result
+
+    def _plan(self, stage_id, context):
+        """(политика, готовый текст или промпт, модель или None для шаблона)."""
+        snapshot = self.knowledge_base.snapshot()
+        policy = snapshot.prompts.policy(stage_id)
+        if policy.name == "template":
+            # Текст уходит клиенту как есть: пустые значения не должны превращаться в "None"
+            values = {key: "" if value is None else value for key, value in context.items()}
+            return policy, policy.template.render(values), None
+        prompt = snapshot.prompts.render(stage_id, context)
+        return policy, prompt, policy.model or self.models[policy.name]
+
+    def _record(self, policy_name, model, usage, elapsed):
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        cost = 0.0
+        if model and not usage.get("cached"):
+            input_price, output_price = self.prices.get(model, (0.0, 0.0))
+            cost = (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+        with self._lock:
+            item = self._stats.setdefault(policy_name, {
+                "calls": 0, "llm_calls": 0, "cached": 0, "seconds": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0,
+            })
+            item["calls"] += 1
+            item["seconds"] += elapsed
+            if model:
+                if usage.get("cached"):
+                    item["cached"] += 1
+                else:
+                    item["llm_calls"] += 1
+                    item["prompt_tokens"] += prompt_tokens
+                    item["completion_tokens"] += completion_tokens
+                    item["cost_usd"] += cost
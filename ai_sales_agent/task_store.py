@@ -0,0 +1,173 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    run_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_due ON tasks (status, run_at);
+"""
+
+
+class DelayedTaskStore:
+    """Долговечное хранилище отложенных задач на SQLite.
+
+    Задачи лежат на диске с индексом по времени запуска, в памяти находятся
+    только те, что выполняются прямо сейчас. Фоновый поток выбирает из базы
+    ближайшую пачку созревших задач (не больше числа свободных воркеров) и
+    спит до следующего срока. Задачи, просроченные за время простоя, и
+    прерванные падением процесса выполняются после старта с той же
+    ограниченной параллельностью. Задача, упершаяся в квоту (RateLimited),
+    откладывается на throttle_delay секунд без траты попытки.
+    """
+
+    def __init__(self, path, handlers, max_workers=4, poll_interval=5.0,
+                 max_attempts=3, retry_delay=300, throttle_delay=60):
+        self.path = path
+        self.handlers = handlers
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.throttle_delay = throttle_delay
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_workers)
+        self._wakeup = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="delayed-task")
+        self._thread = None
+        self._stopped = False
+        self.completed = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def start(self):
+        with self._lock:
+            # Задачи, которые выполнялись в момент падения, возвращаем в очередь
+            self._conn.execute("UPDATE tasks SET status = 'pending' WHERE status = 'running'")
+        self._thread = threading.Thread(target=self._run, name="delayed-task-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._executor.shutdown(wait=True)
+
+    def schedule(self, task_type, payload, delay_seconds=0):
+        """Сохраняет задачу на диск; возвращает ее id."""
+        if task_type not in self.handlers:
+            raise ValueError(f"Неизвестный тип задачи: {task_type}")
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO tasks (task_type, payload, run_at, created_at) VALUES (?, ?, ?, ?)",
+                (task_type, json.dumps(payload, ensure_ascii=False), now + delay_seconds, now),
+            )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tasks WHERE status = 'pending'").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+            next_run = self._conn.execute(
+                "SELECT MIN(run_at) FROM tasks WHERE status = 'pending'").fetchone()[0]
+        return {
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "failed_permanently": counts.get("failed", 0),
+            "completed": self.completed,
+            "failed_attempts": self.failed,
+            "deferred_throttled": self.deferred,
+            "next_run_in_seconds": round(next_run - time.time(), 1) if next_run else None,
+        }
+
+    def _claim_due(self, limit):
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, task_type, payload, attempts FROM tasks "
+                "WHERE status = 'pending' AND run_at <= ? ORDER BY run_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            if rows:
+                self._conn.executemany(
+                    "UPDATE tasks SET status = 'running' WHERE id = ?", [(row[0],) for row in rows])
+            next_run = self._conn.execute(
+                "SELECT MIN(run_at) FROM tasks WHERE status = 'pending'").fetchone()[0]
+        return rows, next_run
+
+    def _run(self):
+        while not self._stopped:
+            # Берем из базы не больше задач, чем есть свободных воркеров
+            self._slots.acquire()
+            free = 1
+            while free < self.max_workers and self._slots.acquire(blocking=False):
+                free += 1
+            try:
+                rows, next_run = self._claim_due(free)
+            except Exception as e:
+                logger.error(f"Ошибка чтения отложенных задач: {e}")
+                rows, next_run = [], None
+            for _ in range(free - len(rows)):
+                self._slots.release()
+            for row in rows:
+                self._executor.submit(self._execute, *row)
+            if len(rows) == free:
+                continue
+            timeout = self.poll_interval
+            if next_run is not None:
+                timeout = max(0.0, min(timeout, next_run - time.time()))
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def _execute(self, task_id, task_type, payload, attempts):
+        try:
+            self.handlers[task_type](json.loads(payload))
+        except RateLimited as e:
+            # Квота освободится сама: откладываем задачу, попытку не списываем
+            self.deferred += 1
+            logger.warning(f"Отложенная задача {task_id} ({task_type}) упёрлась в квоту, "
+                           f"повтор через {self.throttle_delay} с: {e}")
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE tasks SET status = 'pending', last_error = ?, run_at = ? WHERE id = ?",
+                    (str(e), time.time() + self.throttle_delay, task_id),
+                )
+        except Exception as e:
+            self.failed += 1
+            attempts += 1
+            status = "failed" if attempts >= self.max_attempts else "pending"
+            logger.error(f"Отложенная задача {task_id} ({task_type}) завершилась ошибкой, попытка {attempts}: {e}")
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE tasks SET status = ?, attempts = ?, last_error = ?, run_at = ? WHERE id = ?",
+                    (status, attempts, str(e), time.time() + self.retry_delay, task_id),
+                )
+        else:
+            self.completed += 1
+            with self._lock:
+                self._conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+        finally:
+            self._slots.release()
+            self._wakeup.set()
@@ -0,0 +1,122 @@
+import contextvars
+import functools
+import json
+from contextlib import contextmanager
+
+import metrics
+
+DEFAULT_TENANT_ID = "default"
+
+_current_tenant = contextvars.ContextVar("tenant", default=None)
+
+
+class UnknownTenant(Exception):
+    """Продавец с таким id не настроен."""
+
+
+class Tenant:
+    """Один продавец: своя сессия WAHA, Google Таблица и база знаний.
+
+    settings — настройки продавца из файла TENANTS_CONFIG (или из переменных
+    окружения, если продавец один). Ресурсы продавца — листы, локальная
+    база, кэши, ограничители квот, роутер сценариев — заполняет
+    main.create_tenant; пулы HTTP-соединений, клиент OpenAI, очередь событий
+    и планировщик общие на процесс.
+    """
+
+    def __init__(self, tenant_id, settings):
+        self.id = tenant_id
+        self.settings = settings
+        self.knowledge_base = None
+        self.stage_router = None
+        self.rate_limiters = {}
+        self.llm_cache = None
+        self.waha_client = None
+        self.local_store = None
+        self.store_catalog = None
+        self.store_catalog_ready = None
+        self.catalog_cache = None
+        self.co_purchase = None
+        self.sheets_ready = None
+        self.products_sheet = None
+        self.customers_sheet = None
+        self.orders_sheet = None
+        self.order_history = None
+        self.customer_writer = None
+        self.sheet_sync = None
+        self.campaign_runner = None
+
+    def setting(self, name, default=None):
+        value = self.settings.get(name)
+        return default if value in (None, "") else value
+
+    def bind(self, func):
+        """func, который всегда выполняется в контексте этого продавца (для фоновых потоков)."""
+        @functools.wraps(func)
+        def bound(*args, **kwargs):
+            with tenant_scope(self):
+                return func(*args, **kwargs)
+        return bound
+
+    @contextmanager
+    def span(self, dependency):
+        """metrics.span с меткой этого продавца — для потоков компонентов вне tenant_scope."""
+        with tenant_scope(self), metrics.span(dependency):
+            yield
+
+
+class TenantRegistry:
+    """Продавцы процесса по id; get(None) — продавец по умолчанию."""
+
+    def __init__(self, tenants, default_id=None):
+        self._tenants = {tenant.id: tenant for tenant in tenants}
+        if not self._tenants:
+            raise ValueError("Не настроено ни одного продавца")
+        self.default_id = default_id or next(iter(self._tenants))
+        if self.default_id not in self._tenants:
+            raise ValueError(f"Продавец по умолчанию {self.default_id} не настроен")
+
+    def get(self, tenant_id=None):
+        tenant = self._tenants.get(str(tenant_id) if tenant_id else self.default_id)
+        if tenant is None:
+            raise UnknownTenant(f"Неизвестный продавец: {tenant_id}")
+        return tenant
+
+    def __contains__(self, tenant_id):
+        return str(tenant_id) in self._tenants
+
+    def __iter__(self):
+        return iter(list(self._tenants.values()))
+
+    def __len__(self):
+        return len(self._tenants)
+
+
+def load_tenant_settings(path):
+    """Читает файл продавцов: {"default": id, "tenants": [{"id": ..., ...}, ...]}.
+
+    Возвращает (список настроек, id продавца по умолчанию или None).
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    settings = config.get("tenants") or []
+    ids = [str(item.get("id") or "") for item in settings]
+    if not all(ids) or len(set(ids)) != len(ids):
+        raise ValueError(f"{path}: у каждого продавца должен быть уникальный непустой id")
+    return settings, config.get("default")
+
+
+@contextmanager
+def tenant_scope(tenant):
+    """Все вызовы внутри блока работают с ресурсами и метриками продавца tenant."""
+    token = _current_tenant.set(tenant)
+    try:
+        with metrics.tenant_scope(tenant.id):
+            yield tenant
+    finally:
+        _current_tenant.reset(token)
+
+
+def current_tenant():
+    """Продавец текущего контекста или None вне tenant_scope."""
+    return _current_tenant.get()
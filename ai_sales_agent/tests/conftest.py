@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Модули агента лежат плоско в ai_sales_agent/, заменители Sheets — рядом, в tests/fakes.py
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, AGENT_DIR)
+sys.path.insert(0, TESTS_DIR)
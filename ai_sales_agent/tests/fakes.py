@@ -0,0 +1,263 @@
+"""Локальные заменители Google Sheets, OpenAI и WAHA для бенчмарка.
+
+У каждого заменителя настраиваются задержка (latency, секунды) и доля
+ошибок (error_rate, 0..1); все внешние вызовы считаются в CallCounter.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+
+class CallCounter:
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class FakeDependencyError(Exception):
+    """Искусственная ошибка внешнего сервиса: ответ 429, как при исчерпании квоты."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.response = SimpleNamespace(status_code=429, headers={"Retry-After": "0.1"})
+
+
+class _Latency:
+    def __init__(self, latency, error_rate, rng):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+
+    def __call__(self, name):
+        if self.latency:
+            time.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            raise FakeDependencyError(f"{name}: искусственная ошибка")
+
+
+_CELL = re.compile(r"([A-Z]+)(\d*)")
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+
+def _parse_range(range_name):
+    start, _, end = range_name.partition(":")
+    start_col, start_row = _CELL.fullmatch(start).groups()
+    end_col, end_row = _CELL.fullmatch(end or start).groups()
+    # Диапазон без номера последней строки ("A2:F") — до конца листа
+    return int(start_row), _column_index(start_col), int(end_row or 10 ** 9), _column_index(end_col)
+
+
+class FakeWorksheet:
+    """Лист в памяти с тем подмножеством API gspread, которое использует агент."""
+
+    def __init__(self, title, rows, counter, latency=0.0, error_rate=0.0, rng=None):
+        self.title = title
+        self.rows = [list(row) for row in rows]
+        self.counter = counter
+        self._delay = _Latency(latency, error_rate, rng or random.Random())
+        self._lock = threading.Lock()
+
+    def _call(self, kind):
+        self.counter.add(f"sheets.{self.title}.{kind}")
+        self._delay(f"sheets.{self.title}.{kind}")
+
+    def get_all_records(self):
+        self._call("read")
+        with self._lock:
+            header = self.rows[0] if self.rows else []
+            return [dict(zip(header, row)) for row in self.rows[1:]]
+
+    def col_values(self, col):
+        self._call("read")
+        with self._lock:
+            values = [row[col - 1] if len(row) >= col else '' for row in self.rows]
+        # Как Sheets API: пустые ячейки в конце колонки не возвращаются
+        while values and values[-1] in ('', None):
+            values.pop()
+        return values
+
+    def get(self, range_name):
+        self._call("read")
+        return self._read_range(range_name)
+
+    def batch_get(self, ranges):
+        self._call("read")
+        return [self._read_range(range_name) for range_name in ranges]
+
+    def batch_update(self, data):
+        self._call("write")
+        with self._lock:
+            for item in data:
+                start_row, start_col, _, _ = _parse_range(item["range"])
+                for offset, values in enumerate(item["values"]):
+                    row = self._row(start_row + offset)
+                    row[start_col - 1:start_col - 1 + len(values)] = values
+
+    def append_rows(self, values, **kwargs):
+        self._call("write")
+        with self._lock:
+            first = len(self.rows) + 1
+            self.rows.extend(list(row) for row in values)
+            last = len(self.rows)
+        width = max((len(row) for row in values), default=1)
+        end_col = chr(ord('A') + width - 1)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first}:{end_col}{last}"}}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def _read_range(self, range_name):
+        start_row, start_col, end_row, end_col = _parse_range(range_name)
+        with self._lock:
+            rows = [row[start_col - 1:end_col] for row in self.rows[start_row - 1:end_row]]
+        while rows and not any(cell not in ('', None) for cell in rows[-1]):
+            rows.pop()
+        return rows
+
+    def _row(self, row_index):
+        while len(self.rows) < row_index:
+            self.rows.append([])
+        row = self.rows[row_index - 1]
+        return row
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheets, counter, latency=0.0):
+        self._worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+        self.counter = counter
+        self.latency = latency
+
+    def worksheet(self, title):
+        import gspread
+        self.counter.add("sheets.open_worksheet")
+        time.sleep(self.latency)
+        if title not in self._worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._worksheets[title]
+
+    def add_worksheet(self, title, rows=1000, cols=26):
+        self.counter.add("sheets.add_worksheet")
+        time.sleep(self.latency)
+        worksheet = FakeWorksheet(title, [], self.counter, self.latency)
+        self._worksheets[title] = worksheet
+        return worksheet
+
+
+class FakeGspreadClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_url(self, url):
+        self.spreadsheet.counter.add("sheets.open_by_url")
+        time.sleep(self.spreadsheet.latency)
+        return self.spreadsheet
+
+
+class FakeOpenAI:
+    """Заменитель openai.OpenAI: chat.completions.create с задержкой и ошибками."""
+
+    def __init__(self, counter, latency=0.0, error_rate=0.0, rng=None):
+        self.counter = counter
+        self._delay = _Latency(latency, error_rate, rng or random.Random())
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, **kwargs):
+        self.counter.add(f"openai.{model}")
+        self._delay(f"openai.{model}")
+        prompt = messages[-1]["content"]
+        text = f"Здравствуйте! Спасибо за покупку. ({len(prompt)} символов промпта)"
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(text) // 4)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+
+
+class FakeWahaServer:
+    """Локальный HTTP-сервер, принимающий любые POST как отправку сообщения WAHA."""
+
+    def __init__(self, counter, latency=0.0, error_rate=0.0, rng=None):
+        self.counter = counter
+        delay = _Latency(latency, 0.0, rng or random.Random())
+        rng = rng or random.Random()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                counter.add("waha.send")
+                delay("waha.send")
+                status = 503 if error_rate and rng.random() < error_rate else 200
+                body = json.dumps({"status": "ok" if status == 200 else "error"}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def seed_products(size, categories=50, rng=None):
+    """Строки листа products: SKU, model, category, price, PP1..PP5."""
+    rng = rng or random.Random()
+    header = ["SKU", "model", "category", "price", "PP1", "PP2", "PP3", "PP4", "PP5"]
+    rows = [header]
+    for i in range(size):
+        stock = [str(rng.randint(0, 20)) if rng.random() < 0.6 else "no" for _ in range(5)]
+        rows.append([str(100000 + i), f"Модель {i}", f"Категория {i % categories}",
+                     rng.randint(1000, 500000)] + stock)
+    return rows
+
+
+def seed_customers(size, product_count, rng=None):
+    """Строки листа customers: phone, name, stage, история заказов (JSON)."""
+    rng = rng or random.Random()
+    rows = [["phone", "name", "stage", "orders"]]
+    for i in range(size):
+        orders = [{"sku": str(100000 + rng.randrange(product_count)), "product_name": "Товар"}
+                  for _ in range(rng.randint(0, 3))]
+        rows.append([customer_phone(i), f"Клиент {i}", rng.choice(["POST_PURCHASE", "NURTURING"]),
+                     json.dumps(orders, ensure_ascii=False)])
+    return rows
+
+
+def customer_phone(i):
+    return str(77000000000 + i)
@@ -0,0 +1,79 @@
+import json
+import time
+
+from campaigns import CampaignRunner, customer_matches
+from fakes import CallCounter, FakeWorksheet
+from rate_limit import RateLimited
+
+HEADER = ["phone", "name", "stage", "orders"]
+
+
+def customers(count):
+    return [HEADER] + [[str(7000 + i), f"Клиент {i}", "NURTURING" if i % 2 else "POST_PURCHASE",
+                        json.dumps([{"sku": "A"}] * (i % 3))] for i in range(count)]
+
+
+def make_runner(tmp_path, rows, send, **kwargs):
+    sheet = FakeWorksheet("customers", rows, CallCounter())
+    return CampaignRunner(sheet, lambda row: f"Привет, {row[1]}", send, str(tmp_path / "campaigns.db"),
+                          page_size=4, max_workers=2, **kwargs)
+
+
+def wait_finished(runner, campaign_id):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        status = runner.status(campaign_id)
+        if status["status"] != "running" and campaign_id not in runner._running:
+            return status
+        time.sleep(0.01)
+    raise AssertionError("рассылка не завершилась")
+
+
+def test_customer_matches_filters():
+    row = ["7001", "Аня", "NURTURING", json.dumps([{"sku": "A"}, {"sku": "B"}])]
+    assert customer_matches(row, {"stages": ["NURTURING"], "min_orders": 2, "skus": ["B"]})
+    assert not customer_matches(row, {"exclude_stages": ["NURTURING"]})
+    assert not customer_matches(row, {"min_orders": 3})
+    assert not customer_matches(row, {"skus": ["C"]})
+    assert not customer_matches(["", "", "NURTURING"], {})
+
+
+def test_campaign_pages_through_sheet_and_sends_to_matching_customers(tmp_path):
+    sent = []
+    runner = make_runner(tmp_path, customers(10), lambda phone, text: sent.append(phone) or True)
+    status = wait_finished(runner, runner.start({"stages": ["NURTURING"]}, campaign_id="c1"))
+    assert sorted(sent) == [str(7000 + i) for i in range(1, 10, 2)]
+    assert (status["status"], status["scanned"], status["matched"], status["sent"]) == ("done", 10, 5, 5)
+
+
+def test_restarted_campaign_skips_customers_already_processed(tmp_path):
+    sent = []
+    runner = make_runner(tmp_path, customers(6), lambda phone, text: sent.append(phone) or True)
+    runner._record_recipient("c1", "7000", "sent")
+    wait_finished(runner, runner.start({}, campaign_id="c1"))
+    assert "7000" not in sent and len(sent) == 5
+
+
+def test_throttled_recipients_are_retried_not_failed(tmp_path):
+    attempts = []
+
+    def send(phone, text):
+        attempts.append(phone)
+        if attempts.count(phone) == 1:
+            raise RateLimited("waha: квота исчерпана")
+        return True
+
+    runner = make_runner(tmp_path, customers(3), send, retry_delay=0)
+    status = wait_finished(runner, runner.start({}, campaign_id="c1"))
+    assert (status["sent"], status["failed"]) == (3, 0)
+    assert len(attempts) == 6
+
+
+def test_blank_rows_do_not_end_campaign_early(tmp_path):
+    # Пустые строки в конце страницы Sheets не возвращает: страница короче page_size
+    rows = customers(3) + [["", "", "", ""]] * 6 + [["7999", "Поздний клиент", "NURTURING", ""]]
+    sent = []
+    runner = make_runner(tmp_path, rows, lambda phone, text: sent.append(phone) or True)
+    status = wait_finished(runner, runner.start({}, campaign_id="c1"))
+    assert status["status"] == "done"
+    assert sorted(sent) == ["7000", "7001", "7002", "7999"]
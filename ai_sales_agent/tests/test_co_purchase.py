@@ -0,0 +1,40 @@
+from co_purchase import CoPurchaseRecommender
+
+
+def product(sku, stock=5):
+    return {"SKU": sku, "product_name": f"Товар {sku}", "total_stock": stock}
+
+
+PRODUCTS = [product("A"), product("B"), product("C"), product("D", stock=0)]
+
+
+def skus(products):
+    return [item["SKU"] for item in products]
+
+
+def test_rebuild_ranks_by_co_purchases_and_skips_out_of_stock():
+    recommender = CoPurchaseRecommender(top_k=2)
+    pairs = [("1", "A"), ("1", "B"), ("2", "A"), ("2", "B"), ("2", "C"), ("3", "A"), ("3", "D"), ("3", "D")]
+    recommender.rebuild(pairs, PRODUCTS)
+    assert skus(recommender.recommendations("A")) == ["B", "C"]
+    assert skus(recommender.recommendations("D")) == ["A"]
+    assert recommender.recommendations("missing") == ()
+    assert recommender.stats()["customers"] == 3
+
+
+def test_add_order_updates_only_for_new_purchases():
+    recommender = CoPurchaseRecommender()
+    recommender.rebuild([("1", "A")], PRODUCTS)
+    assert skus(recommender.recommendations("A")) == []
+    recommender.add_order("1", "C")
+    recommender.add_order("1", "C")
+    assert skus(recommender.recommendations("A")) == ["C"]
+    assert recommender.stats()["updates"] == 1
+
+
+def test_refresh_stock_drops_sold_out_products():
+    recommender = CoPurchaseRecommender()
+    recommender.rebuild([("1", "A"), ("1", "B")], PRODUCTS)
+    recommender.refresh_stock([product("A"), product("B", stock=0)])
+    assert skus(recommender.recommendations("A")) == []
+    assert skus(recommender.recommendations("B")) == ["A"]
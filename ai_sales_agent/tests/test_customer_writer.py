@@ -0,0 +1,105 @@
+from customer_writer import ORDER_COLUMNS, CustomerWriteBuffer, read_orders_by_phone
+from fakes import CallCounter, FakeWorksheet
+from test_sheet_sync import FlakyWorksheet
+
+
+def make_writer(customer_rows, failures=None, orders_failures=None, **kwargs):
+    counter = CallCounter()
+    customers = FlakyWorksheet("customers", [["phone", "name", "stage", "orders"]] + customer_rows, counter,
+                               failures=failures)
+    orders = FlakyWorksheet("orders", [ORDER_COLUMNS], counter, failures=orders_failures)
+    writer = CustomerWriteBuffer(customers, flush_interval=3600, orders_worksheet=orders, **kwargs)
+    writer.row_index.rebuild()
+    return writer, customers, orders
+
+
+def change(name, stage, orders=()):
+    return {"name": name, "stage": stage, "orders": list(orders)}
+
+
+def test_write_batch_clears_appended_orders_on_failure():
+    writer, customers, orders = make_writer([["7001", "Old", "NEW", ""]], failures={"batch_update": 1})
+    batch = {"7001": change("Аня", "POST_PURCHASE", [{"sku": "A"}])}
+    try:
+        writer.write_batch(batch)
+    except RuntimeError:
+        pass
+    assert batch == {"7001": change("Аня", "POST_PURCHASE")}
+    assert len(orders.rows) == 2
+    writer.close()
+
+
+def test_write_batch_drops_updated_customers_when_append_fails():
+    writer, customers, _ = make_writer([["7001", "Old", "NEW", ""]], failures={"append_rows": 1})
+    batch = {"7001": change("Аня", "DELIVERED"), "7002": change("Боря", "POST_PURCHASE")}
+    try:
+        writer.write_batch(batch)
+    except RuntimeError:
+        pass
+    assert list(batch) == ["7002"]
+    assert customers.rows[1][:3] == ["7001", "Аня", "DELIVERED"]
+    writer.close()
+
+
+def test_flush_requeues_failed_batch_and_merges_newer_changes():
+    writer, customers, orders = make_writer([], orders_failures={"append_rows": 1})
+    writer.update("7001", "Аня", "POST_PURCHASE", {"sku": "A"})
+    assert writer.flush() == 0
+    writer.update("7001", "Аня", "ORDER_DELIVERED", {"sku": "B"})
+    assert writer.queue_depth() == 1
+    writer._retry_at = 0.0
+    assert writer.flush() == 1
+    assert customers.rows[1:] == [["7001", "Аня", "ORDER_DELIVERED", ""]]
+    assert [row[2] for row in orders.rows[1:]] == ["A", "B"]
+    writer.close()
+
+
+def test_flush_drops_customer_after_max_attempts():
+    writer, customers, _ = make_writer([], failures={"append_rows": 10}, max_attempts=2)
+    writer.update("7001", "Аня", "POST_PURCHASE")
+    assert writer.flush() == 0
+    assert writer.queue_depth() == 1
+    assert writer.flush() == 0
+    assert writer.queue_depth() == 0
+    assert writer.stats()["dropped"] == 1
+    writer.close()
+
+
+def test_pending_buffer_is_bounded():
+    writer, _, _ = make_writer([], max_pending=3)
+    for i in range(5):
+        writer.update(f"700{i}", "N", "POST_PURCHASE")
+    assert writer.queue_depth() == 3
+    assert set(writer._pending) == {"7002", "7003", "7004"}
+    assert writer.stats()["dropped"] == 2
+    writer.close()
+
+
+def test_read_orders_by_phone_window():
+    rows = [ORDER_COLUMNS] + [["7001" if i % 2 else "7002", str(i), f"SKU{i}", "", "", ""] for i in range(10)]
+    orders = FakeWorksheet("orders", rows, CallCounter())
+    assert len(read_orders_by_phone(orders)["7002"]) == 5
+    recent = read_orders_by_phone(orders, max_rows=3)
+    assert [order["sku"] for order in recent["7001"]] == ["SKU7", "SKU9"]
+    assert [order["sku"] for order in recent["7002"]] == ["SKU8"]
+    assert read_orders_by_phone(FakeWorksheet("orders", [ORDER_COLUMNS], CallCounter()), max_rows=3) == {}
+
+
+def test_updates_of_one_customer_merge_into_one_write():
+    writer, customers, orders = make_writer([["7001", "Old", "NEW", ""]])
+    writer.update("7001", "Аня", "POST_PURCHASE", {"sku": "A"})
+    writer.update("7001", "Аня", "ORDER_DELIVERED", {"sku": "B"})
+    writer.update("7002", "Боря", "POST_PURCHASE")
+    assert writer.queue_depth() == 2
+    assert writer.flush() == 2
+    assert customers.rows[1:] == [["7001", "Аня", "ORDER_DELIVERED", ""], ["7002", "Боря", "POST_PURCHASE", ""]]
+    assert [row[2] for row in orders.rows[1:]] == ["A", "B"]
+    assert customers.counter.snapshot()["sheets.customers.write"] == 2
+    writer.close()
+
+
+def test_close_flushes_pending_changes():
+    writer, customers, _ = make_writer([])
+    writer.update("7001", "Аня", "POST_PURCHASE")
+    writer.close()
+    assert customers.rows[1:] == [["7001", "Аня", "POST_PURCHASE", ""]]
@@ -0,0 +1,79 @@
+from dedup import PROCESSING, DedupStore, event_key
+
+EVENT = {"waha_stage_id": "POST_PURCHASE", "customer": {"phone": "7001"}, "order": {"sku": "A"}}
+
+
+def test_claim_complete_and_duplicate():
+    store = DedupStore()
+    key = event_key(EVENT)
+    assert store.claim(key) is None
+    assert store.claim(key) == PROCESSING
+    store.complete(key, ({"status": "success"}, 200))
+    assert store.claim(key) == ({"status": "success"}, 200)
+    assert store.stats()["duplicates"] == 2
+
+
+def test_release_allows_retry():
+    store = DedupStore()
+    key = event_key(EVENT)
+    assert store.claim(key) is None
+    store.release(key)
+    assert store.claim(key) is None
+
+
+def test_keys_are_scoped_by_tenant_and_event_id():
+    assert event_key(EVENT) != event_key(dict(EVENT, tenant_id="shop2"))
+    assert event_key(dict(EVENT, event_id="e1")) == "id:e1"
+    assert event_key(dict(EVENT, event_id="e1", tenant_id="shop2")) == "shop2:id:e1"
+
+
+def test_hash_keys_expire_after_hash_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("dedup.time.time", lambda: now[0])
+    store = DedupStore(ttl=86400, hash_ttl=600)
+    hashed, by_id = event_key(EVENT), event_key(dict(EVENT, event_id="e1"))
+    for key in (hashed, by_id):
+        store.claim(key)
+        store.complete(key, ({"status": "success"}, 200))
+    now[0] += 601
+    # Повторная покупка того же SKU после окна повторов — новое событие
+    assert store.claim(hashed) is None
+    assert store.claim(by_id) == ({"status": "success"}, 200)
+
+
+def test_results_survive_restart_and_stay_bounded(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    store = DedupStore(max_size=3, db_path=path)
+    for i in range(10):
+        store.claim(f"id:{i}")
+        store.complete(f"id:{i}", ({"n": i}, 200))
+    restarted = DedupStore(max_size=3, db_path=path)
+    for i in range(10):
+        assert restarted.claim(f"id:{i}") == ({"n": i}, 200)
+    assert restarted.stats()["size"] == 3
+
+
+def test_processing_marker_is_not_persisted(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    DedupStore(db_path=path).claim("id:crashed")
+    assert DedupStore(db_path=path).claim("id:crashed") is None
+
+
+def test_memory_bound_evicts_oldest_results():
+    store = DedupStore(max_size=2)
+    for i in range(3):
+        store.claim(f"id:{i}")
+        store.complete(f"id:{i}", ({"n": i}, 200))
+    assert store.stats()["size"] == 2
+    assert store.claim("id:0") is None
+    assert store.claim("id:2") == ({"n": 2}, 200)
+
+
+def test_id_keys_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("dedup.time.time", lambda: now[0])
+    store = DedupStore(ttl=60)
+    store.claim("id:e1")
+    store.complete("id:e1", ({"status": "success"}, 200))
+    now[0] += 61
+    assert store.claim("id:e1") is None
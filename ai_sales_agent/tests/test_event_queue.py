@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from event_queue import EventQueue, QueueFull
+
+
+def customer_key(event):
+    return event.get("phone")
+
+
+def test_events_of_one_customer_run_in_order_and_never_overlap():
+    seen, active, overlaps = {}, set(), []
+    lock = threading.Lock()
+
+    def process(event):
+        with lock:
+            if event["phone"] in active:
+                overlaps.append(event)
+            active.add(event["phone"])
+        time.sleep(0.0005)
+        with lock:
+            seen.setdefault(event["phone"], []).append(event["n"])
+            active.discard(event["phone"])
+        return {"status": "success"}, 200
+
+    queue = EventQueue(process, workers=4, max_queue=2000, shard_key=customer_key)
+    for n in range(400):
+        queue.submit({"phone": str(n % 13), "n": n})
+    queue.join()
+
+    assert not overlaps
+    assert sum(len(numbers) for numbers in seen.values()) == 400
+    assert all(numbers == sorted(numbers) for numbers in seen.values())
+    assert queue.stats()["processed"] == 400
+
+
+def test_same_key_always_maps_to_the_same_shard():
+    queue = EventQueue(lambda event: ({}, 200), workers=8, shard_key=customer_key)
+    assert len({queue.shard_for({"phone": "7001"}) for _ in range(20)}) == 1
+
+
+def test_full_shard_rejects_event_and_reports_depth():
+    started, release = threading.Event(), threading.Event()
+
+    def process(event):
+        started.set()
+        release.wait(5)
+        return {}, 200
+
+    queue = EventQueue(process, workers=2, max_queue=4, shard_key=customer_key)
+    # Шард вмещает 2 события плюс одно, которое уже взял воркер
+    accepted = [queue.submit({"phone": "7001", "n": 0})]
+    assert started.wait(5)
+    with pytest.raises(QueueFull):
+        for n in range(1, 10):
+            accepted.append(queue.submit({"phone": "7001", "n": n}))
+    assert len(accepted) == 3
+    shard = queue.shard_for({"phone": "7001"})
+    assert queue.shard_depths()[shard] == 2
+    assert queue.stats()["rejected"] == 1
+    release.set()
+    queue.join()
+    assert all(queue.status(event_id)["status"] == "done" for event_id in accepted)
+
+
+def test_slow_customer_does_not_block_other_customers():
+    release = threading.Event()
+
+    def process(event):
+        if event["phone"] == "slow":
+            release.wait(5)
+        return {"phone": event["phone"]}, 200
+
+    queue = EventQueue(process, workers=4, shard_key=customer_key)
+    slow = queue.submit({"phone": "slow"})
+    others = [queue.submit({"phone": str(n)}) for n in range(20)
+              if queue.shard_for({"phone": str(n)}) != queue.shard_for({"phone": "slow"})]
+    deadline = time.time() + 5
+    while time.time() < deadline and any(queue.status(event_id)["status"] != "done" for event_id in others):
+        time.sleep(0.01)
+    assert all(queue.status(event_id)["status"] == "done" for event_id in others)
+    assert queue.status(slow)["status"] == "processing"
+    release.set()
+    queue.join()
+
+
+def test_failed_event_is_reported_and_worker_keeps_running():
+    def process(event):
+        if event["n"] == 0:
+            raise RuntimeError("boom")
+        return {"status": "success"}, 200
+
+    queue = EventQueue(process, workers=1, shard_key=customer_key)
+    failed = queue.submit({"phone": "7001", "n": 0}, event_id="e0")
+    done = queue.submit({"phone": "7001", "n": 1})
+    queue.join()
+    assert failed == "e0"
+    assert queue.status(failed)["status"] == "error" and queue.status(failed)["error"] == "boom"
+    assert queue.status(done)["result"] == {"status": "success"}
+    assert queue.stats()["failed"] == 1 and queue.stats()["processed"] == 1
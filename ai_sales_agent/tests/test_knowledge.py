@@ -0,0 +1,77 @@
+import json
+import os
+import time
+
+from knowledge import KnowledgeBase, normalize_knowledge_base
+from prompt_templates import compile_script_templates
+
+
+def write_knowledge(path, script, mtime):
+    path.write_text(json.dumps({"scenarios": {"POST_PURCHASE": {"script": [script]}}}, ensure_ascii=False),
+                    encoding="utf-8")
+    os.utime(path, (mtime, mtime))
+
+
+def wait_reloaded(knowledge, reloads):
+    deadline = time.time() + 5
+    while time.time() < deadline and (knowledge.reloads < reloads or knowledge._reloading):
+        knowledge.snapshot()
+        time.sleep(0.01)
+
+
+def test_normalize_supports_stage_format():
+    data = normalize_knowledge_base({"knowledge_base": {
+        "stages": {"LOYALTY": {"description": "Постоянные", "actions": ["Поблагодарить"]}},
+        "communication_rules": {"principles": ["Уважать отказ"]},
+    }})
+    assert data["scenarios"]["LOYALTY"] == {"description": "Постоянные", "script": ["Поблагодарить"]}
+    assert data["rules"]["general"] == ["Уважать отказ"]
+
+
+def test_lazy_load_and_hot_reload(tmp_path):
+    path = tmp_path / "knowledge.json"
+    write_knowledge(path, "Первая версия", 1000)
+    knowledge = KnowledgeBase(str(path), compile_script_templates, check_interval=0)
+    assert not knowledge.stats()["loaded"]
+    assert knowledge.render("POST_PURCHASE", {}) == "Первая версия"
+    old = knowledge.snapshot()
+    write_knowledge(path, "Вторая версия", 2000)
+    wait_reloaded(knowledge, 2)
+    assert knowledge.render("POST_PURCHASE", {}) == "Вторая версия"
+    assert old.prompts.render("POST_PURCHASE", {}) == "Первая версия"
+
+
+def test_broken_file_keeps_previous_version(tmp_path):
+    path = tmp_path / "knowledge.json"
+    write_knowledge(path, "Рабочая версия", 1000)
+    knowledge = KnowledgeBase(str(path), compile_script_templates, check_interval=0)
+    knowledge.snapshot()
+    path.write_text("{не json", encoding="utf-8")
+    os.utime(path, (2000, 2000))
+    deadline = time.time() + 5
+    while time.time() < deadline and not knowledge.errors:
+        knowledge.snapshot()
+        time.sleep(0.01)
+    while knowledge._reloading:
+        time.sleep(0.01)
+    for _ in range(5):
+        knowledge.snapshot()
+        time.sleep(0.01)
+    # Сломанный файл читается один раз, повторно — только после нового изменения
+    assert knowledge.errors == 1
+    assert knowledge.render("POST_PURCHASE", {}) == "Рабочая версия"
+    write_knowledge(path, "Исправленная версия", 3000)
+    wait_reloaded(knowledge, 2)
+    assert knowledge.render("POST_PURCHASE", {}) == "Исправленная версия"
+
+
+def test_broken_initial_file_is_not_reread_until_changed(tmp_path):
+    path = tmp_path / "knowledge.json"
+    path.write_text("{не json", encoding="utf-8")
+    knowledge = KnowledgeBase(str(path), compile_script_templates, check_interval=0)
+    for _ in range(5):
+        knowledge.snapshot()
+    assert knowledge.errors == 1 and not knowledge._reloading
+    write_knowledge(path, "Первая версия", 4000)
+    wait_reloaded(knowledge, 1)
+    assert knowledge.render("POST_PURCHASE", {}) == "Первая версия"
@@ -0,0 +1,34 @@
+from llm_cache import NAME_TOKEN, ResponseCache, anonymize, personalize
+
+
+def test_name_is_replaced_and_restored():
+    text = anonymize("Аня, спасибо за покупку, Аня!", "Аня")
+    assert text == f"{NAME_TOKEN}, спасибо за покупку, {NAME_TOKEN}!"
+    assert personalize(text, "Боря") == "Боря, спасибо за покупку, Боря!"
+    assert anonymize("Спасибо за покупку!", None) == "Спасибо за покупку!"
+
+
+def test_declined_name_is_not_cacheable():
+    assert anonymize("Анне понравится этот чехол", "Анна") is None
+
+
+def test_keys_depend_on_model_and_prompts():
+    key = ResponseCache.make_key("gpt-4o", "system", "prompt")
+    assert key == ResponseCache.make_key("gpt-4o", "system", "prompt")
+    assert key != ResponseCache.make_key("gpt-4o-mini", "system", "prompt")
+    assert ResponseCache.make_key("m", "ab", "c") != ResponseCache.make_key("m", "a", "bc")
+
+
+def test_lru_eviction_and_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("llm_cache.time.monotonic", lambda: now[0])
+    cache = ResponseCache(max_size=2, ttl=10)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+    now[0] += 11
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 1
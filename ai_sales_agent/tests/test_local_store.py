@@ -0,0 +1,16 @@
+from local_store import LocalStore
+
+
+def test_import_keeps_sheet_data_synced_and_skips_known_customers(tmp_path):
+    store = LocalStore(str(tmp_path / "store.sqlite3"))
+    store.record_customers([("7001", "Аня", "POST_PURCHASE", {"sku": "A"})])
+    imported = store.import_customers([
+        ("7001", "Старое имя", "NEW", [{"sku": "X"}]),
+        ("7002", "Боря", "NURTURING", [{"sku": "B"}, {"sku": "C"}]),
+    ])
+    assert imported == 1
+    assert store.customer_count() == 2
+    assert store.recent_orders("7001", None) == [{"sku": "A"}]
+    assert store.recent_orders("7002", None) == [{"sku": "B"}, {"sku": "C"}]
+    assert list(store.pending_changes()) == ["7001"]
+    assert store.order_skus() == [("7001", "A"), ("7002", "B"), ("7002", "C")]
@@ -0,0 +1,49 @@
+import pytest
+
+from prompt_templates import (UnknownStageError, compile_sales_prompts, compile_script_templates)
+
+KNOWLEDGE = {
+    "scenarios": {
+        "POST_PURCHASE": {"description": "Допродажа", "script": ["Поздравь {Клиент} с покупкой", "Предложи товары"]},
+        "PROMOTIONS": {"description": "Рассылка", "script": ["Расскажи об акциях"],
+                       "rendering": {"policy": "template", "template": "Привет, {Клиент}! Скидки недели."}},
+    },
+    "rules": {"general": ["Не придумывать товары"]},
+}
+
+
+def test_script_template_substitutes_placeholders_and_lists_other_keys():
+    book = compile_script_templates(KNOWLEDGE)
+    prompt = book.render("POST_PURCHASE", {"Клиент": "Аня", "Купленный товар": "Чайник"})
+    assert prompt == ("Поздравь Аня с покупкой\nПредложи товары"
+                      "\n\n--- КОНТЕКСТ ДИАЛОГА ---\n- Купленный товар: Чайник")
+    assert book.render("POST_PURCHASE", {"Клиент": "Аня"}) == "Поздравь Аня с покупкой\nПредложи товары"
+
+
+def test_sales_prompt_keeps_static_prefix_and_appends_context():
+    book = compile_sales_prompts(KNOWLEDGE)
+    template = book.templates["POST_PURCHASE"]
+    prompt = book.render("POST_PURCHASE", {"Клиент": "Аня"})
+    assert prompt.startswith(template.prefix)
+    assert "- Не придумывать товары" in template.prefix
+    assert "- Клиент: Аня" in prompt and prompt.endswith("сразу пиши финальный текст.")
+
+
+def test_policies_and_unknown_stages():
+    book = compile_script_templates(KNOWLEDGE)
+    assert book.policy("POST_PURCHASE").name == "full"
+    policy = book.policy("PROMOTIONS")
+    assert policy.name == "template"
+    assert policy.template.render({"Клиент": "Аня"}) == "Привет, Аня! Скидки недели."
+    assert book.missing(["POST_PURCHASE", "LOYALTY"]) == ["LOYALTY"]
+    with pytest.raises(UnknownStageError):
+        book.render("LOYALTY", {})
+
+
+def test_invalid_placeholders_and_policies_fail_at_compile_time():
+    with pytest.raises(ValueError):
+        compile_script_templates({"scenarios": {"S": {"script": ["Привет, {Клиентт}"]}}})
+    with pytest.raises(ValueError):
+        compile_script_templates({"scenarios": {"S": {"script": [], "rendering": {"policy": "turbo"}}}})
+    with pytest.raises(ValueError):
+        compile_script_templates({"scenarios": {"S": {"script": [], "rendering": {"policy": "template"}}}})
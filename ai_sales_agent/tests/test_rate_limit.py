@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from rate_limit import AdaptiveRateLimiter, RateLimited, RateLimitedWorksheet, rate_limit_info
+
+
+class RecordingWorksheet:
+    title = "customers"
+
+    def __init__(self):
+        self.calls = []
+
+    def get(self, range_name):
+        self.calls.append(("get", range_name))
+        return [["a"]]
+
+    def append_rows(self, rows):
+        self.calls.append(("append_rows", rows))
+
+
+def limiter(name):
+    return AdaptiveRateLimiter(name, rate=100, burst=100)
+
+
+def test_only_reads_limited():
+    sheet, reads = RecordingWorksheet(), limiter("sheets_read")
+    ws = RateLimitedWorksheet(sheet, reads, None)
+    assert ws.get("A1") == [["a"]]
+    ws.append_rows([["x"]])
+    assert sheet.calls == [("get", "A1"), ("append_rows", [["x"]])]
+    assert reads.acquired == 1
+
+
+def test_only_writes_limited():
+    sheet, writes = RecordingWorksheet(), limiter("sheets_write")
+    ws = RateLimitedWorksheet(sheet, None, writes)
+    assert ws.get("A1") == [["a"]]
+    ws.append_rows([["x"]])
+    assert sheet.calls == [("get", "A1"), ("append_rows", [["x"]])]
+    assert writes.acquired == 1
+    assert ws.title == "customers"
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after="0.01"):
+        super().__init__("429")
+        self.status_code = 429
+        self.response = type("Response", (), {"headers": {"Retry-After": retry_after}})()
+
+
+def test_rate_limit_info_reads_status_and_retry_after():
+    assert rate_limit_info(Throttled("2")) == (True, 2.0)
+    assert rate_limit_info(ValueError("boom")) == (False, None)
+
+
+def test_call_retries_throttled_calls_and_slows_down():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise Throttled()
+        return "ok"
+
+    limiter = AdaptiveRateLimiter("sheets_read", rate=100, burst=100)
+    assert limiter.call(flaky) == "ok"
+    assert limiter.throttled == 2
+    assert 25 <= limiter.rate < 100
+
+
+def test_call_gives_up_with_rate_limited():
+    def always_throttled():
+        raise Throttled()
+
+    limiter = AdaptiveRateLimiter("openai", rate=100, burst=100, max_retries=1)
+    with pytest.raises(RateLimited):
+        limiter.call(always_throttled)
+    with pytest.raises(ValueError):
+        limiter.call(lambda: int("x"))
+
+
+def test_acquire_does_not_wait_longer_than_max_wait():
+    limiter = AdaptiveRateLimiter("sheets_write", rate=0.1, burst=1, max_wait=0.05)
+    limiter.acquire()
+    with pytest.raises(RateLimited):
+        limiter.acquire()
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_call_async_uses_the_same_quota():
+    async def fetch():
+        return "ok"
+
+    limiter = AdaptiveRateLimiter("openai", rate=100, burst=100)
+    assert asyncio.run(limiter.call_async(fetch)) == "ok"
+    assert limiter.acquired == 1
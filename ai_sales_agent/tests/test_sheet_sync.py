@@ -0,0 +1,111 @@
+import pytest
+
+from customer_writer import ORDER_COLUMNS, CustomerWriteBuffer
+from fakes import CallCounter, FakeWorksheet
+from local_store import LocalStore
+from sheet_sync import SheetSync
+
+
+class FlakyWorksheet(FakeWorksheet):
+    """Лист, у которого заданные методы падают заданное число раз."""
+
+    def __init__(self, *args, failures=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = dict(failures or {})
+
+    def _fail(self, name):
+        if self.failures.get(name):
+            self.failures[name] -= 1
+            raise RuntimeError(f"{name}: 503")
+
+    def batch_update(self, data):
+        self._fail("batch_update")
+        return super().batch_update(data)
+
+    def append_rows(self, values, **kwargs):
+        self._fail("append_rows")
+        return super().append_rows(values, **kwargs)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalStore(str(tmp_path / "store.sqlite3"))
+
+
+def make_writer(customers, orders):
+    writer = CustomerWriteBuffer(customers, flush_interval=3600, orders_worksheet=orders)
+    writer.row_index.rebuild()
+    return writer
+
+
+def sheets(customer_rows, customers_failures=None, orders_failures=None):
+    counter = CallCounter()
+    customers = FlakyWorksheet("customers", [["phone", "name", "stage", "orders"]] + customer_rows, counter,
+                               failures=customers_failures)
+    orders = FlakyWorksheet("orders", [ORDER_COLUMNS], counter, failures=orders_failures)
+    return customers, orders
+
+
+def test_push_marks_customers_and_orders_synced(store):
+    customers, orders = sheets([["7001", "Old", "NEW", ""]])
+    writer = make_writer(customers, orders)
+    store.record_customers([("7001", "Аня", "POST_PURCHASE", {"id": 1, "sku": "A"}),
+                            ("7002", "Боря", "POST_PURCHASE", {"id": 2, "sku": "B"})])
+    assert SheetSync(store, writer.write_batch, lambda: 0).push() == 2
+    assert store.pending_count() == 0
+    assert store.pending_changes() == {}
+    assert [row[:3] for row in customers.rows[1:]] == [["7001", "Аня", "POST_PURCHASE"], ["7002", "Боря", "POST_PURCHASE"]]
+    assert [row[2] for row in orders.rows[1:]] == ["A", "B"]
+    writer.close()
+
+
+def test_push_failure_after_orders_append_does_not_duplicate_orders(store):
+    customers, orders = sheets([["7001", "Old", "NEW", ""]], customers_failures={"batch_update": 1})
+    writer = make_writer(customers, orders)
+    store.record_customers([("7001", "Аня", "POST_PURCHASE", {"id": 1, "sku": "A"})])
+    sync = SheetSync(store, writer.write_batch, lambda: 0)
+
+    with pytest.raises(RuntimeError):
+        sync.push()
+    # Заказ уже в листе orders и отмечен отправленным, сам клиент — еще нет
+    assert [row[2] for row in orders.rows[1:]] == ["A"]
+    pending = store.pending_changes()
+    assert pending["7001"]["orders"] == []
+
+    assert sync.push() == 1
+    assert store.pending_count() == 0
+    assert [row[2] for row in orders.rows[1:]] == ["A"]
+    assert customers.rows[1][:3] == ["7001", "Аня", "POST_PURCHASE"]
+    writer.close()
+
+
+def test_push_failure_on_new_rows_keeps_updated_customers_synced(store):
+    customers, orders = sheets([["7001", "Old", "NEW", ""]], customers_failures={"append_rows": 1})
+    writer = make_writer(customers, orders)
+    store.record_customers([("7001", "Аня", "ORDER_DELIVERED", None), ("7002", "Боря", "POST_PURCHASE", None)])
+    sync = SheetSync(store, writer.write_batch, lambda: 0)
+
+    with pytest.raises(RuntimeError):
+        sync.push()
+    assert list(store.pending_changes()) == ["7002"]
+
+    sync.push()
+    assert store.pending_count() == 0
+    assert [row[0] for row in customers.rows[1:]] == ["7001", "7002"]
+    writer.close()
+
+
+def test_changes_after_push_failure_are_sent_with_the_retry(store):
+    customers, orders = sheets([], orders_failures={"append_rows": 1})
+    writer = make_writer(customers, orders)
+    store.record_customers([("7001", "Аня", "POST_PURCHASE", {"id": 1, "sku": "A"})])
+    sync = SheetSync(store, writer.write_batch, lambda: 0)
+
+    with pytest.raises(RuntimeError):
+        sync.push()
+    store.record_customers([("7001", "Аня", "ORDER_DELIVERED", {"id": 2, "sku": "B"})])
+    sync.push()
+    assert store.pending_count() == 0
+    assert [row[2] for row in orders.rows[1:]] == ["A", "B"]
+    assert customers.rows[1:] == [["7001", "Аня", "ORDER_DELIVERED", ""]]
+    writer.close()
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from prompt_templates import PromptBook, UnknownStageError, compile_script_templates
+from stage_router import StageRouter
+
+KNOWLEDGE = {"scenarios": {
+    "POST_PURCHASE": {"script": ["Поздравь {Клиент}"]},
+    "PROMOTIONS": {"script": ["Акции"], "rendering": {"policy": "fast"}},
+    "ORDER_DELIVERED": {"script": ["Отзыв"], "rendering": {"policy": "template", "template": "Спасибо, {Клиент}!"}},
+}}
+
+
+class StaticKnowledge:
+    def __init__(self, prompts):
+        self.prompts = prompts
+
+    def snapshot(self):
+        return self
+
+
+class FakeLLM:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompt, model, scenario, customer_name, usage, **kwargs):
+        self.calls.append((model, prompt))
+        usage.update(prompt_tokens=1000, completion_tokens=100)
+        return f"{model}: {prompt}"
+
+    async def complete_async(self, prompt, **kwargs):
+        return self(prompt, **kwargs)
+
+
+def make_router():
+    llm = FakeLLM()
+    router = StageRouter(StaticKnowledge(compile_script_templates(KNOWLEDGE)), llm,
+                         {"fast": "gpt-4o-mini", "full": "gpt-4o"}, complete_async=llm.complete_async)
+    return router, llm
+
+
+def test_template_policy_skips_llm():
+    router, llm = make_router()
+    assert router.render("ORDER_DELIVERED", {"Клиент": None}) == "Спасибо, !"
+    assert not llm.calls
+    assert router.stats()["template"]["llm_calls"] == 0
+
+
+def test_fast_and_full_policies_use_their_models_and_count_cost():
+    router, llm = make_router()
+    assert router.render("PROMOTIONS", {}) == "gpt-4o-mini: Акции"
+    assert router.render("POST_PURCHASE", {"Клиент": "Аня"}) == "gpt-4o: Поздравь Аня"
+    stats = router.stats()
+    assert stats["fast"]["llm_calls"] == 1 and stats["full"]["llm_calls"] == 1
+    assert stats["full"]["cost_usd"] == pytest.approx((1000 * 2.50 + 100 * 10.00) / 1_000_000)
+
+
+def test_render_async_and_unknown_stage():
+    router, llm = make_router()
+    assert asyncio.run(router.render_async("PROMOTIONS", {})) == "gpt-4o-mini: Акции"
+    with pytest.raises(UnknownStageError):
+        StageRouter(StaticKnowledge(PromptBook({})), llm, {}).render("LOYALTY", {})
@@ -0,0 +1,51 @@
+from rate_limit import RateLimited
+from task_store import DelayedTaskStore
+
+
+def run_due(store):
+    rows, _ = store._claim_due(10)
+    for row in rows:
+        store._execute(*row)
+    return len(rows)
+
+
+def task_row(store, task_id):
+    return store._conn.execute(
+        "SELECT status, attempts, run_at FROM tasks WHERE id = ?", (task_id,)).fetchone()
+
+
+def test_throttled_task_does_not_spend_attempts(tmp_path):
+    def handler(payload):
+        raise RateLimited("openai: квота исчерпана")
+
+    store = DelayedTaskStore(str(tmp_path / "tasks.db"), {"T": handler}, max_attempts=1, throttle_delay=60)
+    task_id = store.schedule("T", {})
+    for _ in range(5):
+        store._conn.execute("UPDATE tasks SET run_at = 0")
+        assert run_due(store) == 1
+    status, attempts, run_at = task_row(store, task_id)
+    assert (status, attempts) == ("pending", 0)
+    assert store.deferred == 5 and store.failed == 0
+
+
+
+def test_failing_task_stops_after_max_attempts(tmp_path):
+    def handler(payload):
+        raise ValueError("boom")
+
+    store = DelayedTaskStore(str(tmp_path / "tasks.db"), {"T": handler}, max_attempts=2)
+    task_id = store.schedule("T", {})
+    for _ in range(3):
+        store._conn.execute("UPDATE tasks SET run_at = 0")
+        run_due(store)
+    assert task_row(store, task_id)[:2] == ("failed", 2)
+    assert store.stats()["failed_permanently"] == 1
+
+
+def test_completed_task_is_deleted(tmp_path):
+    seen = []
+    store = DelayedTaskStore(str(tmp_path / "tasks.db"), {"T": seen.append})
+    task_id = store.schedule("T", {"phone": "7701"})
+    assert run_due(store) == 1
+    assert seen == [{"phone": "7701"}]
+    assert task_row(store, task_id) is None
@@ -0,0 +1,43 @@
+import requests
+
+from waha_client import WahaClient
+
+
+class ScriptedSession:
+    """Session, который отвечает по списку: HTTP-код или исключение."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.posts = 0
+
+    def post(self, url, json=None, timeout=None):
+        self.posts += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response.url = url
+        return response
+
+
+def make_client(outcomes):
+    session = ScriptedSession(outcomes)
+    client = WahaClient("http://waha/api/sendMessage/default", lambda phone, text: {"phone": phone},
+                        backoff=0, max_backoff=0, rate_limit=0, session=session)
+    return client, session
+
+
+def test_throttling_and_connect_errors_are_retried():
+    client, session = make_client([429, 503, requests.exceptions.ConnectTimeout("connect"), 200])
+    assert client.send("7001", "Привет")
+    assert session.posts == 4
+    assert client.stats() == {"sent": 1, "failed": 0, "retries": 3}
+
+
+def test_ambiguous_failures_are_not_retried():
+    for outcome in (requests.exceptions.ReadTimeout("read"), 500, 502, 504):
+        client, session = make_client([outcome, 200])
+        assert not client.send("7001", "Привет")
+        assert session.posts == 1
+        assert client.stats()["failed"] == 1
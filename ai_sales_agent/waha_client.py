@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# sendMessage не идемпотентен: повторяем только ответы, после которых сообщение
+# точно не отправлено, и ошибки установки соединения
+RETRY_STATUS_CODES = {429, 503}
+
+
+def make_session(pool_size=10, headers=None):
+    """keep-alive requests.Session с пулом на pool_size соединений."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(headers or {"Content-Type": "application/json"})
+    return session
+
+
+def make_async_client(timeout=15, pool_size=10, headers=None):
+    import httpx
+    return httpx.AsyncClient(
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        headers=headers or {"Content-Type": "application/json"},
+    )
+
+
+class WahaClient:
+    """Клиент WhatsApp HTTP API (WAHA) с пулом соединений и повторами.
+
+    Все запросы идут через один keep-alive requests.Session, поэтому TCP/TLS
+    соединения переиспользуются. Ответы 429/503 и ошибки соединения
+    повторяются с экспоненциальной задержкой и джиттером (Retry-After
+    учитывается); таймаут чтения и другие 5xx не повторяются — сообщение
+    могло уже уйти, а повтор отправил бы его клиенту дважды. Частота
+    отправки ограничена rate_limit сообщений в секунду на сессию.
+    on_retry() вызывается перед каждым повтором (для метрик). Клиенты разных
+    сессий WAHA могут делить один пул соединений: session — общий
+    requests.Session из make_session().
+    """
+
+    def __init__(self, url, build_payload, headers=None, timeout=15, pool_size=10,
+                 max_retries=3, backoff=0.5, max_backoff=10, rate_limit=20, on_retry=None, session=None):
+        self.url = url
+        self.build_payload = build_payload
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_retry = on_retry
+        self.limiter = TokenBucket(rate_limit) if rate_limit else None
+        self._owns_session = session is None
+        self.session = session or make_session(pool_size, headers)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def send(self, phone, text):
+        """Отправляет одно сообщение; возвращает True при успехе."""
+        payload = self.build_payload(phone, text)
+        for attempt in range(self.max_retries + 1):
+            if self.limiter:
+                self.limiter.acquire()
+            retry_after = None
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    self.sent += 1
+                    logger.info("WAHA message sent to %s", phone)
+                    return True
+                error = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+            except requests.exceptions.ConnectionError as e:
+                # Включая ConnectTimeout: запрос до WAHA не дошел
+                error = e
+            except requests.exceptions.RequestException as e:
+                # 4xx, прочие 5xx и таймаут чтения — повтор не поможет или задублирует сообщение
+                self.failed += 1
+                logger.error("WAHA send error: %s", e)
+                return False
+            if attempt == self.max_retries:
+                break
+            self.retries += 1
+            if self.on_retry:
+                self.on_retry()
+            delay = self._retry_delay(attempt, retry_after)
+            logger.warning("WAHA send to %s failed (%s), retry in %.1fs", phone, error, delay)
+            time.sleep(delay)
+        self.failed += 1
+        logger.error("WAHA send error after %d attempts: %s", self.max_retries + 1, error)
+        return False
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed, "retries": self.retries}
+
+    def close(self):
+        if self._owns_session:
+            self.session.close()
+
+    def _retry_delay(self, attempt, retry_after=None):
+        return _retry_delay(attempt, retry_after, self.backoff, self.max_backoff)
+
+
+def _retry_delay(attempt, retry_after, backoff, max_backoff):
+    if retry_after:
+        try:
+            return min(float(retry_after), max_backoff)
+        except ValueError:
+            pass
+    delay = min(backoff * (2 ** attempt), max_backoff)
+    return delay + random.uniform(0, delay)
+
+
+class AsyncWahaClient:
+    """Асинхронный вариант WahaClient на httpx.AsyncClient для ASGI-приложения.
+
+    Политика повторов та же; ограничитель частоты можно передать общий
+    с синхронным клиентом (limiter), чтобы оба не превышали лимит сессии,
+    а пул соединений — общий с клиентами других сессий (client из
+    make_async_client()).
+    """
+
+    def __init__(self, url, build_payload, headers=None, timeout=15, pool_size=10,
+                 max_retries=3, backoff=0.5, max_backoff=10, rate_limit=20, limiter=None, on_retry=None,
+                 client=None):
+        import httpx
+        self._httpx = httpx
+        self.url = url
+        self.build_payload = build_payload
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_retry = on_retry
+        self.limiter = limiter or (TokenBucket(rate_limit) if rate_limit else None)
+        self._owns_client = client is None
+        self.client = client or make_async_client(timeout, pool_size, headers)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    async def send(self, phone, text):
+        """Отправляет одно сообщение; возвращает True при успехе."""
+        httpx = self._httpx
+        payload = self.build_payload(phone, text)
+        for attempt in range(self.max_retries + 1):
+            if self.limiter:
+                await self.limiter.acquire_async()
+            retry_after = None
+            try:
+                response = await self.client.post(self.url, json=payload)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    self.sent += 1
+                    logger.info("WAHA message sent to %s", phone)
+                    return True
+                error = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                error = e
+            except httpx.HTTPError as e:
+                self.failed += 1
+                logger.error("WAHA send error: %s", e)
+                return False
+            if attempt == self.max_retries:
+                break
+            self.retries += 1
+            if self.on_retry:
+                self.on_retry()
+            delay = _retry_delay(attempt, retry_after, self.backoff, self.max_backoff)
+            logger.warning("WAHA send to %s failed (%s), retry in %.1fs", phone, error, delay)
+            await asyncio.sleep(delay)
+        self.failed += 1
+        logger.error("WAHA send error after %d attempts: %s", self.max_retries + 1, error)
+        return False
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed, "retries": self.retries}
+
+    async def aclose(self):
+        if self._owns_client:
+            await self.client.aclose()